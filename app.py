@@ -1,81 +1,195 @@
-from flask import Flask
+from flask import Flask, request, jsonify, redirect, url_for, flash
 from flask_login import LoginManager
 from config import Config
 from models.user import User
-from routes import auth, admin, dashboard
+from routes import auth, admin, dashboard, health, api
+from utils.db import get_db_connection, report_error, user_cache, DatabaseUnavailable, CACHED_USER_COLUMNS
+from utils.search import init_user_index, user_index
+from utils.tokens import verify_token, TokenError, init_token_revocations, auth_failures
+from models.audit_log import AuditEvent
+from utils.logging import log_event
+from utils.rollups import init_rollups
+from utils.cache import init_cache_invalidations
+from utils.deletions import init_deletion_worker
+from utils.shards import is_sharded, init_shards
+import click
 import pymysql
 import os
 
-# Initialize Flask app
-app = Flask(__name__)
-app.config.from_object(Config)
-
 # Initialize Flask-Login
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.login_view = 'auth.login'
 login_manager.login_message = 'Please log in to access this page.'
 login_manager.login_message_category = 'info'
 
-@login_manager.user_loader
-def load_user(user_id):
-    """Load user by ID for Flask-Login."""
+# pid of the process whose per-worker resources have been started
+_worker_pid = None
+
+def _query_user(user_id):
+    connection = get_db_connection()
+    if connection is None:
+        raise DatabaseUnavailable('database unavailable')
     try:
-        connection = pymysql.connect(
-            host=Config.MYSQL_HOST,
-            user=Config.MYSQL_USER,
-            password=Config.MYSQL_PASSWORD,
-            database=Config.MYSQL_DB,
-            cursorclass=pymysql.cursors.DictCursor
-        )
-        
         with connection.cursor() as cursor:
-            cursor.execute("""
-                SELECT u.*, r.role_name 
+            cursor.execute(f"""
+                SELECT {CACHED_USER_COLUMNS}, r.role_name 
                 FROM Users u 
                 LEFT JOIN Roles r ON u.role_id = r.role_id 
                 WHERE u.user_id = %s
             """, (user_id,))
-            user_data = cursor.fetchone()
-            
-            if user_data:
-                user = User(
-                    user_id=user_data['user_id'],
-                    username=user_data['username'],
-                    email=user_data['email'],
-                    password=user_data['hashed_password'],
-                    full_name=user_data.get('full_name'),
-                    profile_pic=user_data.get('profile_pic'),
-                    role_id=user_data.get('role_id'),
-                    created_at=user_data.get('created_at'),
-                    updated_at=user_data.get('updated_at')
-                )
-                connection.close()
-                return user
-        
+            return cursor.fetchone()
+    finally:
         connection.close()
-        return None
-    
+
+def _load_user_row(user_id):
+    """Cached Users row (with role_name), falling back to a stale copy in degraded mode."""
+    try:
+        return user_cache.get_or_load(user_id, lambda: _query_user(user_id))
+    except DatabaseUnavailable:
+        pass
     except Exception as e:
+        report_error(e)
         print(f"Error loading user: {e}")
+    # Degraded mode: keep already logged-in users signed in from cache
+    return user_cache.get_stale(user_id)
+
+@login_manager.user_loader
+def load_user(user_id):
+    """Load user by ID for Flask-Login (cached; writes call invalidate_user)."""
+    return _build_user(_load_user_row(int(user_id)))
+
+@login_manager.unauthorized_handler
+def unauthorized():
+    """API clients get a 401; browsers are sent to the login page."""
+    if request.path.startswith('/api/'):
+        return jsonify({'error': 'Authentication required'}), 401
+    flash(login_manager.login_message, login_manager.login_message_category)
+    return redirect(url_for(login_manager.login_view, next=request.path))
+
+@login_manager.request_loader
+def load_user_from_token(req):
+    """Authenticate API clients from an Authorization: Bearer token.
+    
+    The signature and revocation check need no database access; the claims
+    are then checked against the cached user row, so a token stops working
+    as soon as its user is deactivated, deleted or given another role.
+    """
+    header = req.headers.get('Authorization', '')
+    if not header.startswith('Bearer '):
+        return None
+    ip_address = req.remote_addr
+    if auth_failures.blocked(ip_address):
         return None
+    try:
+        claims = verify_token(header[7:].strip())
+    except TokenError as e:
+        _token_rejected(e.user_id, str(e), ip_address)
+        return None
+    user_data = _load_user_row(claims['user_id'])
+    user = _build_user(user_data) if user_data and user_data.get('role_name') == claims['role'] else None
+    if user is None:
+        _token_rejected(claims['user_id'], 'User inactive or role changed', ip_address)
+        return None
+    user.token_id = claims['token_id']
+    return user
 
-# Register blueprints
-app.register_blueprint(auth.auth_bp)
-app.register_blueprint(admin.admin_bp)
-app.register_blueprint(dashboard.dashboard_bp)
+def _token_rejected(user_id, reason, ip_address):
+    """Count a failed Bearer authentication against the client IP and audit it."""
+    auth_failures.hit(ip_address)
+    log_event(user_id, AuditEvent.API_AUTH_FAILED, payload={'reason': reason, 'ip': ip_address})
 
-# Create necessary directories
-os.makedirs('static/uploads', exist_ok=True)
+def _build_user(user_data):
+    """Create a User from a Users row, or None."""
+    if not user_data or not user_data.get('is_active', True):
+        return None
+    return User(
+        user_id=user_data['user_id'],
+        username=user_data['username'],
+        email=user_data['email'],
+        password=user_data.get('hashed_password'),
+        full_name=user_data.get('full_name'),
+        profile_pic=user_data.get('profile_pic'),
+        role_id=user_data.get('role_id'),
+        created_at=user_data.get('created_at'),
+        updated_at=user_data.get('updated_at'),
+        active=user_data.get('is_active', True),
+        role_name=user_data.get('role_name')
+    )
 
-if __name__ == '__main__':
-    # Check if database tables exist, if not, create them
+def init_worker():
+    """Start per-process resources (background index builds).
+    
+    Threads do not survive fork(), so this must run in each worker after it
+    is forked, never in a preloading master. Called from the gunicorn
+    post_fork hook, and lazily on the first request for other servers.
+    """
+    global _worker_pid
+    if _worker_pid == os.getpid():
+        return
+    _worker_pid = os.getpid()
+    # Listen first, so search index writes broadcast while it starts are not missed
+    init_cache_invalidations()
+    init_user_index()
+    init_token_revocations()
+    init_rollups()
+    init_deletion_worker()
+    if Config.ASYNC_MODE:
+        from utils.async_db import async_db
+        async_db.start()
+
+def preload_worker_state():
+    """Build the search index once, in a preloading master.
+    
+    Workers forked from the master share it copy-on-write instead of each
+    scanning Users at startup. Only a short-lived connection is opened, so
+    nothing unsafe is inherited. Called from the gunicorn when_ready hook.
+    """
+    user_index.rebuild()
+
+def _ensure_worker_initialized():
+    if _worker_pid != os.getpid():
+        init_worker()
+
+def create_app(config_object=Config):
+    """Application factory; the only place an app is built.
+    
+    gunicorn calls it as app:create_app() and the flask CLI finds it by
+    name, so importing this module builds nothing. Safe to call in a
+    preloading master: it opens no connections or threads.
+    """
+    app = Flask(__name__)
+    app.config.from_object(config_object)
+    
+    login_manager.init_app(app)
+    
+    # Register blueprints
+    app.register_blueprint(auth.auth_bp)
+    app.register_blueprint(admin.admin_bp)
+    app.register_blueprint(dashboard.dashboard_bp)
+    app.register_blueprint(health.health_bp)
+    app.register_blueprint(api.api_bp)
+    
+    if app.config.get('ASYNC_MODE'):
+        from routes.async_views import register_async_views
+        register_async_views(app)
+    
+    app.before_request(_ensure_worker_initialized)
+    app.cli.add_command(init_db_command)
+    
+    # Create necessary directories
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    
+    return app
+
+def init_database():
+    """Create the database and tables if they do not exist."""
     try:
         connection = pymysql.connect(
             host=Config.MYSQL_HOST,
             user=Config.MYSQL_USER,
             password=Config.MYSQL_PASSWORD,
-            cursorclass=pymysql.cursors.DictCursor
+            cursorclass=pymysql.cursors.DictCursor,
+            connect_timeout=Config.MYSQL_CONNECT_TIMEOUT
         )
         
         with connection.cursor() as cursor:
@@ -108,12 +222,27 @@ if __name__ == '__main__':
                     full_name VARCHAR(100),
                     profile_pic VARCHAR(255),
                     role_id INT,
+                    is_active BOOLEAN NOT NULL DEFAULT TRUE,
+                    risk_flagged_at DATETIME NULL,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-                    FOREIGN KEY (role_id) REFERENCES Roles(role_id)
+                    FOREIGN KEY (role_id) REFERENCES Roles(role_id),
+                    INDEX idx_users_updated (updated_at)
                 )
             """)
             
+            # Add columns introduced after the first release
+            cursor.execute("SHOW COLUMNS FROM Users LIKE 'is_active'")
+            if not cursor.fetchone():
+                cursor.execute("ALTER TABLE Users ADD COLUMN is_active BOOLEAN NOT NULL DEFAULT TRUE AFTER role_id")
+            cursor.execute("SHOW COLUMNS FROM Users LIKE 'risk_flagged_at'")
+            if not cursor.fetchone():
+                cursor.execute("ALTER TABLE Users ADD COLUMN risk_flagged_at DATETIME NULL AFTER is_active")
+            # The search index catches up on Users by updated_at
+            cursor.execute("SHOW INDEX FROM Users WHERE Key_name = 'idx_users_updated'")
+            if not cursor.fetchone():
+                cursor.execute("ALTER TABLE Users ADD INDEX idx_users_updated (updated_at)")
+            
             # Create Sessions table
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS Sessions (
@@ -127,14 +256,114 @@ if __name__ == '__main__':
                 )
             """)
             
+            # Create API token tables
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS ApiTokens (
+                    token_id INT PRIMARY KEY AUTO_INCREMENT,
+                    user_id INT NOT NULL,
+                    label VARCHAR(100),
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    expires_at TIMESTAMP NULL,
+                    INDEX idx_apitokens_user (user_id)
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS RevokedTokens (
+                    revoke_id INT PRIMARY KEY AUTO_INCREMENT,
+                    token_id INT NOT NULL,
+                    revoked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE KEY uniq_revoked_token (token_id)
+                )
+            """)
+            # Revocations are inserted with INSERT IGNORE against this key;
+            # older tables may hold duplicates, so keep the first of each
+            cursor.execute("SHOW INDEX FROM RevokedTokens WHERE Key_name = 'uniq_revoked_token'")
+            if not cursor.fetchone():
+                cursor.execute("""
+                    DELETE r FROM RevokedTokens r 
+                    JOIN RevokedTokens k ON k.token_id = r.token_id AND k.revoke_id < r.revoke_id
+                """)
+                cursor.execute("ALTER TABLE RevokedTokens ADD UNIQUE KEY uniq_revoked_token (token_id)")
+            
             # Create AuditLogs table
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS AuditLogs (
                     log_id INT AUTO_INCREMENT PRIMARY KEY,
                     user_id INT,
                     action VARCHAR(100),
+                    event_type TINYINT UNSIGNED NOT NULL DEFAULT 0,
+                    target_id INT NULL,
+                    payload JSON NULL,
                     action_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES Users(user_id)
+                    FOREIGN KEY (user_id) REFERENCES Users(user_id),
+                    INDEX idx_auditlogs_type_time (event_type, action_time),
+                    INDEX idx_auditlogs_target_time (target_id, action_time)
+                )
+            """)
+            
+            # Structured audit columns for databases created before they existed
+            cursor.execute("SHOW COLUMNS FROM AuditLogs LIKE 'event_type'")
+            if not cursor.fetchone():
+                cursor.execute("""
+                    ALTER TABLE AuditLogs 
+                        ADD COLUMN event_type TINYINT UNSIGNED NOT NULL DEFAULT 0 AFTER action, 
+                        ADD COLUMN target_id INT NULL AFTER event_type, 
+                        ADD COLUMN payload JSON NULL AFTER target_id, 
+                        ADD INDEX idx_auditlogs_type_time (event_type, action_time), 
+                        ADD INDEX idx_auditlogs_target_time (target_id, action_time)
+                """)
+            
+            # Create UserStats table (per-user activity summary)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS UserStats (
+                    user_id INT PRIMARY KEY,
+                    login_count INT NOT NULL DEFAULT 0,
+                    failed_login_count INT NOT NULL DEFAULT 0,
+                    activity_count INT NOT NULL DEFAULT 0,
+                    last_login_at TIMESTAMP NULL,
+                    last_logout_at TIMESTAMP NULL,
+                    last_failed_login_at TIMESTAMP NULL,
+                    last_activity_at TIMESTAMP NULL,
+                    last_ip VARCHAR(45),
+                    FOREIGN KEY (user_id) REFERENCES Users(user_id) ON DELETE CASCADE
+                )
+            """)
+            
+            # Create ActivityRollups table (time-bucketed counters for admin charts)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS ActivityRollups (
+                    resolution ENUM('minute', 'hour', 'day') NOT NULL,
+                    bucket_start DATETIME NOT NULL,
+                    logins INT NOT NULL DEFAULT 0,
+                    failures INT NOT NULL DEFAULT 0,
+                    registrations INT NOT NULL DEFAULT 0,
+                    unique_users INT NOT NULL DEFAULT 0,
+                    unique_users_hll BLOB,
+                    PRIMARY KEY (resolution, bucket_start)
+                )
+            """)
+            
+            # Create AuditOutbox table (drained into segment files by the relay)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS AuditOutbox (
+                    outbox_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                    kind VARCHAR(20) NOT NULL,
+                    body TEXT NOT NULL,
+                    created_at DATETIME NOT NULL
+                )
+            """)
+            
+            # Create AccountDeletions table (queue drained by the background deletion worker)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS AccountDeletions (
+                    user_id INT PRIMARY KEY,
+                    requested_by INT NULL,
+                    mode ENUM('anonymize', 'cascade') NOT NULL DEFAULT 'anonymize',
+                    requested_at DATETIME NOT NULL,
+                    claimed_by VARCHAR(64) NULL,
+                    claimed_at DATETIME NULL,
+                    attempts INT NOT NULL DEFAULT 0,
+                    last_error VARCHAR(255) NULL
                 )
             """)
             
@@ -142,11 +371,22 @@ if __name__ == '__main__':
         
         connection.close()
         print("Database initialized successfully!")
+        
+        if is_sharded():
+            init_shards()
     
     except Exception as e:
         print(f"Database initialization error: {e}")
         print("Please make sure MySQL is running and credentials are correct in .env file")
-    
-    # Run the app
-    app.run(debug=True, host='0.0.0.0', port=5000)
 
+@click.command('init-db')
+def init_db_command():
+    """Create the database and tables."""
+    init_database()
+
+if __name__ == '__main__':
+    # Check if database tables exist, if not, create them
+    init_database()
+    
+    # Run the development server (use gunicorn -c gunicorn.conf.py in production)
+    create_app().run(debug=True, host='0.0.0.0', port=5000)
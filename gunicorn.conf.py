@@ -0,0 +1,65 @@
+# Gunicorn configuration for production
+#
+#   gunicorn -c gunicorn.conf.py
+#
+# Deploy new code (the app is preloaded, so HUP alone keeps running the old code):
+#   kill -USR2 $(cat instance/gunicorn.pid)         new master and workers start on the new code
+#   kill -WINCH $(cat instance/gunicorn.pid.oldbin) old workers finish their requests and exit
+#   kill -QUIT $(cat instance/gunicorn.pid.oldbin)  old master exits (or HUP it to roll back)
+# Restart workers on the same code: kill -HUP $(cat instance/gunicorn.pid)
+# Drain:           touch instance/drain     (/readyz returns 503 so the load balancer stops routing)
+
+import gc
+import multiprocessing
+import os
+
+wsgi_app = 'app:create_app()'
+bind = os.getenv('BIND', '0.0.0.0:5000')
+pidfile = os.getenv('PIDFILE', 'instance/gunicorn.pid')
+os.makedirs(os.path.dirname(pidfile) or '.', exist_ok=True)
+
+# One process per core (plus one); threads cover requests waiting on MySQL
+# and long-lived SSE streams on the admin logs page
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() + 1))
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', '8'))
+
+# Build the app once in the master so workers share its memory copy-on-write.
+# The factory opens no connections or threads, so nothing unsafe is inherited.
+# The cyclic GC stays off in the master: a collection there writes to every
+# tracked object's header and un-shares the pages.
+preload_app = True
+gc.disable()
+
+# Recycle workers periodically to bound memory growth; jitter avoids all
+# workers restarting at once
+max_requests = int(os.getenv('MAX_REQUESTS', '10000'))
+max_requests_jitter = int(os.getenv('MAX_REQUESTS_JITTER', '1000'))
+
+# Time given to in-flight requests when stopping or reloading
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', '30'))
+timeout = int(os.getenv('WORKER_TIMEOUT', '60'))
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+
+def when_ready(server):
+    """Build the search index once, before any worker forks."""
+    from app import preload_worker_state
+    preload_worker_state()
+
+def pre_fork(server, worker):
+    # Move everything the master holds out of the GC's reach, so collections
+    # in the worker never touch (and copy) the shared pages
+    gc.freeze()
+
+def post_fork(server, worker):
+    """Start per-worker resources (DB-backed caches, background threads)."""
+    gc.enable()
+    from app import init_worker
+    init_worker()
+    server.log.info(f"Worker {worker.pid} initialized")
+
+def worker_exit(server, worker):
+    server.log.info(f"Worker {worker.pid} exiting")
@@ -27,11 +27,19 @@ CREATE TABLE IF NOT EXISTS Users (
     full_name VARCHAR(100),
     profile_pic VARCHAR(255),
     role_id INT,
+    is_active BOOLEAN NOT NULL DEFAULT TRUE,
+    risk_flagged_at DATETIME NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-    FOREIGN KEY (role_id) REFERENCES Roles(role_id)
+    FOREIGN KEY (role_id) REFERENCES Roles(role_id),
+    INDEX idx_users_updated (updated_at)
 );
 
+-- Upgrading an existing database:
+-- ALTER TABLE Users ADD COLUMN is_active BOOLEAN NOT NULL DEFAULT TRUE AFTER role_id;
+-- ALTER TABLE Users ADD COLUMN risk_flagged_at DATETIME NULL AFTER is_active;
+-- ALTER TABLE Users ADD INDEX idx_users_updated (updated_at);
+
 -- Create Sessions table
 CREATE TABLE IF NOT EXISTS Sessions (
     session_id INT PRIMARY KEY AUTO_INCREMENT,
@@ -43,13 +51,93 @@ CREATE TABLE IF NOT EXISTS Sessions (
     FOREIGN KEY (user_id) REFERENCES Users(user_id)
 );
 
+-- Create API token tables
+CREATE TABLE IF NOT EXISTS ApiTokens (
+    token_id INT PRIMARY KEY AUTO_INCREMENT,
+    user_id INT NOT NULL,
+    label VARCHAR(100),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NULL,
+    INDEX idx_apitokens_user (user_id)
+);
+
+-- Revocations are read incrementally by revoke_id
+CREATE TABLE IF NOT EXISTS RevokedTokens (
+    revoke_id INT PRIMARY KEY AUTO_INCREMENT,
+    token_id INT NOT NULL,
+    revoked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE KEY uniq_revoked_token (token_id)
+);
+
 -- Create AuditLogs table
 CREATE TABLE IF NOT EXISTS AuditLogs (
     log_id INT AUTO_INCREMENT PRIMARY KEY,
     user_id INT,
-    action VARCHAR(100),
+    action VARCHAR(100),                         -- legacy free text; NULL for structured events
+    event_type TINYINT UNSIGNED NOT NULL DEFAULT 0,  -- see models.audit_log.AuditEvent
+    target_id INT NULL,                          -- user acted upon (user_id is the actor)
+    payload JSON NULL,
     action_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY (user_id) REFERENCES Users(user_id)
+    FOREIGN KEY (user_id) REFERENCES Users(user_id),
+    INDEX idx_auditlogs_type_time (event_type, action_time),
+    INDEX idx_auditlogs_target_time (target_id, action_time)
+);
+
+-- Upgrading an existing database (then run: flask --app app admin backfill-audit-events):
+-- ALTER TABLE AuditLogs
+--     ADD COLUMN event_type TINYINT UNSIGNED NOT NULL DEFAULT 0 AFTER action,
+--     ADD COLUMN target_id INT NULL AFTER event_type,
+--     ADD COLUMN payload JSON NULL AFTER target_id,
+--     ADD INDEX idx_auditlogs_type_time (event_type, action_time),
+--     ADD INDEX idx_auditlogs_target_time (target_id, action_time);
+
+-- Create UserStats table (per-user activity summary, maintained incrementally)
+-- Populate for existing data with: flask --app app admin backfill-stats
+CREATE TABLE IF NOT EXISTS UserStats (
+    user_id INT PRIMARY KEY,
+    login_count INT NOT NULL DEFAULT 0,
+    failed_login_count INT NOT NULL DEFAULT 0,
+    activity_count INT NOT NULL DEFAULT 0,
+    last_login_at TIMESTAMP NULL,
+    last_logout_at TIMESTAMP NULL,
+    last_failed_login_at TIMESTAMP NULL,
+    last_activity_at TIMESTAMP NULL,
+    last_ip VARCHAR(45),
+    FOREIGN KEY (user_id) REFERENCES Users(user_id) ON DELETE CASCADE
+);
+
+-- Create ActivityRollups table (per-minute/hour/day counters for admin charts;
+-- unique_users_hll holds a HyperLogLog sketch so buckets can be merged)
+CREATE TABLE IF NOT EXISTS ActivityRollups (
+    resolution ENUM('minute', 'hour', 'day') NOT NULL,
+    bucket_start DATETIME NOT NULL,
+    logins INT NOT NULL DEFAULT 0,
+    failures INT NOT NULL DEFAULT 0,
+    registrations INT NOT NULL DEFAULT 0,
+    unique_users INT NOT NULL DEFAULT 0,
+    unique_users_hll BLOB,
+    PRIMARY KEY (resolution, bucket_start)
+);
+
+-- Create AuditOutbox table (written with each audit/session change and drained
+-- into segment files by: flask --app app admin relay-outbox --follow)
+CREATE TABLE IF NOT EXISTS AuditOutbox (
+    outbox_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    kind VARCHAR(20) NOT NULL,
+    body TEXT NOT NULL,
+    created_at DATETIME NOT NULL
+);
+
+-- Create AccountDeletions table (accounts waiting for the background deletion worker)
+CREATE TABLE IF NOT EXISTS AccountDeletions (
+    user_id INT PRIMARY KEY,
+    requested_by INT NULL,
+    mode ENUM('anonymize', 'cascade') NOT NULL DEFAULT 'anonymize',
+    requested_at DATETIME NOT NULL,
+    claimed_by VARCHAR(64) NULL,
+    claimed_at DATETIME NULL,
+    attempts INT NOT NULL DEFAULT 0,
+    last_error VARCHAR(255) NULL
 );
 
 -- Optional: Create an admin user
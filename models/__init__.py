@@ -1,7 +1,7 @@
 from .user import User
 from .role import Role
 from .session import Session
-from .audit_log import AuditLog
+from .audit_log import AuditLog, AuditEvent
 
-__all__ = ['User', 'Role', 'Session', 'AuditLog']
+__all__ = ['User', 'Role', 'Session', 'AuditLog', 'AuditEvent']
 
@@ -1,15 +1,147 @@
+import json
+import re
+
+class AuditEvent:
+    """Integer codes for audit event types (AuditLogs.event_type)."""
+    OTHER = 0
+    USER_REGISTERED = 1
+    LOGIN = 2
+    LOGOUT = 3
+    LOGIN_FAILED = 4
+    PROFILE_UPDATED = 5
+    ACCOUNT_DELETED = 6
+    ROLE_CHANGED = 7
+    USER_DELETED = 8
+    BULK_ROLE_CHANGED = 9
+    BULK_DEACTIVATED = 10
+    BULK_ACTIVATED = 11
+    BULK_DELETED = 12
+    SUSPICIOUS_LOGIN = 13
+    RISK_FLAG_CLEARED = 14
+    API_TOKEN_ISSUED = 15
+    API_TOKEN_REVOKED = 16
+    API_AUTH_FAILED = 17
+    
+    NAMES = {
+        0: 'other',
+        1: 'user_registered',
+        2: 'login',
+        3: 'logout',
+        4: 'login_failed',
+        5: 'profile_updated',
+        6: 'account_deleted',
+        7: 'role_changed',
+        8: 'user_deleted',
+        9: 'bulk_role_changed',
+        10: 'bulk_deactivated',
+        11: 'bulk_activated',
+        12: 'bulk_deleted',
+        13: 'suspicious_login',
+        14: 'risk_flag_cleared',
+        15: 'api_token_issued',
+        16: 'api_token_revoked',
+        17: 'api_auth_failed'
+    }
+    
+    # Human readable text, formatted from target_id and payload
+    TEMPLATES = {
+        1: 'User registered',
+        2: 'User logged in',
+        3: 'User logged out',
+        4: 'Failed login attempt',
+        5: 'Profile updated',
+        6: 'Account deleted',
+        7: 'Changed role for user_id {target_id} to {role}',
+        8: 'Deleted user_id {target_id}',
+        9: 'Bulk role change to role_id {role_id}: {count} users ({ids})',
+        10: 'Bulk deactivated {count} users ({ids})',
+        11: 'Bulk activated {count} users ({ids})',
+        12: 'Bulk deleted {count} users ({ids}, {mode})',
+        13: 'Suspicious login ({reasons}) from {ip}',
+        14: 'Cleared login risk flag for user_id {target_id}',
+        15: 'API token {token_id} issued',
+        16: 'API token {token_id} revoked',
+        17: 'API authentication failed ({reason}) from {ip}'
+    }
+    
+    # Bulk events recorded before they listed every user id kept only the range
+    RANGE_TEMPLATES = {
+        9: 'Bulk role change to role_id {role_id}: {count} users ({first}..{last})',
+        10: 'Bulk deactivated {count} users ({first}..{last})',
+        11: 'Bulk activated {count} users ({first}..{last})',
+        12: 'Bulk deleted {count} users ({first}..{last}, {mode})'
+    }
+    
+    # Legacy free-text actions and how they map onto event fields
+    LEGACY_PATTERNS = [
+        (re.compile(r'^User registered$'), USER_REGISTERED, ()),
+        (re.compile(r'^User logged in$'), LOGIN, ()),
+        (re.compile(r'^User logged out$'), LOGOUT, ()),
+        (re.compile(r'^Failed login attempt$'), LOGIN_FAILED, ()),
+        (re.compile(r'^Profile updated$'), PROFILE_UPDATED, ()),
+        (re.compile(r'^Account deleted$'), ACCOUNT_DELETED, ()),
+        (re.compile(r'^Changed role for user_id (\d+) to (.+)$'), ROLE_CHANGED, ('target_id', 'role')),
+        (re.compile(r'^Deleted user_id (\d+)$'), USER_DELETED, ('target_id',)),
+        (re.compile(r'^Bulk role change to role_id (\d+): (\d+) users \((\d+)\.\.(\d+)\)$'), BULK_ROLE_CHANGED,
+         ('role_id', 'count', 'first', 'last')),
+        (re.compile(r'^Bulk deactivated (\d+) users \((\d+)\.\.(\d+)\)$'), BULK_DEACTIVATED, ('count', 'first', 'last')),
+        (re.compile(r'^Bulk activated (\d+) users \((\d+)\.\.(\d+)\)$'), BULK_ACTIVATED, ('count', 'first', 'last')),
+        (re.compile(r'^Bulk deleted (\d+) users \((\d+)\.\.(\d+), (\w+)\)$'), BULK_DELETED,
+         ('count', 'first', 'last', 'mode')),
+        (re.compile(r'^Suspicious login \((.+)\) from (.+)$'), SUSPICIOUS_LOGIN, ('reasons', 'ip')),
+        (re.compile(r'^Cleared login risk flag for user_id (\d+)$'), RISK_FLAG_CLEARED, ('target_id',)),
+        (re.compile(r'^API token (\d+) issued$'), API_TOKEN_ISSUED, ('token_id',)),
+        (re.compile(r'^API token (\d+) revoked$'), API_TOKEN_REVOKED, ('token_id',))
+    ]
+    
+    @classmethod
+    def describe(cls, event_type, target_id=None, payload=None):
+        """Render an event as text, e.g. for the logs page."""
+        if isinstance(payload, str):
+            payload = json.loads(payload)
+        payload = payload or {}
+        template = cls.TEMPLATES.get(event_type)
+        if template is None:
+            return payload.get('text', cls.NAMES.get(event_type, 'unknown'))
+        if 'ids' in payload:
+            payload = dict(payload, ids='user_ids ' + ', '.join(map(str, payload['ids'])))
+        elif event_type in cls.RANGE_TEMPLATES:
+            template = cls.RANGE_TEMPLATES[event_type]
+        try:
+            return template.format(target_id=target_id, **payload)
+        except KeyError:
+            return cls.NAMES.get(event_type, 'unknown')
+    
+    @classmethod
+    def parse_legacy(cls, action):
+        """Map a legacy action string to (event_type, target_id, payload)."""
+        for pattern, event_type, fields in cls.LEGACY_PATTERNS:
+            match = pattern.match(action or '')
+            if not match:
+                continue
+            values = dict(zip(fields, match.groups()))
+            target_id = values.pop('target_id', None)
+            payload = {k: int(v) if v.isdigit() else v for k, v in values.items()}
+            return event_type, int(target_id) if target_id else None, payload or None
+        return cls.OTHER, None, {'text': action}
+
 class AuditLog:
-    def __init__(self, log_id, user_id, action, action_time):
+    def __init__(self, log_id, user_id, action, action_time, event_type=AuditEvent.OTHER, target_id=None, payload=None):
         self.log_id = log_id
         self.user_id = user_id
         self.action = action
         self.action_time = action_time
+        self.event_type = event_type
+        self.target_id = target_id
+        self.payload = payload
     
     def to_dict(self):
         return {
             'log_id': self.log_id,
             'user_id': self.user_id,
-            'action': self.action,
-            'action_time': self.action_time
+            'action': self.action or AuditEvent.describe(self.event_type, self.target_id, self.payload),
+            'action_time': self.action_time,
+            'event_type': AuditEvent.NAMES.get(self.event_type, 'other'),
+            'target_id': self.target_id,
+            'payload': self.payload
         }
-
@@ -1,7 +1,7 @@
 from flask_login import UserMixin
 
 class User(UserMixin):
-    def __init__(self, user_id, username, email, password, full_name=None, profile_pic=None, role_id=None, created_at=None, updated_at=None):
+    def __init__(self, user_id, username, email, password, full_name=None, profile_pic=None, role_id=None, created_at=None, updated_at=None, active=True, role_name=None):
         self.id = user_id
         self.user_id = user_id
         self.username = username
@@ -12,6 +12,12 @@ class User(UserMixin):
         self.role_id = role_id
         self.created_at = created_at
         self.updated_at = updated_at
+        self.active = active
+        self.role_name = role_name
+    
+    @property
+    def is_active(self):
+        return bool(self.active)
     
     def to_dict(self):
         return {
@@ -22,6 +28,7 @@ class User(UserMixin):
             'profile_pic': self.profile_pic,
             'role_id': self.role_id,
             'created_at': self.created_at,
-            'updated_at': self.updated_at
+            'updated_at': self.updated_at,
+            'is_active': bool(self.active)
         }
 
@@ -1,36 +1,39 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, session as flask_session
-from flask_login import login_required
+from flask import Blueprint, render_template, redirect, url_for, flash, request, session as flask_session, Response, stream_with_context, jsonify, current_app
+from flask_login import login_required, current_user
 from functools import wraps
-import pymysql
+import json
+import time
+import click
 from config import Config
-from utils.logging import get_audit_logs, create_audit_log
+from models.audit_log import AuditEvent
+from utils.logging import get_audit_logs, log_event, backfill_audit_events
 from utils.sessions import get_all_sessions
+from utils.db import get_db_connection, invalidate_users
+from utils.events import LiveFeed, matches_filter, stream_slots
+from utils.search import user_index
+from utils.bulk import bulk_change_role, bulk_set_active, bulk_delete_users, role_exists
+from utils.anomaly import login_monitor, set_risk_flag, get_risk
+from utils.stats import backfill_user_stats
+from utils.rollups import get_trend, compact_rollups, RESOLUTIONS
+from utils.outbox import run_relay, RelayLockedError, SegmentReader, encode_body, outbox_dir
+from utils.shards import count_rows, rebalance, shard_count, attach_usernames
+from utils.tokens import revoke_user_tokens
+from utils.deletions import request_deletion, process_deletions, collect_orphaned_uploads, pending_deletions, \
+    failed_deletions, retry_failed_deletions
+from utils.breach import build_corpus, build_bloom
 
 admin_bp = Blueprint('admin', __name__)
 
-def get_db_connection():
-    """Create and return a database connection."""
-    try:
-        connection = pymysql.connect(
-            host=Config.MYSQL_HOST,
-            user=Config.MYSQL_USER,
-            password=Config.MYSQL_PASSWORD,
-            database=Config.MYSQL_DB,
-            cursorclass=pymysql.cursors.DictCursor
-        )
-        return connection
-    except Exception as e:
-        print(f"Database connection error: {e}")
-        return None
-
 def admin_required(f):
     """Decorator to require admin role."""
     @wraps(f)
     def wrapper(*args, **kwargs):
-        if flask_session.get('role') != 'Admin':
+        # The loaded user row is current; the session copy is only a fallback
+        role = getattr(current_user, 'role_name', None) or flask_session.get('role')
+        if role != 'Admin':
             flash('Access denied. Admin privileges required.', 'danger')
             return redirect(url_for('dashboard.dashboard'))
-        return f(*args, **kwargs)
+        return current_app.ensure_sync(f)(*args, **kwargs)
     return wrapper
 
 @admin_bp.route('/admin/dashboard')
@@ -51,15 +54,13 @@ def admin_dashboard():
             
             cursor.execute("SELECT COUNT(*) as count FROM Roles")
             total_roles = cursor.fetchone()['count']
-            
-            cursor.execute("SELECT COUNT(*) as count FROM Sessions")
-            total_sessions = cursor.fetchone()['count']
-            
-            cursor.execute("SELECT COUNT(*) as count FROM AuditLogs")
-            total_logs = cursor.fetchone()['count']
         
         conn.close()
         
+        # Sessions and audit logs are counted across all shards
+        total_sessions = count_rows('Sessions')
+        total_logs = count_rows('AuditLogs')
+        
         stats = {
             'total_users': total_users,
             'total_roles': total_roles,
@@ -87,9 +88,10 @@ def admin_users():
     try:
         with conn.cursor() as cursor:
             cursor.execute("""
-                SELECT u.*, r.role_name 
+                SELECT u.*, r.role_name, st.login_count, st.last_login_at 
                 FROM Users u 
                 LEFT JOIN Roles r ON u.role_id = r.role_id 
+                LEFT JOIN UserStats st ON st.user_id = u.user_id 
                 ORDER BY u.created_at DESC
             """)
             users = cursor.fetchall()
@@ -100,13 +102,45 @@ def admin_users():
             roles = cursor.fetchall()
         
         conn.close()
-        return render_template('admin_users.html', users=users, roles=roles)
+        risk = {user['user_id']: {
+            'risk_score': login_monitor.risk_score(user['user_id']),
+            'flagged': user.get('risk_flagged_at') is not None,
+            'flagged_at': user.get('risk_flagged_at')
+        } for user in users}
+        return render_template('admin_users.html', users=users, roles=roles, risk=risk)
     
     except Exception as e:
         flash(f'Error: {str(e)}', 'danger')
         conn.close()
         return redirect(url_for('dashboard.dashboard'))
 
+@admin_bp.route('/admin/users/search')
+@login_required
+@admin_required
+def search_users():
+    """Type-ahead search over username, email and full name."""
+    query = request.args.get('q', '')
+    limit = min(request.args.get('limit', 10, type=int), 50)
+    return jsonify({
+        'ready': user_index.ready,
+        'results': user_index.search(query, limit=limit)
+    })
+
+@admin_bp.route('/admin/users/<int:user_id>/risk', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def user_risk(user_id):
+    """Show a user's login risk flag; POST clears it."""
+    if request.method == 'POST':
+        if not set_risk_flag(user_id, False):
+            return jsonify({'error': 'Database unavailable'}), 503
+        from flask_login import current_user
+        log_event(current_user.user_id, AuditEvent.RISK_FLAG_CLEARED, target_id=user_id)
+    risk = get_risk(user_id)
+    if risk is None:
+        return jsonify({'error': 'Database unavailable'}), 503
+    return jsonify(risk)
+
 @admin_bp.route('/admin/change_role/<int:user_id>', methods=['POST'])
 @login_required
 @admin_required
@@ -135,9 +169,12 @@ def change_role(user_id):
                 "UPDATE Users SET role_id = %s WHERE user_id = %s",
                 (new_role_id, user_id)
             )
+            # Tokens carry the old role; make the user sign in again
+            revoke_user_tokens(cursor, [user_id])
             conn.commit()
+        invalidate_users([user_id])
         
-        create_audit_log(admin_user_id, f'Changed role for user_id {user_id} to {role_name}')
+        log_event(admin_user_id, AuditEvent.ROLE_CHANGED, target_id=user_id, payload={'role': role_name})
         
         conn.close()
         flash('User role updated successfully!', 'success')
@@ -152,50 +189,329 @@ def change_role(user_id):
 @login_required
 @admin_required
 def delete_user(user_id):
-    """Delete a user."""
-    conn = get_db_connection()
-    if conn is None:
+    """Delete a user.
+    
+    The user is deactivated and queued here; their rows and uploads are
+    removed by the background deletion worker.
+    """
+    from flask_login import current_user
+    admin_user_id = current_user.user_id
+    
+    # Prevent admin from deleting themselves
+    if user_id == admin_user_id:
+        flash('You cannot delete your own account.', 'warning')
+        return redirect(url_for('admin.admin_users'))
+    
+    # Also records the USER_DELETED event
+    if not request_deletion(user_id, requested_by=admin_user_id):
         flash('Database connection error.', 'danger')
         return redirect(url_for('admin.admin_users'))
     
-    try:
-        # Get current user from session
-        from flask_login import current_user
-        admin_user_id = current_user.user_id
-        
-        # Prevent admin from deleting themselves
-        if user_id == admin_user_id:
-            flash('You cannot delete your own account.', 'warning')
-            conn.close()
+    flash('User deleted. Their data will be removed shortly.', 'success')
+    return redirect(url_for('admin.admin_users'))
+
+@admin_bp.route('/admin/users/bulk', methods=['POST'])
+@login_required
+@admin_required
+def bulk_users():
+    """Apply one action to many selected users."""
+    from flask_login import current_user
+    admin_user_id = current_user.user_id
+    
+    action = request.form.get('action')
+    # Admins cannot demote, deactivate or delete themselves in bulk either
+    user_ids = [user_id for user_id in request.form.getlist('user_ids', type=int) if user_id != admin_user_id]
+    if not user_ids:
+        flash('No users selected (your own account is skipped).', 'warning')
+        return redirect(url_for('admin.admin_users'))
+    
+    if action == 'change_role':
+        role_id = request.form.get('role_id', type=int)
+        if role_id is None:
+            flash('Select a role.', 'warning')
             return redirect(url_for('admin.admin_users'))
-        
-        with conn.cursor() as cursor:
-            cursor.execute("DELETE FROM Users WHERE user_id = %s", (user_id,))
-            conn.commit()
-        
-        create_audit_log(admin_user_id, f'Deleted user_id {user_id}')
-        
-        conn.close()
-        flash('User deleted successfully!', 'success')
+        found = role_exists(role_id)
+        if found is None:
+            flash('Database connection error.', 'danger')
+            return redirect(url_for('admin.admin_users'))
+        if not found:
+            flash('Unknown role.', 'danger')
+            return redirect(url_for('admin.admin_users'))
+        processed, failed = bulk_change_role(user_ids, role_id, admin_user_id)
+    elif action == 'deactivate':
+        processed, failed = bulk_set_active(user_ids, False, admin_user_id)
+    elif action == 'activate':
+        processed, failed = bulk_set_active(user_ids, True, admin_user_id)
+    elif action == 'delete':
+        mode = request.form.get('mode', 'anonymize')
+        if mode not in ('anonymize', 'cascade'):
+            mode = 'anonymize'
+        processed, failed = bulk_delete_users(user_ids, admin_user_id, mode=mode)
+    else:
+        flash('Unknown bulk action.', 'danger')
         return redirect(url_for('admin.admin_users'))
     
+    if failed < 0:
+        flash('Database connection error.', 'danger')
+    elif failed:
+        flash(f'{processed} users updated; {failed} chunk(s) failed and were rolled back.', 'warning')
+    elif action == 'delete':
+        flash(f'{processed} users deactivated and queued for deletion.', 'success')
+    else:
+        flash(f'{processed} users updated successfully!', 'success')
+    return redirect(url_for('admin.admin_users'))
+
+def _read_user_ids(ids, ids_file):
+    """Collect user ids from arguments and/or a file with one id per line."""
+    user_ids = list(ids)
+    if ids_file:
+        user_ids.extend(int(line) for line in ids_file if line.strip())
+    return user_ids
+
+def _report(processed, failed):
+    if failed < 0:
+        raise click.ClickException('Database connection error.')
+    click.echo(f'{processed} users updated, {failed} failed chunk(s).')
+
+@admin_bp.cli.command('change-role')
+@click.argument('role_id', type=int)
+@click.argument('ids', nargs=-1, type=int)
+@click.option('--ids-file', type=click.File('r'), help='File with one user_id per line.')
+@click.option('--actor-id', type=int, help='Admin user_id recorded in the audit log.')
+@click.option('--chunk-size', default=1000, show_default=True)
+def change_role_command(role_id, ids, ids_file, actor_id, chunk_size):
+    """Assign ROLE_ID to many users."""
+    found = role_exists(role_id)
+    if found is None:
+        raise click.ClickException('Database connection error.')
+    if not found:
+        raise click.BadParameter(f'no role with id {role_id}', param_hint='ROLE_ID')
+    _report(*bulk_change_role(_read_user_ids(ids, ids_file), role_id, actor_id, chunk_size))
+
+@admin_bp.cli.command('deactivate-users')
+@click.argument('ids', nargs=-1, type=int)
+@click.option('--ids-file', type=click.File('r'), help='File with one user_id per line.')
+@click.option('--actor-id', type=int, help='Admin user_id recorded in the audit log.')
+@click.option('--chunk-size', default=1000, show_default=True)
+@click.option('--reactivate', is_flag=True, help='Reactivate instead of deactivating.')
+def deactivate_users_command(ids, ids_file, actor_id, chunk_size, reactivate):
+    """Deactivate (or reactivate) many users."""
+    _report(*bulk_set_active(_read_user_ids(ids, ids_file), reactivate, actor_id, chunk_size))
+
+@admin_bp.cli.command('delete-users')
+@click.argument('ids', nargs=-1, type=int)
+@click.option('--ids-file', type=click.File('r'), help='File with one user_id per line.')
+@click.option('--actor-id', type=int, help='Admin user_id recorded in the audit log.')
+@click.option('--chunk-size', default=1000, show_default=True)
+@click.option('--mode', type=click.Choice(['anonymize', 'cascade']), default='anonymize', show_default=True,
+              help='Keep audit rows with user_id NULL, or delete them.')
+def delete_users_command(ids, ids_file, actor_id, chunk_size, mode):
+    """Deactivate many users and queue them for deletion."""
+    _report(*bulk_delete_users(_read_user_ids(ids, ids_file), actor_id, mode, chunk_size))
+
+@admin_bp.route('/admin/stats/trends')
+@login_required
+@admin_required
+def admin_trends():
+    """Login/registration trend data for charts, served from rollup rows."""
+    resolution = request.args.get('resolution', 'hour')
+    if resolution not in RESOLUTIONS:
+        return jsonify({'error': 'Unknown resolution'}), 400
+    points = max(1, min(request.args.get('points', 48, type=int), 500))
+    trend = get_trend(resolution, points)
+    if trend is None:
+        return jsonify({'error': 'Database unavailable'}), 503
+    return jsonify({'resolution': resolution, 'buckets': trend})
+
+@admin_bp.cli.command('compact-rollups')
+def compact_rollups_command():
+    """Drop minute and hour rollups past their retention."""
+    click.echo(f'{compact_rollups()} rollup rows pruned.')
+
+@admin_bp.cli.command('backfill-audit-events')
+@click.option('--batch-size', default=5000, show_default=True)
+def backfill_audit_events_command(batch_size):
+    """Convert legacy free-text audit rows to structured events."""
+    converted = backfill_audit_events(batch_size)
+    if converted < 0:
+        raise click.ClickException('Backfill failed.')
+    click.echo(f'{converted} audit rows converted.')
+
+@admin_bp.cli.command('relay-outbox')
+@click.option('--follow', is_flag=True, help='Keep polling for new events.')
+def relay_outbox_command(follow):
+    """Drain the audit outbox into segment files."""
+    try:
+        relayed = run_relay(follow=follow)
+    except RelayLockedError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'{relayed} events relayed.')
+
+@admin_bp.cli.command('tail-audit')
+@click.option('--offset', type=int, help='Byte offset to start from (printed with each event).')
+@click.option('--from-id', type=int, help='Start at the first event with this outbox id.')
+@click.option('--follow', is_flag=True, help='Wait for new events.')
+@click.option('--shard', default=0, show_default=True, help='Shard whose feed to read (with DB_SHARDS set).')
+def tail_audit_command(offset, from_id, follow, shard):
+    """Print audit events from the segment files as JSON lines."""
+    if not 0 <= shard < shard_count():
+        raise click.BadParameter(f'there are {shard_count()} shard(s)', param_hint='--shard')
+    reader = SegmentReader(outbox_dir(shard))
+    if offset is None:
+        offset = reader.offset_for_id(from_id) if from_id is not None else 0
+    for record in reader.tail(offset, Config.OUTBOX_POLL_INTERVAL, follow=follow):
+        if from_id is None or record['id'] >= from_id:
+            click.echo(encode_body(record))
+
+@admin_bp.cli.command('rebalance-shards')
+@click.option('--batch-size', default=500, show_default=True)
+@click.option('--dry-run', is_flag=True, help='Only count users on the wrong shard.')
+def rebalance_shards_command(batch_size, dry_run):
+    """Move sessions and audit logs to the shard their user hashes to."""
+    try:
+        users, rows = rebalance(batch_size=batch_size, dry_run=dry_run)
     except Exception as e:
-        flash(f'Error: {str(e)}', 'danger')
-        conn.close()
-        return redirect(url_for('admin.admin_users'))
+        raise click.ClickException(f'Rebalance failed: {e}')
+    if dry_run:
+        click.echo(f'{users} users to move.')
+    else:
+        click.echo(f'{users} users moved ({rows} rows copied).')
+
+@admin_bp.cli.command('process-deletions')
+@click.option('--follow', is_flag=True, help='Keep polling for new deletions.')
+@click.option('--retry-failed', is_flag=True, help='First reset jobs that used up DELETION_MAX_ATTEMPTS.')
+def process_deletions_command(follow, retry_failed):
+    """Run queued account deletions."""
+    if retry_failed:
+        reset = retry_failed_deletions()
+        if reset is None:
+            raise click.ClickException('Database unavailable.')
+        click.echo(f'{reset} failed deletions queued for retry.')
+    completed = 0
+    while True:
+        count = process_deletions()
+        if count < 0:
+            raise click.ClickException('Database unavailable.')
+        completed += count
+        if count:
+            continue
+        if not follow:
+            break
+        time.sleep(Config.DELETION_POLL_INTERVAL)
+    click.echo(f'{completed} accounts deleted, {pending_deletions() or 0} still queued '
+               f'({failed_deletions() or 0} failed {Config.DELETION_MAX_ATTEMPTS} times).')
+
+@admin_bp.cli.command('gc-uploads')
+@click.option('--min-age', type=int, help='Only remove files older than this many seconds.')
+@click.option('--dry-run', is_flag=True, help='Only report what would be removed.')
+def gc_uploads_command(min_age, dry_run):
+    """Remove uploads that no user's profile picture refers to."""
+    result = collect_orphaned_uploads(min_age=min_age, dry_run=dry_run)
+    if result is None:
+        raise click.ClickException('Upload GC failed.')
+    removed, freed = result
+    verb = 'would be removed' if dry_run else 'removed'
+    click.echo(f'{removed} orphaned uploads {verb} ({freed} bytes).')
+
+@admin_bp.cli.command('build-breach-corpus')
+@click.argument('dump', type=click.File('rb'))
+@click.argument('output', required=False)
+@click.option('--bloom-bits', default=10, show_default=True, help='Bloom filter bits per hash; 0 skips the filter.')
+@click.option('--run-size', default=2000000, show_default=True, help='Hashes sorted in memory at a time (about 65 bytes each).')
+def build_breach_corpus_command(dump, output, bloom_bits, run_size):
+    """Convert a SHA-1 text dump ('-' for stdin) into the breached-password corpus."""
+    output = output or Config.BREACHED_PASSWORDS_FILE
+    if not output:
+        raise click.BadParameter('set BREACHED_PASSWORDS_FILE or pass OUTPUT', param_hint='output')
+    try:
+        count = build_corpus(dump, output, run_size=run_size)
+        click.echo(f'{count} hashes written to {output}.')
+        if bloom_bits > 0:
+            click.echo(f'Bloom filter written ({build_bloom(output, bloom_bits)} bytes).')
+    except (OSError, ValueError) as e:
+        raise click.ClickException(f'Build failed: {e}')
+
+@admin_bp.cli.command('backfill-stats')
+@click.option('--batch-size', default=1000, show_default=True, help='Users rebuilt per transaction.')
+def backfill_stats_command(batch_size):
+    """Rebuild UserStats from Sessions and AuditLogs."""
+    if not backfill_user_stats(batch_size):
+        raise click.ClickException('Backfill failed.')
+    click.echo('UserStats backfilled.')
 
 @admin_bp.route('/admin/logs')
 @login_required
 @admin_required
 def admin_logs():
-    """View system logs."""
+    """View system logs, optionally filtered by event type and target user."""
     try:
-        audit_logs = get_audit_logs(limit=100)
+        event_name = request.args.get('event_type') or None
+        event_type = {name: code for code, name in AuditEvent.NAMES.items()}.get(event_name)
+        target_id = request.args.get('target_id', type=int)
+        audit_logs = get_audit_logs(limit=100, event_type=event_type, target_id=target_id)
         sessions = get_all_sessions(limit=100)
         
-        return render_template('admin_logs.html', audit_logs=audit_logs, sessions=sessions)
+        return render_template('admin_logs.html', audit_logs=audit_logs, sessions=sessions,
+                               event_types=sorted(AuditEvent.NAMES.values()),
+                               event_name=event_name if event_type is not None else None, target_id=target_id)
     
     except Exception as e:
         flash(f'Error: {str(e)}', 'danger')
         return redirect(url_for('admin.admin_dashboard'))
 
+@admin_bp.route('/admin/logs/stream')
+@login_required
+@admin_required
+def admin_logs_stream():
+    """Stream new audit and session events as Server-Sent Events.
+    
+    Query parameters:
+      types   - comma separated event types to include (audit, session, session_end)
+      user_id - only include events for this user
+    
+    Events come from the outbox segment files, so every worker's events are
+    streamed and a reconnecting client's Last-Event-ID resumes on any worker.
+    Each event gets the acting user's username, looked up once per stream.
+    A worker serves at most LOG_STREAM_MAX_PER_WORKER streams; more get 503.
+    """
+    types = {t for t in request.args.get('types', '').split(',') if t} or None
+    user_id = request.args.get('user_id', type=int)
+    
+    if not stream_slots.acquire(blocking=False):
+        return Response('Too many live log streams on this worker\n', status=503,
+                        headers={'Retry-After': '30'}, mimetype='text/plain')
+    try:
+        feed = LiveFeed(request.headers.get('Last-Event-ID'))
+    except Exception:
+        stream_slots.release()
+        raise
+    usernames = {}
+    
+    def generate():
+        # Tell the browser how long to wait before reconnecting
+        yield 'retry: 3000\n\n'
+        idle = 0
+        while True:
+            events = feed.read()
+            if not events:
+                time.sleep(Config.OUTBOX_POLL_INTERVAL)
+                idle += Config.OUTBOX_POLL_INTERVAL
+                if idle >= 15:
+                    # Keep-alive comment so proxies do not close the connection
+                    idle = 0
+                    yield ': ping\n\n'
+                continue
+            idle = 0
+            events = [(event_id, event) for event_id, event in events if matches_filter(event, types, user_id)]
+            missing = {event['data'].get('user_id') for _, event in events} - usernames.keys() - {None}
+            if missing:
+                rows = attach_usernames([{'user_id': uid} for uid in missing])
+                usernames.update((row['user_id'], row['username']) for row in rows if row['username'])
+            for event_id, event in events:
+                data = dict(event['data'], username=usernames.get(event['data'].get('user_id')))
+                yield f"id: {event_id}\nevent: {event['type']}\ndata: {json.dumps(data)}\n\n"
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(stream_slots.release)
+    return response
@@ -0,0 +1,113 @@
+from flask import Blueprint, request, jsonify, session as flask_session
+from flask_login import login_required, current_user
+from config import Config
+from utils.db import get_db_connection
+from models.audit_log import AuditEvent
+from utils.logging import log_event
+from utils.security import verify_password
+from utils.tokens import issue_token, revoke_token, get_token_owner, auth_failures
+from utils.stats import get_user_stats
+
+api_bp = Blueprint('api', __name__, url_prefix='/api')
+
+def _current_role():
+    return getattr(current_user, 'role_name', None) or flask_session.get('role')
+
+@api_bp.route('/tokens', methods=['POST'])
+def create_token():
+    """Issue an API token.
+    
+    Accepts a logged-in browser session, or username/password in a JSON or
+    form body for programmatic clients. Optional: expires_in (seconds), label.
+    """
+    data = request.get_json(silent=True) or request.form
+    try:
+        ttl = int(data.get('expires_in') or Config.API_TOKEN_TTL)
+    except (TypeError, ValueError):
+        ttl = 0
+    if ttl <= 0:
+        return jsonify({'error': 'expires_in must be a positive number of seconds'}), 400
+    ttl = min(ttl, Config.API_TOKEN_MAX_TTL)
+    label = (data.get('label') or '')[:100] or None
+    
+    if current_user.is_authenticated:
+        user_id, role = current_user.user_id, _current_role() or 'User'
+    else:
+        ip_address = request.remote_addr
+        if auth_failures.blocked(ip_address):
+            return jsonify({'error': 'Too many failed attempts; try again later'}), 429
+        conn = get_db_connection()
+        if conn is None:
+            return jsonify({'error': 'Database unavailable'}), 503
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT u.user_id, u.hashed_password, u.is_active, r.role_name 
+                    FROM Users u 
+                    LEFT JOIN Roles r ON u.role_id = r.role_id 
+                    WHERE u.username = %s
+                """, (data.get('username'),))
+                user_data = cursor.fetchone()
+        finally:
+            conn.close()
+        
+        if not user_data or not user_data['is_active'] or \
+                not verify_password(user_data['hashed_password'], data.get('password') or ''):
+            auth_failures.hit(ip_address)
+            if user_data:
+                # Counted in UserStats.failed_login_count like a failed form login
+                log_event(user_data['user_id'], AuditEvent.LOGIN_FAILED)
+            else:
+                log_event(None, AuditEvent.API_AUTH_FAILED, payload={'reason': 'unknown user', 'ip': ip_address})
+            return jsonify({'error': 'Invalid credentials'}), 401
+        user_id, role = user_data['user_id'], user_data.get('role_name') or 'User'
+    
+    issued = issue_token(user_id, role, ttl=ttl, label=label)
+    if issued is None:
+        return jsonify({'error': 'Could not issue token'}), 503
+    token_id, token, expires_at = issued
+    
+    log_event(user_id, AuditEvent.API_TOKEN_ISSUED, payload={'token_id': token_id})
+    return jsonify({
+        'token_id': token_id,
+        'token': token,
+        'token_type': 'Bearer',
+        'expires_at': expires_at.isoformat()
+    }), 201
+
+@api_bp.route('/tokens/<int:token_id>', methods=['DELETE'])
+@login_required
+def delete_token(token_id):
+    """Revoke a token. Owners can revoke their own tokens; admins any token."""
+    owner_id = get_token_owner(token_id)
+    if owner_id is None:
+        return jsonify({'error': 'Token not found'}), 404
+    if owner_id != current_user.user_id and _current_role() != 'Admin':
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    if not revoke_token(token_id):
+        return jsonify({'error': 'Could not revoke token'}), 503
+    
+    log_event(current_user.user_id, AuditEvent.API_TOKEN_REVOKED, target_id=owner_id, payload={'token_id': token_id})
+    return jsonify({'token_id': token_id, 'revoked': True})
+
+@api_bp.route('/me')
+@login_required
+def me():
+    """Return the caller's identity (no database access for token clients)."""
+    return jsonify({
+        'user_id': current_user.user_id,
+        'role': _current_role(),
+        'token_id': getattr(current_user, 'token_id', None)
+    })
+
+@api_bp.route('/users/<int:user_id>/stats')
+@login_required
+def user_stats(user_id):
+    """Activity summary for a user (self or admin)."""
+    if user_id != current_user.user_id and _current_role() != 'Admin':
+        return jsonify({'error': 'Forbidden'}), 403
+    stats = get_user_stats(user_id)
+    if stats is None:
+        return jsonify({'error': 'No activity recorded'}), 404
+    return jsonify(stats)
@@ -0,0 +1,194 @@
+"""Async versions of the read-heavy views, used when ASYNC_MODE is enabled.
+
+Each view issues its independent queries concurrently over the async pool
+(utils.async_db), which shortens the view's latency; the request still
+holds its worker thread throughout, as with any Flask view. If the pool is
+unavailable the synchronous view is used instead, so degraded mode keeps
+working.
+"""
+import asyncio
+from flask import render_template, redirect, url_for, flash, request, session as flask_session, current_app
+from flask_login import login_required, login_user, current_user
+from models.user import User
+from routes import admin, auth, dashboard
+from routes.admin import admin_required
+from utils.async_db import async_db, fetchone, fetchall, DatabaseUnavailable
+from utils.anomaly import login_monitor, set_risk_flag, SUSPICIOUS_THRESHOLD
+from utils.db import dashboard_cache, session_cache
+from models.audit_log import AuditEvent
+from utils.logging import log_event, describe_rows
+from utils.security import verify_password
+from utils.sessions import create_session
+from utils.shards import is_sharded
+
+USER_WITH_ROLE_SQL = """
+    SELECT u.*, r.role_name 
+    FROM Users u 
+    LEFT JOIN Roles r ON u.role_id = r.role_id 
+    WHERE u.{column} = %s
+"""
+
+@login_required
+async def dashboard_view():
+    """User dashboard page."""
+    user_id = current_user.user_id
+    if flask_session.get('role') == 'Admin':
+        logs_query = fetchall("""SELECT al.*, u.username 
+                                 FROM AuditLogs al 
+                                 LEFT JOIN Users u ON al.user_id = u.user_id 
+                                 ORDER BY al.action_time DESC 
+                                 LIMIT 20""")
+    else:
+        logs_query = fetchall("""SELECT * FROM AuditLogs 
+                                 WHERE user_id = %s 
+                                 ORDER BY action_time DESC 
+                                 LIMIT 20""", (user_id,))
+    try:
+        async with async_db.admitted():
+            user_data, sessions, audit_logs = await asyncio.gather(
+                fetchone(dashboard.DASHBOARD_USER_SQL, (user_id,)),
+                fetchall("""SELECT * FROM Sessions 
+                            WHERE user_id = %s 
+                            ORDER BY login_time DESC 
+                            LIMIT 10""", (user_id,)),
+                logs_query
+            )
+    except DatabaseUnavailable:
+        logs_query.close()
+        return dashboard.dashboard()
+    
+    if user_data:
+        dashboard_cache.set(user_id, user_data)
+    session_cache.set(user_id, sessions)
+    return render_template('dashboard.html', user=user_data, sessions=sessions, audit_logs=describe_rows(audit_logs))
+
+@login_required
+@admin_required
+async def admin_dashboard_view():
+    """Admin dashboard page."""
+    try:
+        async with async_db.admitted():
+            counts = await asyncio.gather(*[
+                fetchone(f"SELECT COUNT(*) as count FROM {table}")
+                for table in ('Users', 'Roles', 'Sessions', 'AuditLogs')
+            ])
+    except DatabaseUnavailable:
+        return admin.admin_dashboard()
+    
+    stats = {
+        'total_users': counts[0]['count'],
+        'total_roles': counts[1]['count'],
+        'total_sessions': counts[2]['count'],
+        'total_logs': counts[3]['count']
+    }
+    return render_template('admin_dashboard.html', stats=stats)
+
+@login_required
+@admin_required
+async def admin_logs_view():
+    """View system logs."""
+    if request.args.get('event_type') or request.args.get('target_id'):
+        # Filtered views use the indexed sync query
+        return admin.admin_logs()
+    try:
+        async with async_db.admitted():
+            audit_logs, sessions = await asyncio.gather(
+                fetchall("""SELECT al.*, u.username 
+                            FROM AuditLogs al 
+                            LEFT JOIN Users u ON al.user_id = u.user_id 
+                            ORDER BY al.action_time DESC 
+                            LIMIT 100"""),
+                fetchall("""SELECT s.*, u.username 
+                            FROM Sessions s
+                            LEFT JOIN Users u ON s.user_id = u.user_id 
+                            ORDER BY s.login_time DESC 
+                            LIMIT 100""")
+            )
+    except DatabaseUnavailable:
+        return admin.admin_logs()
+    return render_template('admin_logs.html', audit_logs=describe_rows(audit_logs), sessions=sessions,
+                           event_types=sorted(AuditEvent.NAMES.values()), event_name=None, target_id=None)
+
+async def login_view():
+    """Handle user login; session and audit writes run concurrently."""
+    if request.method != 'POST':
+        return render_template('login.html')
+    
+    username = request.form.get('username')
+    password = request.form.get('password')
+    if not username or not password:
+        flash('Please enter both username and password.', 'danger')
+        return render_template('login.html')
+    
+    try:
+        user_data = await fetchone(USER_WITH_ROLE_SQL.format(column='username'), (username,))
+    except DatabaseUnavailable:
+        return auth.login()
+    
+    # Password hashing is CPU bound; keep it off the event loop
+    if not user_data or not await asyncio.to_thread(verify_password, user_data['hashed_password'], password):
+        if user_data:
+            await asyncio.to_thread(log_event, user_data['user_id'], AuditEvent.LOGIN_FAILED)
+        flash('Invalid username or password.', 'danger')
+        return render_template('login.html')
+    
+    # Checked after the password so the message does not reveal which usernames exist
+    if not user_data.get('is_active', True):
+        flash('This account has been deactivated.', 'danger')
+        return render_template('login.html')
+    
+    user = User(
+        user_id=user_data['user_id'],
+        username=user_data['username'],
+        email=user_data['email'],
+        password=user_data['hashed_password'],
+        full_name=user_data.get('full_name'),
+        profile_pic=user_data.get('profile_pic'),
+        role_id=user_data.get('role_id'),
+        created_at=user_data.get('created_at'),
+        updated_at=user_data.get('updated_at'),
+        active=user_data.get('is_active', True)
+    )
+    flask_session['role'] = user_data.get('role_name', 'User')
+    login_user(user, remember=True)
+    
+    ip_address = request.remote_addr
+    user_agent = request.headers.get('User-Agent', '')
+    # Scored against recent logins before this one's session row exists
+    score, reasons = await asyncio.to_thread(login_monitor.check_login, user_data['user_id'], ip_address, user_agent)
+    # The sync helpers keep spooling, breaker and outbox behaviour
+    session_id, _ = await asyncio.gather(
+        asyncio.to_thread(create_session, user_data['user_id'], ip_address, user_agent),
+        asyncio.to_thread(log_event, user_data['user_id'], AuditEvent.LOGIN)
+    )
+    flask_session['db_session_id'] = session_id
+    
+    if score >= SUSPICIOUS_THRESHOLD:
+        await asyncio.gather(
+            asyncio.to_thread(log_event, user_data['user_id'], AuditEvent.SUSPICIOUS_LOGIN,
+                              payload={'reasons': ', '.join(reasons), 'ip': ip_address}),
+            asyncio.to_thread(set_risk_flag, user_data['user_id'], True)
+        )
+    
+    flash('Login successful!', 'success')
+    if user_data.get('role_name') == 'Admin':
+        return redirect(url_for('admin.admin_dashboard'))
+    return redirect(url_for('dashboard.dashboard'))
+
+ASYNC_VIEWS = {
+    'auth.login': login_view,
+    'dashboard.dashboard': dashboard_view,
+    'admin.admin_dashboard': admin_dashboard_view,
+    'admin.admin_logs': admin_logs_view
+}
+
+# These read Sessions and AuditLogs through the main-database pool
+MAIN_DB_ONLY_VIEWS = ('dashboard.dashboard', 'admin.admin_dashboard', 'admin.admin_logs')
+
+def register_async_views(app):
+    """Swap the async views in for their sync endpoints."""
+    for endpoint, view in ASYNC_VIEWS.items():
+        if is_sharded() and endpoint in MAIN_DB_ONLY_VIEWS:
+            # The sync views already query the shards in parallel
+            continue
+        app.view_functions[endpoint] = view
@@ -2,30 +2,20 @@ from flask import Blueprint, render_template, request, redirect, url_for, flash,
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.utils import secure_filename
 import os
-import pymysql
 from models.user import User
 from config import Config
 from utils.security import hash_password, verify_password, validate_password_strength
 from utils.sessions import create_session
-from utils.logging import create_audit_log
+from utils.deletions import request_deletion
+from models.audit_log import AuditEvent
+from utils.logging import log_event
+from utils.rollups import record_metric
+from utils.db import get_db_connection, unavailable_message, invalidate_users
+from utils.search import user_index
+from utils.anomaly import login_monitor, set_risk_flag, SUSPICIOUS_THRESHOLD
 
 auth_bp = Blueprint('auth', __name__)
 
-def get_db_connection():
-    """Create and return a database connection."""
-    try:
-        connection = pymysql.connect(
-            host=Config.MYSQL_HOST,
-            user=Config.MYSQL_USER,
-            password=Config.MYSQL_PASSWORD,
-            database=Config.MYSQL_DB,
-            cursorclass=pymysql.cursors.DictCursor
-        )
-        return connection
-    except Exception as e:
-        print(f"Database connection error: {e}")
-        return None
-
 def allowed_file(filename):
     """Check if file extension is allowed."""
     return '.' in filename and \
@@ -52,7 +42,7 @@ def register():
         # Check if username or email already exists
         conn = get_db_connection()
         if conn is None:
-            flash('Database connection error. Please try again.', 'danger')
+            flash(unavailable_message(), 'danger')
             return render_template('register.html')
         
         try:
@@ -85,9 +75,11 @@ def register():
                 
                 # Get the new user's ID
                 user_id = cursor.lastrowid
+                user_index.add(user_id, username, email, full_name)
+                record_metric('registrations', user_id)
                 
                 # Create audit log
-                create_audit_log(user_id, 'User registered')
+                log_event(user_id, AuditEvent.USER_REGISTERED)
                 
                 flash('Registration successful! Please login.', 'success')
                 conn.close()
@@ -113,7 +105,7 @@ def login():
         
         conn = get_db_connection()
         if conn is None:
-            flash('Database connection error. Please try again.', 'danger')
+            flash(unavailable_message(), 'danger')
             return render_template('login.html')
         
         try:
@@ -128,6 +120,13 @@ def login():
                 user_data = cursor.fetchone()
                 
                 if user_data and verify_password(user_data['hashed_password'], password):
+                    # Checked after the password so the message does not reveal
+                    # which usernames exist
+                    if not user_data.get('is_active', True):
+                        flash('This account has been deactivated.', 'danger')
+                        conn.close()
+                        return render_template('login.html')
+                    
                     # Create User object
                     user = User(
                         user_id=user_data['user_id'],
@@ -150,11 +149,18 @@ def login():
                     # Create session record
                     ip_address = request.remote_addr
                     user_agent = request.headers.get('User-Agent', '')
+                    # Compare against recent logins, before this one's session row exists
+                    score, reasons = login_monitor.check_login(user_data['user_id'], ip_address, user_agent)
                     session_id = create_session(user_data['user_id'], ip_address, user_agent)
                     flask_session['db_session_id'] = session_id
                     
                     # Create audit log
-                    create_audit_log(user_data['user_id'], 'User logged in')
+                    log_event(user_data['user_id'], AuditEvent.LOGIN)
+                    
+                    if score >= SUSPICIOUS_THRESHOLD:
+                        log_event(user_data['user_id'], AuditEvent.SUSPICIOUS_LOGIN,
+                                  payload={'reasons': ', '.join(reasons), 'ip': ip_address})
+                        set_risk_flag(user_data['user_id'], True)
                     
                     conn.close()
                     flash('Login successful!', 'success')
@@ -165,6 +171,9 @@ def login():
                     else:
                         return redirect(url_for('dashboard.dashboard'))
                 else:
+                    if user_data:
+                        # Counted in UserStats.failed_login_count
+                        log_event(user_data['user_id'], AuditEvent.LOGIN_FAILED)
                     flash('Invalid username or password.', 'danger')
                     conn.close()
                     return render_template('login.html')
@@ -186,10 +195,10 @@ def logout():
     session_id = flask_session.get('db_session_id')
     if session_id:
         from utils.sessions import end_session
-        end_session(session_id)
+        end_session(session_id, user_id)
     
     # Create audit log
-    create_audit_log(user_id, 'User logged out')
+    log_event(user_id, AuditEvent.LOGOUT)
     
     logout_user()
     flask_session.clear()
@@ -232,8 +241,10 @@ def profile():
                             (full_name, filename, current_user.user_id)
                         )
                         conn.commit()
+                    invalidate_users([current_user.user_id])
+                    user_index.update(current_user.user_id, full_name=full_name)
                     
-                    create_audit_log(current_user.user_id, 'Profile updated')
+                    log_event(current_user.user_id, AuditEvent.PROFILE_UPDATED)
                     flash('Profile updated successfully!', 'success')
                     conn.close()
                     return redirect(url_for('auth.profile'))
@@ -245,8 +256,10 @@ def profile():
                     (full_name, current_user.user_id)
                 )
                 conn.commit()
+            invalidate_users([current_user.user_id])
+            user_index.update(current_user.user_id, full_name=full_name)
             
-            create_audit_log(current_user.user_id, 'Profile updated')
+            log_event(current_user.user_id, AuditEvent.PROFILE_UPDATED)
             flash('Profile updated successfully!', 'success')
             conn.close()
             return redirect(url_for('auth.profile'))
@@ -277,32 +290,19 @@ def uploaded_file(filename):
 @auth_bp.route('/delete_account', methods=['POST'])
 @login_required
 def delete_account():
-    """Delete user account."""
-    conn = get_db_connection()
-    if conn is None:
-        flash('Database connection error.', 'danger')
-        return redirect(url_for('dashboard.dashboard'))
-    
-    try:
-        user_id = current_user.user_id
-        
-        with conn.cursor() as cursor:
-            # Delete user
-            cursor.execute("DELETE FROM Users WHERE user_id = %s", (user_id,))
-            conn.commit()
-        
-        # Create audit log before logging out
-        create_audit_log(user_id, 'Account deleted')
-        
-        conn.close()
-        
-        logout_user()
-        flask_session.clear()
-        flash('Your account has been deleted.', 'info')
-        return redirect(url_for('auth.login'))
+    """Delete user account.
     
-    except Exception as e:
-        flash(f'Error deleting account: {str(e)}', 'danger')
-        conn.close()
+    The account is deactivated and queued here; sessions, audit history and
+    uploads are removed by the background deletion worker.
+    """
+    user_id = current_user.user_id
+    # Also records the ACCOUNT_DELETED event
+    if not request_deletion(user_id, requested_by=user_id):
+        flash(unavailable_message(), 'danger')
         return redirect(url_for('dashboard.dashboard'))
+    
+    logout_user()
+    flask_session.clear()
+    flash('Your account has been deleted.', 'info')
+    return redirect(url_for('auth.login'))
 
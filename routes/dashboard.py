@@ -1,77 +1,66 @@
-from flask import Blueprint, render_template, redirect, url_for
+from flask import Blueprint, render_template, redirect, url_for, flash
 from flask_login import login_required, current_user
-import pymysql
 from config import Config
 from utils.sessions import get_user_sessions
-from utils.logging import get_audit_logs
+from utils.logging import get_audit_logs, get_user_audit_logs
+from utils.db import get_db_connection, report_error, dashboard_cache, DatabaseUnavailable, CACHED_USER_COLUMNS
 
 dashboard_bp = Blueprint('dashboard', __name__)
 
-def get_db_connection():
-    """Create and return a database connection."""
+# User row with role and activity summary (UserStats is kept current on write)
+DASHBOARD_USER_SQL = f"""
+    SELECT {CACHED_USER_COLUMNS}, r.role_name, 
+           st.login_count, st.failed_login_count, st.last_login_at, 
+           st.last_logout_at, st.last_failed_login_at, st.last_ip 
+    FROM Users u 
+    LEFT JOIN Roles r ON u.role_id = r.role_id 
+    LEFT JOIN UserStats st ON st.user_id = u.user_id 
+    WHERE u.user_id = %s
+"""
+
+def _query_dashboard_user(user_id):
+    conn = get_db_connection()
+    if conn is None:
+        raise DatabaseUnavailable('database unavailable')
     try:
-        connection = pymysql.connect(
-            host=Config.MYSQL_HOST,
-            user=Config.MYSQL_USER,
-            password=Config.MYSQL_PASSWORD,
-            database=Config.MYSQL_DB,
-            cursorclass=pymysql.cursors.DictCursor
-        )
-        return connection
-    except Exception as e:
-        print(f"Database connection error: {e}")
-        return None
+        with conn.cursor() as cursor:
+            cursor.execute(DASHBOARD_USER_SQL, (user_id,))
+            return cursor.fetchone()
+    finally:
+        conn.close()
 
 @dashboard_bp.route('/dashboard')
 @login_required
 def dashboard():
     """User dashboard page."""
-    conn = get_db_connection()
-    if conn is None:
-        return redirect(url_for('auth.login'))
-    
+    user_id = current_user.user_id
     try:
-        # Get user information
-        with conn.cursor() as cursor:
-            cursor.execute("""
-                SELECT u.*, r.role_name 
-                FROM Users u 
-                LEFT JOIN Roles r ON u.role_id = r.role_id 
-                WHERE u.user_id = %s
-            """, (current_user.user_id,))
-            user_data = cursor.fetchone()
-        
-        conn.close()
-        
-        # Get user sessions
-        sessions = get_user_sessions(current_user.user_id, limit=10)
-        
-        # Get user's audit logs
-        audit_logs = []
-        if user_data and user_data.get('role_name') == 'Admin':
-            # Admins can see all logs
-            audit_logs = get_audit_logs(limit=20)
-        else:
-            # Regular users see only their logs
-            try:
-                conn = get_db_connection()
-                with conn.cursor() as cursor:
-                    cursor.execute("""
-                        SELECT * FROM AuditLogs 
-                        WHERE user_id = %s 
-                        ORDER BY action_time DESC 
-                        LIMIT 20
-                    """, (current_user.user_id,))
-                    audit_logs = cursor.fetchall()
-                conn.close()
-            except:
-                pass
-        
-        return render_template('dashboard.html', user=user_data, sessions=sessions, audit_logs=audit_logs)
-    
+        # Get user information (cached briefly; invalidated on profile, role and login changes)
+        user_data = dashboard_cache.get_or_load(user_id, lambda: _query_dashboard_user(user_id))
+    except DatabaseUnavailable:
+        # Degraded mode: render from the last known user and session data
+        user_data = dashboard_cache.get_stale(user_id)
+        if user_data is None:
+            return redirect(url_for('auth.login'))
+        flash('The database is currently unavailable. Showing cached data in read-only mode.', 'warning')
+        sessions = get_user_sessions(user_id, limit=10)
+        return render_template('dashboard.html', user=user_data, sessions=sessions, audit_logs=[])
     except Exception as e:
-        conn.close()
+        report_error(e)
         return redirect(url_for('auth.login'))
+    
+    # Get user sessions
+    sessions = get_user_sessions(user_id, limit=10)
+    
+    # Get user's audit logs
+    if user_data and user_data.get('role_name') == 'Admin':
+        # Admins can see all logs
+        audit_logs = get_audit_logs(limit=20)
+    else:
+        # Regular users see only their logs
+        audit_logs = get_user_audit_logs(user_id, limit=20)
+    
+    return render_template('dashboard.html', user=user_data, sessions=sessions, audit_logs=audit_logs)
 
 @dashboard_bp.route('/')
 def index():
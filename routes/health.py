@@ -0,0 +1,44 @@
+from flask import Blueprint, jsonify
+import os
+from config import Config
+from utils.db import db_status, is_degraded
+from utils.shards import shard_status
+from utils.cache import cache_stats
+
+health_bp = Blueprint('health', __name__)
+
+def is_draining():
+    """True once an operator has asked this instance to drain (see DRAIN_FILE)."""
+    return os.path.exists(Config.DRAIN_FILE)
+
+@health_bp.route('/healthz')
+def healthz():
+    """Liveness: the worker is up and serving requests."""
+    return jsonify({'status': 'ok', 'pid': os.getpid()})
+
+@health_bp.route('/readyz')
+def readyz():
+    """Readiness: accept traffic unless draining.
+    
+    An open database breaker does not fail readiness; the instance keeps
+    serving logged-in users in degraded mode and pulling every instance out
+    of rotation would turn a database incident into a full outage.
+    """
+    draining = is_draining()
+    body = {
+        'status': 'draining' if draining else 'ready',
+        'database_degraded': is_degraded()
+    }
+    return jsonify(body), (503 if draining else 200)
+
+@health_bp.route('/status/db')
+def db_status_view():
+    """Expose circuit breaker state (main database and each shard) for monitoring."""
+    status = db_status()
+    status['shards'] = shard_status()
+    return jsonify(status)
+
+@health_bp.route('/status/cache')
+def cache_status_view():
+    """Per-namespace cache hit rates for this worker."""
+    return jsonify({'pid': os.getpid(), 'namespaces': cache_stats()})
@@ -115,3 +115,194 @@ function hideLoading(element, originalText) {
     }
 }
 
+
+// Live tail for the admin logs page (Server-Sent Events)
+document.addEventListener('DOMContentLoaded', function() {
+    const container = document.querySelector('[data-live-stream]');
+    if (!container || !window.EventSource) {
+        return;
+    }
+    
+    const status = document.getElementById('liveStatus');
+    const auditRows = document.getElementById('auditLogRows');
+    const sessionRows = document.getElementById('sessionRows');
+    const maxRows = 100;
+    const source = new EventSource(container.dataset.liveStream);
+    
+    function cell(text) {
+        const td = document.createElement('td');
+        td.textContent = (text === null || text === undefined || text === '') ? '-' : text;
+        return td;
+    }
+    
+    function formatTime(value) {
+        return value ? value.replace('T', ' ').split('.')[0] : '-';
+    }
+    
+    function prepend(tbody, row) {
+        tbody.insertBefore(row, tbody.firstChild);
+        while (tbody.rows.length > maxRows) {
+            tbody.deleteRow(tbody.rows.length - 1);
+        }
+    }
+    
+    source.onopen = function() {
+        status.textContent = 'Live';
+        status.className = 'badge bg-success';
+    };
+    
+    source.onerror = function() {
+        if (source.readyState === EventSource.CLOSED) {
+            // Refused (e.g. too many streams on the server); the browser does not retry
+            status.textContent = 'Live: unavailable, reload to retry';
+            status.className = 'badge bg-secondary';
+            return;
+        }
+        status.textContent = 'Live: reconnecting...';
+        status.className = 'badge bg-warning text-dark';
+    };
+    
+    source.addEventListener('audit', function(e) {
+        const data = JSON.parse(e.data);
+        const row = document.createElement('tr');
+        row.appendChild(cell(data.log_id));
+        row.appendChild(cell(data.user_id));
+        row.appendChild(cell(data.username));
+        const action = document.createElement('td');
+        const code = document.createElement('code');
+        code.textContent = data.action;
+        action.appendChild(code);
+        row.appendChild(action);
+        row.appendChild(cell(formatTime(data.action_time)));
+        prepend(auditRows, row);
+    });
+    
+    source.addEventListener('session', function(e) {
+        const data = JSON.parse(e.data);
+        const row = document.createElement('tr');
+        row.dataset.sessionId = data.session_id;
+        row.dataset.userId = data.user_id;
+        row.appendChild(cell(data.session_id));
+        row.appendChild(cell(data.user_id));
+        row.appendChild(cell(data.username));
+        row.appendChild(cell(formatTime(data.login_time)));
+        const logout = document.createElement('td');
+        logout.innerHTML = '<span class="badge bg-success">Active</span>';
+        row.appendChild(logout);
+        row.appendChild(cell(data.ip_address));
+        prepend(sessionRows, row);
+    });
+    
+    source.addEventListener('session_end', function(e) {
+        const data = JSON.parse(e.data);
+        // Older session ids can repeat across shards; the user id tells them apart
+        const row = sessionRows.querySelector('tr[data-session-id="' + data.session_id + '"][data-user-id="' + data.user_id + '"]');
+        if (row) {
+            row.cells[4].textContent = formatTime(data.logout_time);
+        }
+    });
+});
+
+// Type-ahead user search on the admin users page
+document.addEventListener('DOMContentLoaded', function() {
+    const input = document.getElementById('userSearch');
+    if (!input) {
+        return;
+    }
+    
+    const results = document.getElementById('userSearchResults');
+    let timer = null;
+    let controller = null;
+    
+    function render(users) {
+        results.innerHTML = '';
+        users.forEach(user => {
+            const item = document.createElement('a');
+            item.className = 'list-group-item list-group-item-action';
+            item.href = '#user-' + user.user_id;
+            item.textContent = user.username + ' <' + user.email + '>' + (user.full_name ? ' - ' + user.full_name : '');
+            item.addEventListener('click', function() {
+                results.innerHTML = '';
+                const row = document.getElementById('user-' + user.user_id);
+                if (row) {
+                    row.classList.add('table-warning');
+                }
+            });
+            results.appendChild(item);
+        });
+    }
+    
+    input.addEventListener('input', function() {
+        clearTimeout(timer);
+        const query = this.value.trim();
+        if (!query) {
+            render([]);
+            return;
+        }
+        timer = setTimeout(() => {
+            if (controller) {
+                controller.abort();
+            }
+            controller = new AbortController();
+            fetch(input.dataset.searchUrl + '?q=' + encodeURIComponent(query), {signal: controller.signal})
+                .then(response => response.json())
+                .then(data => render(data.results))
+                .catch(() => {});
+        }, 150);
+    });
+});
+
+// Select-all checkbox for admin bulk actions
+document.addEventListener('DOMContentLoaded', function() {
+    const selectAll = document.getElementById('selectAllUsers');
+    if (!selectAll) {
+        return;
+    }
+    selectAll.addEventListener('change', function() {
+        document.querySelectorAll('input[name="user_ids"]').forEach(box => {
+            box.checked = selectAll.checked;
+        });
+    });
+});
+
+// Activity trend chart on the admin dashboard (served from rollups)
+document.addEventListener('DOMContentLoaded', function() {
+    const canvas = document.getElementById('activityChart');
+    if (!canvas || !window.Chart) {
+        return;
+    }
+    
+    const select = document.getElementById('trendResolution');
+    const chart = new Chart(canvas, {
+        type: 'line',
+        data: {labels: [], datasets: [
+            {label: 'Logins', data: [], borderColor: '#0d6efd'},
+            {label: 'Failed logins', data: [], borderColor: '#dc3545'},
+            {label: 'Registrations', data: [], borderColor: '#198754'},
+            {label: 'Unique users', data: [], borderColor: '#6f42c1', borderDash: [4, 4]}
+        ]},
+        options: {animation: false, scales: {y: {beginAtZero: true}}}
+    });
+    
+    function load() {
+        const option = select.options[select.selectedIndex];
+        const url = canvas.dataset.trendsUrl + '?resolution=' + option.value + '&points=' + option.dataset.points;
+        fetch(url)
+            .then(response => response.json())
+            .then(data => {
+                if (!data.buckets) {
+                    return;
+                }
+                chart.data.labels = data.buckets.map(b => b.bucket_start.replace('T', ' ').slice(0, option.value === 'day' ? 10 : 16));
+                chart.data.datasets[0].data = data.buckets.map(b => b.logins);
+                chart.data.datasets[1].data = data.buckets.map(b => b.failures);
+                chart.data.datasets[2].data = data.buckets.map(b => b.registrations);
+                chart.data.datasets[3].data = data.buckets.map(b => b.unique_users);
+                chart.update();
+            })
+            .catch(() => {});
+    }
+    
+    select.addEventListener('change', load);
+    load();
+});
@@ -0,0 +1,63 @@
+from utils import anomaly
+from utils.anomaly import LoginMonitor, SUSPICIOUS_THRESHOLD
+
+HOME_IP = '203.0.113.10'
+AWAY_IP = '198.51.100.7'
+LAPTOP = 'Mozilla/5.0 (X11; Linux x86_64) Firefox/120.0'
+PHONE = 'Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) Safari/604.1'
+
+def _monitor():
+    monitor = LoginMonitor()
+    monitor.record(1, HOME_IP, LAPTOP)
+    return monitor
+
+def test_known_location_and_device_is_not_flagged():
+    score, reasons = _monitor().check_login(1, '203.0.113.99', LAPTOP.replace('120.0', '121.0'))
+    assert score < SUSPICIOUS_THRESHOLD
+    assert reasons == []
+
+def test_new_location_alone_is_flagged():
+    score, reasons = _monitor().check_login(1, AWAY_IP, LAPTOP)
+    assert score >= SUSPICIOUS_THRESHOLD
+    assert reasons == ['new location']
+
+def test_new_device_alone_is_flagged():
+    score, reasons = _monitor().check_login(1, HOME_IP, PHONE)
+    assert score >= SUSPICIOUS_THRESHOLD
+    assert reasons == ['new device']
+
+def test_new_location_and_device_is_flagged():
+    score, reasons = _monitor().check_login(1, AWAY_IP, PHONE)
+    assert score >= SUSPICIOUS_THRESHOLD
+    assert reasons == ['new location', 'new device']
+
+def test_user_without_history_is_not_flagged():
+    score, reasons = _monitor().check_login(2, AWAY_IP, PHONE)
+    assert score == 0
+    assert reasons == []
+
+def test_history_is_loaded_for_a_user_this_worker_has_not_seen():
+    calls = []
+    def loader(user_id, limit):
+        calls.append(user_id)
+        return [(HOME_IP, LAPTOP)]
+    monitor = LoginMonitor(loader=loader)
+    score, reasons = monitor.check_login(1, HOME_IP, LAPTOP)
+    assert (score, reasons) == (0, [])
+    monitor.check_login(1, AWAY_IP, LAPTOP)
+    assert calls == [1]
+
+def test_unloadable_history_is_not_cached():
+    monitor = LoginMonitor(loader=lambda user_id, limit: None)
+    assert monitor.check_login(1, AWAY_IP, PHONE) == (0, [])
+    assert monitor.check_login(1, HOME_IP, LAPTOP) == (0, [])
+
+def test_logins_from_other_workers_are_applied(monkeypatch):
+    sent = []
+    monkeypatch.setattr(anomaly, 'broadcast', lambda topic, items: sent.extend(items))
+    worker = LoginMonitor(topic='test_login_history')
+    worker.record(1, HOME_IP, LAPTOP)
+    worker.check_login(1, AWAY_IP, PHONE)
+    other = _monitor()
+    other.apply(sent)
+    assert other.check_login(1, AWAY_IP, PHONE) == (0, [])
@@ -0,0 +1,32 @@
+import hashlib
+import pytest
+from utils import breach
+
+def _dump(passwords):
+    return [hashlib.sha1(p.encode()).hexdigest().upper().encode() + b':1\n' for p in passwords]
+
+@pytest.mark.parametrize('vectorised', [True, False])
+def test_built_corpus_and_filter_find_every_hash(tmp_path, monkeypatch, vectorised):
+    if vectorised and breach.numpy is None:
+        pytest.skip('numpy is not installed')
+    if not vectorised:
+        monkeypatch.setattr(breach, 'numpy', None)
+    monkeypatch.setattr(breach, 'BLOOM_CHUNK', 1000)
+    passwords = [f'password{i}' for i in range(5000)]
+    path = str(tmp_path / 'breached.bin')
+    assert breach.build_corpus(_dump(passwords + passwords[:10]), path, run_size=1500) == 5000
+    breach.build_bloom(path)
+    corpus = breach.BreachCorpus(path)
+    try:
+        assert corpus._bloom is not None
+        assert all(corpus.contains(p) for p in passwords)
+        assert not any(corpus.contains(f'other{i}') for i in range(1000))
+    finally:
+        corpus.close()
+
+def test_filter_positions_match_the_double_hashing_formula():
+    digest = breach.password_digest('hunter2')
+    h1 = int.from_bytes(digest[:8], 'big')
+    h2 = int.from_bytes(digest[8:16], 'big') | 1
+    bits = 12345678901
+    assert breach._bloom_positions(digest, 7, bits) == [(h1 + i * h2) % bits for i in range(7)]
@@ -0,0 +1,23 @@
+import pymysql
+import pytest
+from utils.db import CircuitBreaker, breaker_cursor
+
+def _execute_raising(monkeypatch, error):
+    breaker = CircuitBreaker(failure_threshold=1)
+    def execute(self, query, args=None):
+        raise error
+    monkeypatch.setattr(pymysql.cursors.Cursor, 'execute', execute)
+    with pytest.raises(type(error)):
+        breaker_cursor(breaker)(None).execute('SELECT 1')
+    return breaker
+
+@pytest.mark.parametrize('errno', [2003, 2006, 2013, 2055])
+def test_lost_connection_opens_the_breaker(monkeypatch, errno):
+    breaker = _execute_raising(monkeypatch, pymysql.err.OperationalError(errno, 'gone'))
+    assert breaker.state == CircuitBreaker.OPEN
+
+@pytest.mark.parametrize('errno', [1205, 1213])
+def test_lock_errors_do_not_open_the_breaker(monkeypatch, errno):
+    breaker = _execute_raising(monkeypatch, pymysql.err.OperationalError(errno, 'lock'))
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.total_failures == 0
@@ -0,0 +1,55 @@
+import os
+import time
+from config import Config
+from utils import cache
+from utils.search import UserSearchIndex
+
+def _usernames(index, query):
+    return [doc['username'] for doc in index.search(query)]
+
+def _wait_for(check, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if check():
+            return True
+        time.sleep(0.02)
+    return check()
+
+def test_search_matches_prefix_and_inner_words():
+    index = UserSearchIndex()
+    index.add(1, 'alice', 'alice@example.com', 'Alice Liddell')
+    index.add(2, 'bob', 'bob@example.com', 'Bob Stone')
+    assert _usernames(index, 'ali') == ['alice']
+    assert _usernames(index, 'stone') == ['bob']
+    index.remove(2)
+    assert _usernames(index, 'stone') == []
+
+def test_writes_in_one_worker_reach_another(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, 'CACHE_BUS_DIR', str(tmp_path))
+    monkeypatch.setattr(Config, 'CACHE_L2_URL', '')
+    monkeypatch.setattr(cache, '_bus', None)
+    monkeypatch.setattr(cache, '_l2', None)
+    monkeypatch.setattr(cache, '_listen_pid', None)
+    monkeypatch.setattr(cache, '_handlers', {})
+    index = UserSearchIndex('test_user_index')
+    cache.on_broadcast('test_user_index', index.apply)
+    index.add(1, 'carol', 'carol@example.com', 'Carol Jones')
+    cache.init_cache_invalidations()
+    
+    pid = os.fork()
+    if pid == 0:
+        # The other worker: listens on its own socket, then writes
+        code = 1
+        try:
+            cache.init_cache_invalidations()
+            index.add(2, 'dave', 'dave@example.com', 'Dave Smith')
+            index.update(1, full_name='Carol Brown')
+            index.remove(1)
+            code = 0
+        finally:
+            os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    
+    assert _wait_for(lambda: _usernames(index, 'dave') == ['dave'])
+    assert _wait_for(lambda: _usernames(index, 'carol') == [])
@@ -0,0 +1,237 @@
+import hashlib
+import ipaddress
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from config import Config
+from utils.cache import LRUCache, broadcast, on_broadcast
+from utils.db import get_db_connection, report_error
+from utils.shards import connection_for_user
+
+# Score contributions; a login at or above the threshold is flagged, so either
+# signal alone is enough and the score shows how many fired
+NEW_LOCATION_SCORE = 50
+NEW_DEVICE_SCORE = 40
+SUSPICIOUS_THRESHOLD = min(NEW_LOCATION_SCORE, NEW_DEVICE_SCORE)
+
+# Sessions read per remembered IP prefix or device when loading a history
+HISTORY_SESSIONS_PER_ENTRY = 4
+
+_VERSION_RE = re.compile(r'[\d._]+')
+
+def _digest(value):
+    return hashlib.blake2b(value.encode('utf-8', 'replace'), digest_size=8).digest()
+
+def ip_prefix(ip_address):
+    """Collapse an address to its network (/24 for IPv4, /48 for IPv6)."""
+    try:
+        ip = ipaddress.ip_address(ip_address or '')
+    except ValueError:
+        return ip_address or ''
+    prefix = 24 if ip.version == 4 else 48
+    return str(ipaddress.ip_network(f'{ip}/{prefix}', strict=False))
+
+def device_fingerprint(user_agent):
+    """Normalize a User-Agent so browser updates do not look like a new device."""
+    return _VERSION_RE.sub('', (user_agent or '').lower())
+
+class _UserHistory:
+    __slots__ = ('ips', 'devices', 'risk_score')
+    
+    def __init__(self):
+        self.ips = OrderedDict()
+        self.devices = OrderedDict()
+        self.risk_score = 0
+
+def _remember(seen, key, maxlen):
+    seen[key] = True
+    seen.move_to_end(key)
+    while len(seen) > maxlen:
+        seen.popitem(last=False)
+
+class LoginMonitor:
+    """Compact per-user memory of recent IP prefixes and device fingerprints.
+    
+    The history itself is Sessions: with a loader, a user missing from the
+    in-process cache (or older than its ttl) is read back from there, and
+    with a topic every scored login is broadcast so other workers' cached
+    copies stay current. Either way every worker scores a login the same.
+    """
+    
+    def __init__(self, max_users=100000, history_size=8, ttl=None, loader=None, topic=None):
+        self.history_size = history_size
+        self.loader = loader
+        self.topic = topic
+        self._users = LRUCache(maxsize=max_users, ttl=ttl)
+        self._lock = threading.Lock()
+    
+    def _remember_login(self, history, ip_key, device_key):
+        _remember(history.ips, ip_key, self.history_size)
+        _remember(history.devices, device_key, self.history_size)
+    
+    def record(self, user_id, ip_address, user_agent):
+        """Add a login to this worker's copy of the user's history without scoring it."""
+        ip_key = _digest(ip_prefix(ip_address))
+        device_key = _digest(device_fingerprint(user_agent))
+        with self._lock:
+            history = self._users.get(user_id)
+            if history is None:
+                history = _UserHistory()
+                self._users.set(user_id, history)
+            self._remember_login(history, ip_key, device_key)
+    
+    def _history(self, user_id):
+        """Cached history, loaded through the loader on a miss; None if unknown."""
+        history = self._users.get(user_id)
+        if history is not None or self.loader is None:
+            return history
+        logins = self.loader(user_id, self.history_size)
+        if logins is None:
+            return None
+        history = _UserHistory()
+        for ip_address, user_agent in logins:
+            self._remember_login(history, _digest(ip_prefix(ip_address)), _digest(device_fingerprint(user_agent)))
+        with self._lock:
+            # Another thread may have loaded or updated it meanwhile
+            cached = self._users.get(user_id)
+            if cached is not None:
+                return cached
+            self._users.set(user_id, history)
+        return history
+    
+    def check_login(self, user_id, ip_address, user_agent):
+        """Score a login against the user's history, then record it.
+        
+        Call it before the login's own Sessions row is written. Returns
+        (score, reasons). Users with no history score 0, and so does
+        everyone while the history cannot be loaded, so an outage never
+        produces false alarms.
+        """
+        ip_key = _digest(ip_prefix(ip_address))
+        device_key = _digest(device_fingerprint(user_agent))
+        score = 0
+        reasons = []
+        loaded = self._history(user_id)
+        with self._lock:
+            history = self._users.get(user_id) or loaded
+            if history is not None and history.ips:
+                if ip_key not in history.ips:
+                    score += NEW_LOCATION_SCORE
+                    reasons.append('new location')
+                if device_key not in history.devices:
+                    score += NEW_DEVICE_SCORE
+                    reasons.append('new device')
+            if history is None and self.loader is None:
+                history = _UserHistory()
+                self._users.set(user_id, history)
+            # Without a loadable history nothing is cached, so no partial
+            # copy outlives an outage
+            if history is not None:
+                history.risk_score = score
+                self._remember_login(history, ip_key, device_key)
+        if self.topic:
+            broadcast(self.topic, [[user_id, ip_key.hex(), device_key.hex(), score]])
+        return score, reasons
+    
+    def apply(self, items):
+        """Add logins scored by other workers to users this worker has cached."""
+        with self._lock:
+            for user_id, ip_key, device_key, score in items:
+                history = self._users.get(user_id)
+                if history is None:
+                    # Loaded from Sessions, which has this login, on first use
+                    continue
+                history.risk_score = score
+                self._remember_login(history, bytes.fromhex(ip_key), bytes.fromhex(device_key))
+    
+    def risk_score(self, user_id):
+        """Score of the user's latest login, if this worker has the user cached."""
+        history = self._users.get(user_id)
+        return history.risk_score if history is not None else 0
+    
+    def forget(self, user_id):
+        self._users.pop(user_id)
+
+def load_login_history(user_id, limit):
+    """(ip_address, user_agent) of a user's recent logins, oldest first, or None on error.
+    
+    Reads the newest sessions within ANOMALY_HISTORY_DAYS from the user's
+    shard; a few per remembered entry, since repeat logins share one.
+    """
+    connection = connection_for_user(user_id)
+    if connection is None:
+        return None
+    since = datetime.now() - timedelta(days=Config.ANOMALY_HISTORY_DAYS)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT ip_address, user_agent FROM Sessions 
+                WHERE user_id = %s AND login_time >= %s 
+                ORDER BY session_id DESC 
+                LIMIT %s
+            """, (user_id, since, limit * HISTORY_SESSIONS_PER_ENTRY))
+            rows = cursor.fetchall()
+        connection.close()
+        return [(row['ip_address'], row['user_agent']) for row in reversed(rows)]
+    except Exception as e:
+        report_error(e)
+        print(f"Error loading login history: {e}")
+        connection.close()
+        return None
+
+def set_risk_flag(user_id, flagged):
+    """Flag a user after a suspicious login, or clear the flag. Returns True if stored.
+    
+    The flag lives in Users.risk_flagged_at so every worker sees it and it
+    survives restarts; it is only written when a login is flagged.
+    """
+    connection = get_db_connection()
+    if connection is None:
+        return False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE Users SET risk_flagged_at = %s WHERE user_id = %s",
+                           (datetime.now() if flagged else None, user_id))
+        connection.commit()
+        connection.close()
+        return True
+    except Exception as e:
+        report_error(e)
+        print(f"Error updating risk flag: {e}")
+        connection.close()
+        return False
+
+def get_risk(user_id):
+    """Risk flag and latest score for a user, or None if the database is unavailable."""
+    connection = get_db_connection()
+    if connection is None:
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT risk_flagged_at FROM Users WHERE user_id = %s", (user_id,))
+            row = cursor.fetchone()
+        connection.close()
+    except Exception as e:
+        report_error(e)
+        print(f"Error reading risk flag: {e}")
+        connection.close()
+        return None
+    flagged_at = row['risk_flagged_at'] if row else None
+    return {
+        'user_id': user_id,
+        'risk_score': login_monitor.risk_score(user_id),
+        'flagged': flagged_at is not None,
+        'flagged_at': flagged_at
+    }
+
+LOGIN_HISTORY_TOPIC = 'login_history'
+
+login_monitor = LoginMonitor(
+    max_users=Config.ANOMALY_TRACKED_USERS,
+    history_size=Config.ANOMALY_HISTORY_SIZE,
+    ttl=Config.ANOMALY_HISTORY_TTL,
+    loader=load_login_history,
+    topic=LOGIN_HISTORY_TOPIC
+)
+on_broadcast(LOGIN_HISTORY_TOPIC, login_monitor.apply)
@@ -0,0 +1,145 @@
+import asyncio
+import contextlib
+import contextvars
+import os
+import threading
+from config import Config
+from utils.db import breaker, is_connectivity_error, report_error, DatabaseUnavailable
+
+try:
+    import aiomysql
+except ImportError:  # optional dependency, only needed with ASYNC_MODE
+    aiomysql = None
+
+# Set while a group of queries runs under one breaker admission
+_admitted = contextvars.ContextVar('async_db_admitted', default=False)
+
+class AsyncDatabase:
+    """aiomysql pool running on a dedicated event loop thread.
+    
+    Flask runs each async view in its own short-lived event loop (inside
+    the request's thread), so the pool lives on a long-running loop owned
+    by this worker and views await its results through wrapped futures.
+    This lets one view run its queries concurrently; it does not let a
+    worker thread serve more than one request at a time.
+    """
+    
+    def __init__(self):
+        self._loop = None
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+    
+    def start(self):
+        """Start the loop thread and pool for the current process."""
+        if aiomysql is None:
+            raise RuntimeError('ASYNC_MODE requires the aiomysql package')
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._loop = asyncio.new_event_loop()
+            threading.Thread(target=self._loop.run_forever, name='async-db-loop', daemon=True).start()
+            self._pool = None
+            self._pid = os.getpid()
+    
+    async def _get_pool(self):
+        if self._pool is None:
+            self._pool = await aiomysql.create_pool(
+                host=Config.MYSQL_HOST,
+                user=Config.MYSQL_USER,
+                password=Config.MYSQL_PASSWORD,
+                db=Config.MYSQL_DB,
+                minsize=Config.ASYNC_POOL_MIN,
+                maxsize=Config.ASYNC_POOL_MAX,
+                connect_timeout=Config.MYSQL_CONNECT_TIMEOUT,
+                cursorclass=aiomysql.DictCursor,
+                autocommit=True
+            )
+        return self._pool
+    
+    async def _run(self, sql, args, fetch):
+        pool = await self._get_pool()
+        connection = await pool.acquire()
+        try:
+            async with connection.cursor() as cursor:
+                try:
+                    await asyncio.wait_for(cursor.execute(sql, args), Config.MYSQL_READ_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.CancelledError):
+                    # The query may still be running; never hand this connection out again
+                    connection.close()
+                    raise
+                if fetch == 'one':
+                    return await cursor.fetchone()
+                if fetch == 'all':
+                    return await cursor.fetchall()
+                return cursor.lastrowid
+        finally:
+            # The pool drops closed connections instead of reusing them
+            pool.release(connection)
+    
+    @contextlib.asynccontextmanager
+    async def admitted(self):
+        """Pass the breaker once for a group of concurrent queries.
+        
+        In half-open state only one caller is let through; without this a
+        view's asyncio.gather would get its first query admitted and the
+        rest rejected.
+        """
+        if not breaker.allow_request():
+            raise DatabaseUnavailable('database circuit open')
+        trial = breaker.state == breaker.HALF_OPEN
+        token = _admitted.set(True)
+        try:
+            yield
+        finally:
+            _admitted.reset(token)
+            if trial:
+                breaker.release_trial()
+    
+    async def query(self, sql, args=None, fetch='all'):
+        """Run a query on the pool from any event loop."""
+        if self._pid != os.getpid():
+            self.start()
+        trial = False
+        if not _admitted.get():
+            if not breaker.allow_request():
+                raise DatabaseUnavailable('database circuit open')
+            trial = breaker.state == breaker.HALF_OPEN
+        future = asyncio.run_coroutine_threadsafe(self._run(sql, args, fetch), self._loop)
+        recorded = False
+        try:
+            result = await asyncio.wrap_future(future)
+            breaker.record_success()
+            recorded = True
+            return result
+        except asyncio.TimeoutError as e:
+            breaker.record_failure()
+            recorded = True
+            raise DatabaseUnavailable('query timed out') from e
+        except Exception as e:
+            if is_connectivity_error(e):
+                breaker.record_failure()
+                recorded = True
+                raise DatabaseUnavailable(str(e)) from e
+            if aiomysql is not None and isinstance(e, aiomysql.Error):
+                # The server answered, so the database is reachable
+                breaker.record_success()
+                recorded = True
+            report_error(e)
+            raise
+        finally:
+            if trial and not recorded:
+                # Cancelled or failed locally: free a half-open trial so the breaker can probe again
+                breaker.release_trial()
+
+async_db = AsyncDatabase()
+
+async def fetchone(sql, args=None):
+    return await async_db.query(sql, args, fetch='one')
+
+async def fetchall(sql, args=None):
+    return await async_db.query(sql, args, fetch='all')
+
+async def execute(sql, args=None):
+    """Run a write statement; returns lastrowid."""
+    return await async_db.query(sql, args, fetch=None)
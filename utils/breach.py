@@ -0,0 +1,288 @@
+import hashlib
+import heapq
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from config import Config
+
+try:
+    import numpy
+except ImportError:  # optional dependency, only speeds up build_bloom
+    numpy = None
+
+# A corpus file is <magic><count>, a fan-out table of 65537 uint64 and then
+# the sorted 20-byte SHA-1 digests. fanout[p] is the index of the first
+# digest whose first two bytes are >= p, so a lookup only binary-searches
+# the slice for its own prefix. An optional Bloom filter lives next to it
+# in <corpus>.bloom and answers most misses without touching the corpus.
+CORPUS_MAGIC = b'PWSHA1v1'
+BLOOM_MAGIC = b'PWBLOOM1'
+DIGEST_SIZE = 20
+FANOUT_SIZE = 65537
+CORPUS_HEADER = struct.Struct('>8sQ')
+BLOOM_HEADER = struct.Struct('>8sIQ')
+DATA_OFFSET = CORPUS_HEADER.size + FANOUT_SIZE * 8
+# Digests hashed into the Bloom filter per step of build_bloom
+BLOOM_CHUNK = 1 << 20
+
+def password_digest(password):
+    return hashlib.sha1(password.encode('utf-8')).digest()
+
+def _bloom_positions(digest, hashes, bits):
+    # SHA-1 output is already uniform, so slices of it serve as the two base
+    # hashes. Position i is (h1 + i * h2) % bits, stepped modulo bits so a
+    # vectorised build gets the same positions without overflowing uint64.
+    h1, h2 = struct.unpack_from('>QQ', digest)
+    position, step = h1 % bits, (h2 | 1) % bits
+    positions = []
+    for _ in range(hashes):
+        positions.append(position)
+        position = (position + step) % bits
+    return positions
+
+class BreachCorpus:
+    """Read-only, memory-mapped view of a corpus file and its Bloom filter.
+    
+    Pages come from the shared page cache, so workers add next to nothing
+    to their own RSS and a lookup touches only a few pages.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mm = None
+        self._bloom = None
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            if len(self._mm) < DATA_OFFSET:
+                raise ValueError(f"{path} is not a breached-password corpus")
+            magic, self.count = CORPUS_HEADER.unpack_from(self._mm, 0)
+            if magic != CORPUS_MAGIC or len(self._mm) != DATA_OFFSET + self.count * DIGEST_SIZE:
+                raise ValueError(f"{path} is not a breached-password corpus")
+            
+            bloom_path = path + '.bloom'
+            if os.path.exists(bloom_path):
+                self._bloom_file = open(bloom_path, 'rb')
+                self._bloom = mmap.mmap(self._bloom_file.fileno(), 0, access=mmap.ACCESS_READ)
+                if len(self._bloom) < BLOOM_HEADER.size:
+                    raise ValueError(f"{bloom_path} is not a corpus Bloom filter")
+                magic, self.bloom_hashes, self.bloom_bits = BLOOM_HEADER.unpack_from(self._bloom, 0)
+                # A truncated filter would raise IndexError on lookups
+                if magic != BLOOM_MAGIC or not self.bloom_bits or \
+                        len(self._bloom) != BLOOM_HEADER.size + (self.bloom_bits + 7) // 8:
+                    raise ValueError(f"{bloom_path} is not a corpus Bloom filter")
+        except (ValueError, struct.error):
+            self.close()
+            raise
+    
+    def _maybe_contains(self, digest):
+        if self._bloom is None:
+            return True
+        for position in _bloom_positions(digest, self.bloom_hashes, self.bloom_bits):
+            if not self._bloom[BLOOM_HEADER.size + (position >> 3)] & (1 << (position & 7)):
+                return False
+        return True
+    
+    def contains_digest(self, digest):
+        if not self._maybe_contains(digest):
+            return False
+        prefix = int.from_bytes(digest[:2], 'big')
+        lo, hi = struct.unpack_from('>QQ', self._mm, CORPUS_HEADER.size + prefix * 8)
+        mm = self._mm
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = DATA_OFFSET + mid * DIGEST_SIZE
+            probe = mm[start:start + DIGEST_SIZE]
+            if probe < digest:
+                lo = mid + 1
+            elif probe > digest:
+                hi = mid
+            else:
+                return True
+        return False
+    
+    def contains(self, password):
+        return self.contains_digest(password_digest(password))
+    
+    def close(self):
+        for resource in (self._mm, self._file, self._bloom, getattr(self, '_bloom_file', None)):
+            if resource is not None:
+                resource.close()
+
+_corpus = None
+_corpus_pid = None
+_corpus_signature = None
+_corpus_lock = threading.Lock()
+
+def _file_signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
+
+def get_corpus():
+    """The configured corpus, or None if not available.
+    
+    Opened once per process and reopened whenever the corpus or its Bloom
+    filter is replaced (a new inode or mtime), so a rebuilt corpus is
+    picked up without restarting workers.
+    """
+    global _corpus, _corpus_pid, _corpus_signature
+    path = Config.BREACHED_PASSWORDS_FILE
+    if not path:
+        return None
+    signature = (_file_signature(path), _file_signature(path + '.bloom'))
+    with _corpus_lock:
+        if _corpus_pid != os.getpid() or _corpus_signature != signature:
+            _corpus_pid = os.getpid()
+            _corpus_signature = signature
+            # The old corpus is not closed here: another thread may still be
+            # searching it. Its maps are released once nothing references it.
+            try:
+                _corpus = BreachCorpus(path)
+            except (OSError, ValueError) as e:
+                print(f"Breached-password screening disabled: {e}")
+                _corpus = None
+        return _corpus
+
+def is_breached(password):
+    """True if the password appears in the breached-password corpus."""
+    corpus = get_corpus()
+    return corpus is not None and corpus.contains(password)
+
+def _parse_digest(line):
+    """Digest from a 'HASH' or 'HASH:COUNT' dump line, or None for blank lines."""
+    line = line.strip()
+    if not line:
+        return None
+    digest = bytes.fromhex(line.split(b':', 1)[0].decode('ascii'))
+    if len(digest) != DIGEST_SIZE:
+        raise ValueError(f"not a SHA-1 hash: {line[:60]!r}")
+    return digest
+
+def _sorted_runs(digests, run_size, directory):
+    """Split the input into sorted run files; yields their paths."""
+    run = []
+    for digest in digests:
+        run.append(digest)
+        if len(run) >= run_size:
+            yield _write_run(run, directory)
+            run = []
+    if run:
+        yield _write_run(run, directory)
+
+def _write_run(run, directory):
+    run.sort()
+    handle, path = tempfile.mkstemp(suffix='.run', dir=directory)
+    with os.fdopen(handle, 'wb') as f:
+        f.write(b''.join(run))
+    return path
+
+def _read_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            digest = f.read(DIGEST_SIZE)
+            if len(digest) < DIGEST_SIZE:
+                return
+            yield digest
+
+def build_corpus(lines, output_path, run_size=2000000):
+    """Convert a text dump (one 'HASH' or 'HASH:COUNT' per line) into a corpus file.
+    
+    lines is any iterable of byte lines, read once as a stream. Hashes are
+    sorted in runs of run_size on disk and merged, so memory stays bounded
+    and the input does not need to be in order; duplicates are dropped.
+    A run costs about 65 bytes per hash (a bytes object plus its list
+    slot), so the default uses roughly 130MB; every run file stays open
+    during the merge. The file is moved into place only once complete.
+    Returns the number of hashes written.
+    """
+    directory = os.path.dirname(os.path.abspath(output_path))
+    temp_path = output_path + '.tmp'
+    fanout = [0] * FANOUT_SIZE
+    count = 0
+    
+    with tempfile.TemporaryDirectory(dir=directory) as run_dir:
+        digests = (digest for digest in map(_parse_digest, lines) if digest is not None)
+        runs = list(_sorted_runs(digests, run_size, run_dir))
+        merged = heapq.merge(*[_read_run(path) for path in runs])
+        
+        with open(temp_path, 'wb') as out:
+            out.seek(DATA_OFFSET)
+            previous = None
+            for digest in merged:
+                if digest == previous:
+                    continue
+                out.write(digest)
+                fanout[int.from_bytes(digest[:2], 'big') + 1] += 1
+                previous = digest
+                count += 1
+            
+            # Turn per-prefix counts into start indexes
+            for prefix in range(1, FANOUT_SIZE):
+                fanout[prefix] += fanout[prefix - 1]
+            out.seek(0)
+            out.write(CORPUS_HEADER.pack(CORPUS_MAGIC, count))
+            out.write(struct.pack(f'>{FANOUT_SIZE}Q', *fanout))
+    
+    # A filter built for the previous corpus would hide new hashes
+    if os.path.exists(output_path + '.bloom'):
+        os.remove(output_path + '.bloom')
+    os.replace(temp_path, output_path)
+    return count
+
+def _fill_bloom(bloom, mm, hashes, bits):
+    """Set the filter bits of every digest in mm, BLOOM_CHUNK digests at a time."""
+    chunk_size = BLOOM_CHUNK * DIGEST_SIZE
+    if numpy is None:
+        for offset in range(DATA_OFFSET, len(mm), chunk_size):
+            for h1, h2 in struct.iter_unpack('>QQ4x', mm[offset:offset + chunk_size]):
+                position, step = h1 % bits, (h2 | 1) % bits
+                for _ in range(hashes):
+                    bloom[BLOOM_HEADER.size + (position >> 3)] |= 1 << (position & 7)
+                    position = (position + step) % bits
+        return
+    
+    # Each chunk takes about 100 bytes per digest on top of the mapped files
+    filter_bytes = numpy.frombuffer(bloom, dtype=numpy.uint8, offset=BLOOM_HEADER.size)
+    bits = numpy.uint64(bits)
+    for offset in range(DATA_OFFSET, len(mm), chunk_size):
+        digests = numpy.frombuffer(mm[offset:offset + chunk_size], dtype=numpy.uint8).reshape(-1, DIGEST_SIZE)
+        position = numpy.ascontiguousarray(digests[:, :8]).view('>u8').ravel() % bits
+        step = (numpy.ascontiguousarray(digests[:, 8:16]).view('>u8').ravel() | numpy.uint64(1)) % bits
+        for _ in range(hashes):
+            masks = numpy.left_shift(numpy.uint8(1), (position & numpy.uint64(7)).astype(numpy.uint8))
+            numpy.bitwise_or.at(filter_bytes, (position >> numpy.uint64(3)).astype(numpy.intp), masks)
+            position += step
+            position %= bits
+    # The map cannot be closed while an array still exports it
+    del filter_bytes
+
+def build_bloom(corpus_path, bits_per_entry=10):
+    """Write <corpus>.bloom for an existing corpus. Returns the filter size in bytes.
+    
+    About 10 bits per hash gives a 1% false-positive rate; a false
+    positive only costs the normal binary search. The filter file is
+    written through a memory map of bits_per_entry / 8 bytes per hash.
+    With numpy installed the digests are hashed in vectorised chunks,
+    otherwise in a much slower pure-Python loop.
+    """
+    corpus = BreachCorpus(corpus_path)
+    try:
+        bits = max(8, corpus.count * bits_per_entry)
+        hashes = max(1, round(bits_per_entry * 0.693))
+        size = BLOOM_HEADER.size + (bits + 7) // 8
+        temp_path = corpus_path + '.bloom.tmp'
+        with open(temp_path, 'w+b') as f:
+            f.truncate(size)
+            with mmap.mmap(f.fileno(), size) as bloom:
+                bloom[:BLOOM_HEADER.size] = BLOOM_HEADER.pack(BLOOM_MAGIC, hashes, bits)
+                _fill_bloom(bloom, corpus._mm, hashes, bits)
+                bloom.flush()
+        os.replace(temp_path, corpus_path + '.bloom')
+        return size
+    finally:
+        corpus.close()
@@ -0,0 +1,160 @@
+from datetime import datetime
+from models.audit_log import AuditEvent
+from utils.db import get_db_connection, report_error, session_cache, invalidate_users
+from utils.search import user_index
+from utils.anomaly import login_monitor
+from utils.stats import record_activity
+from utils.logging import INSERT_EVENT_SQL, encode_payload, outbox_event
+from utils.outbox import enqueue
+from utils.shards import on_user_shards
+from utils.deletions import DELETE_MODES, queue_deletions
+from utils.tokens import revoke_user_tokens
+
+DEFAULT_CHUNK_SIZE = 1000
+
+def _chunks(user_ids, chunk_size):
+    ids = sorted({int(user_id) for user_id in user_ids})
+    for i in range(0, len(ids), chunk_size):
+        yield ids[i:i + chunk_size]
+
+def _placeholders(ids):
+    return ', '.join(['%s'] * len(ids))
+
+def _run_chunked(user_ids, actor_id, chunk_size, apply_chunk, event_for_chunk, after_commit=None):
+    """Apply a change to users in chunked transactions.
+    
+    apply_chunk(cursor, ids) runs the statements for one chunk and returns
+    the ids of the users it changed. Each chunk commits together with a
+    single audit event from event_for_chunk(changed), which returns
+    (event_type, payload) and names every changed user. after_commit(ids)
+    then updates in-process state. Returns (processed, failed_chunks);
+    failed_chunks is -1 if the database is unavailable.
+    """
+    connection = get_db_connection()
+    if connection is None:
+        return 0, -1
+    
+    processed = 0
+    failed_chunks = 0
+    try:
+        for ids in _chunks(user_ids, chunk_size):
+            try:
+                with connection.cursor() as cursor:
+                    changed = apply_chunk(cursor, ids)
+                    event_type, payload = event_for_chunk(changed)
+                    action_time = datetime.now()
+                    
+                    def insert_event(shard_cursor, _):
+                        shard_cursor.execute(INSERT_EVENT_SQL, (actor_id, event_type, None, encode_payload(payload), action_time))
+                        enqueue(shard_cursor, 'audit', action_time,
+                                **outbox_event(shard_cursor.lastrowid, actor_id, event_type, None, payload))
+                    # The event goes to the actor's shard (this same transaction unless sharded)
+                    on_user_shards(cursor, [actor_id], insert_event)
+                    record_activity(cursor, actor_id)
+                connection.commit()
+                processed += len(changed)
+                if after_commit:
+                    after_commit(ids)
+            except Exception as e:
+                connection.rollback()
+                report_error(e)
+                print(f"Error in bulk chunk {ids[0]}..{ids[-1]}: {e}")
+                failed_chunks += 1
+            invalidate_users(ids)
+    finally:
+        connection.close()
+    return processed, failed_chunks
+
+def _lock_changing(cursor, ids, unchanged_when, value):
+    """Lock the users in ids whose row would change and return their ids.
+    
+    Users that do not exist, or where unchanged_when (with value) already
+    holds, are left out of the update and the audit event.
+    """
+    cursor.execute(f"""
+        SELECT user_id FROM Users 
+        WHERE user_id IN ({_placeholders(ids)}) AND NOT ({unchanged_when}) 
+        ORDER BY user_id 
+        FOR UPDATE
+    """, ids + [value])
+    return [row['user_id'] for row in cursor.fetchall()]
+
+def role_exists(role_id):
+    """Whether role_id is a row in Roles, or None if the database is unavailable."""
+    connection = get_db_connection()
+    if connection is None:
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM Roles WHERE role_id = %s", (role_id,))
+            found = cursor.fetchone() is not None
+        connection.close()
+        return found
+    except Exception as e:
+        report_error(e)
+        print(f"Error looking up role: {e}")
+        connection.close()
+        return None
+
+def bulk_change_role(user_ids, role_id, actor_id=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Assign role_id to every user in user_ids."""
+    if role_id is None:
+        raise ValueError("role_id is required")
+    
+    def apply_chunk(cursor, ids):
+        changed = _lock_changing(cursor, ids, "role_id <=> %s", role_id)
+        if changed:
+            cursor.execute(f"UPDATE Users SET role_id = %s WHERE user_id IN ({_placeholders(changed)})",
+                           [role_id] + changed)
+            revoke_user_tokens(cursor, changed)
+        return changed
+    
+    def event_for_chunk(changed):
+        return AuditEvent.BULK_ROLE_CHANGED, {'role_id': role_id, 'count': len(changed), 'ids': changed}
+    
+    return _run_chunked(user_ids, actor_id, chunk_size, apply_chunk, event_for_chunk)
+
+def bulk_set_active(user_ids, active, actor_id=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Deactivate (or reactivate) users without deleting their data."""
+    def apply_chunk(cursor, ids):
+        changed = _lock_changing(cursor, ids, "is_active = %s", bool(active))
+        if changed:
+            cursor.execute(f"UPDATE Users SET is_active = %s WHERE user_id IN ({_placeholders(changed)})",
+                           [bool(active)] + changed)
+            if not active:
+                revoke_user_tokens(cursor, changed)
+        return changed
+    
+    def event_for_chunk(changed):
+        event_type = AuditEvent.BULK_ACTIVATED if active else AuditEvent.BULK_DEACTIVATED
+        return event_type, {'count': len(changed), 'ids': changed}
+    
+    return _run_chunked(user_ids, actor_id, chunk_size, apply_chunk, event_for_chunk)
+
+def bulk_delete_users(user_ids, actor_id=None, mode='anonymize', chunk_size=DEFAULT_CHUNK_SIZE):
+    """Deactivate users and queue them for background deletion.
+    
+    Each chunk deactivates, revokes tokens and adds AccountDeletions rows
+    in one transaction. process_deletions later removes the users'
+    sessions, their audit rows (anonymized with mode='anonymize', deleted
+    with mode='cascade'), the users and their uploads.
+    """
+    if mode not in DELETE_MODES:
+        raise ValueError(f"Unknown delete mode: {mode}")
+    requested_at = datetime.now()
+    
+    def apply_chunk(cursor, ids):
+        return queue_deletions(cursor, ids, actor_id, mode, requested_at)
+    
+    def event_for_chunk(changed):
+        return AuditEvent.BULK_DELETED, {'count': len(changed), 'ids': changed, 'mode': mode}
+    
+    def after_commit(ids):
+        session_cache.invalidate_many(ids)
+        user_index.remove_many(ids)
+        for user_id in ids:
+            login_monitor.forget(user_id)
+    
+    # Deleting the acting admin would orphan the audit record for the chunk
+    ids = [user_id for user_id in user_ids if int(user_id) != actor_id]
+    return _run_chunked(ids, actor_id, chunk_size, apply_chunk, event_for_chunk, after_commit)
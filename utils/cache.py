@@ -0,0 +1,547 @@
+import glob
+import json
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+from decimal import Decimal
+from urllib.parse import urlparse
+from config import Config
+
+class LRUCache:
+    """Small thread-safe LRU cache used for in-process lookups.
+    
+    With a ttl, get() treats older entries as missing but keeps them until
+    they are evicted, so get_stale() can still serve them in degraded mode.
+    """
+    
+    def __init__(self, maxsize=1000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _lookup(self, key, default, fresh_only):
+        with self._lock:
+            if key not in self._data:
+                return default
+            expires_at, value = self._data[key]
+            if fresh_only and expires_at is not None and expires_at < time.monotonic():
+                return default
+            self._data.move_to_end(key)
+            return value
+    
+    def get(self, key, default=None):
+        return self._lookup(key, default, fresh_only=True)
+    
+    def get_stale(self, key, default=None):
+        """Like get(), ignoring the ttl."""
+        return self._lookup(key, default, fresh_only=False)
+    
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return default if entry is None else entry[1]
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    
+    def __len__(self):
+        return len(self._data)
+
+# Values stored in the shared tier are JSON; database rows carry dates and decimals
+
+def _encode_default(value):
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, date):
+        return {'__date__': value.isoformat()}
+    if isinstance(value, Decimal):
+        return {'__decimal__': str(value)}
+    raise TypeError(f"Cannot cache {type(value).__name__}")
+
+def _decode_hook(obj):
+    if len(obj) == 1:
+        if '__datetime__' in obj:
+            return datetime.fromisoformat(obj['__datetime__'])
+        if '__date__' in obj:
+            return date.fromisoformat(obj['__date__'])
+        if '__decimal__' in obj:
+            return Decimal(obj['__decimal__'])
+    return obj
+
+def encode_value(value):
+    return json.dumps(value, separators=(',', ':'), default=_encode_default).encode('utf-8')
+
+def decode_value(data):
+    return json.loads(data, object_hook=_decode_hook)
+
+class _SocketClient:
+    """One lazily (re)connected socket, shared under a lock.
+    
+    After a failure the server is skipped for a few seconds so a dead
+    cache never adds a connect timeout to every request.
+    """
+    
+    RETRY_AFTER = 5
+    
+    def __init__(self, host, port, timeout=0.25):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._sock = None
+        self._reader = None
+        self._down_until = 0
+        self._lock = threading.Lock()
+    
+    def _open(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._reader = self._sock.makefile('rb')
+    
+    def _close(self):
+        for closable in (self._reader, self._sock):
+            if closable is not None:
+                try:
+                    closable.close()
+                except OSError:
+                    pass
+        self._sock = None
+        self._reader = None
+    
+    def _call(self, request, read_reply):
+        """Send request bytes and parse the reply; returns None on any error."""
+        with self._lock:
+            if time.monotonic() < self._down_until:
+                return None
+            try:
+                if self._sock is None:
+                    self._open()
+                    self._on_connect()
+                self._sock.sendall(request)
+                return read_reply(self._reader)
+            except (OSError, ValueError) as e:
+                self._close()
+                self._down_until = time.monotonic() + self.RETRY_AFTER
+                print(f"Error talking to cache server {self.host}:{self.port}: {e}")
+                return None
+    
+    def _on_connect(self):
+        pass
+
+class MemcacheClient(_SocketClient):
+    """Minimal memcached text-protocol client (get/set/delete)."""
+    
+    def get(self, key):
+        def read(reader):
+            header = reader.readline()
+            if header == b'END\r\n':
+                return None
+            if not header.startswith(b'VALUE '):
+                raise ValueError(f"unexpected reply {header!r}")
+            length = int(header.split()[3])
+            data = reader.read(length + 2)[:-2]
+            if reader.readline() != b'END\r\n':
+                raise ValueError("missing END")
+            return data
+        return self._call(b'get ' + key.encode() + b'\r\n', read)
+    
+    def set(self, key, data, ttl):
+        request = b'set %s 0 %d %d\r\n%s\r\n' % (key.encode(), int(ttl or 0), len(data), data)
+        return self._call(request, lambda reader: reader.readline() == b'STORED\r\n')
+    
+    def delete(self, key):
+        return self._call(b'delete ' + key.encode() + b'\r\n', lambda reader: reader.readline())
+
+def _resp_command(*parts):
+    encoded = [part if isinstance(part, bytes) else str(part).encode() for part in parts]
+    return b'*%d\r\n' % len(encoded) + b''.join(b'$%d\r\n%s\r\n' % (len(part), part) for part in encoded)
+
+def _resp_reply(reader):
+    line = reader.readline()
+    if not line.endswith(b'\r\n'):
+        raise ValueError("connection closed")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b'+':
+        return rest
+    if kind == b'-':
+        raise ValueError(rest.decode())
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        length = int(rest)
+        return None if length < 0 else reader.read(length + 2)[:-2]
+    if kind == b'*':
+        count = int(rest)
+        return None if count < 0 else [_resp_reply(reader) for _ in range(count)]
+    raise ValueError(f"unexpected reply {line!r}")
+
+class RedisClient(_SocketClient):
+    """Minimal Redis (RESP) client: GET/SET/DEL plus PUBLISH for invalidations."""
+    
+    def __init__(self, host, port, db=0, timeout=0.25):
+        super().__init__(host, port, timeout)
+        self.db = db
+    
+    def _on_connect(self):
+        if self.db:
+            self._sock.sendall(_resp_command('SELECT', self.db))
+            _resp_reply(self._reader)
+    
+    def get(self, key):
+        return self._call(_resp_command('GET', key), _resp_reply)
+    
+    def set(self, key, data, ttl):
+        if ttl:
+            return self._call(_resp_command('SET', key, data, 'EX', int(ttl)), _resp_reply)
+        return self._call(_resp_command('SET', key, data), _resp_reply)
+    
+    def delete(self, key):
+        return self._call(_resp_command('DEL', key), _resp_reply)
+    
+    def publish(self, channel, message):
+        return self._call(_resp_command('PUBLISH', channel, message), _resp_reply)
+    
+    def subscribe_forever(self, channel, handler):
+        """Blocking SUBSCRIBE loop on a dedicated connection (run in a thread)."""
+        while True:
+            try:
+                with socket.create_connection((self.host, self.port), timeout=self.timeout) as sock:
+                    sock.sendall(_resp_command('SUBSCRIBE', channel))
+                    sock.settimeout(None)
+                    reader = sock.makefile('rb')
+                    while True:
+                        reply = _resp_reply(reader)
+                        if reply and reply[0] == b'message':
+                            handler(reply[2])
+            except (OSError, ValueError) as e:
+                print(f"Cache invalidation subscriber error: {e}")
+                time.sleep(self.RETRY_AFTER)
+
+def connect_l2(url):
+    """Shared cache client for memcached://host:port or redis://host:port/db, or None."""
+    if not url:
+        return None
+    parsed = urlparse(url)
+    if parsed.scheme == 'memcached':
+        return MemcacheClient(parsed.hostname, parsed.port or 11211)
+    if parsed.scheme == 'redis':
+        return RedisClient(parsed.hostname, parsed.port or 6379, int(parsed.path.lstrip('/') or 0))
+    raise ValueError(f"Unsupported CACHE_L2_URL scheme: {parsed.scheme}")
+
+class LocalBus:
+    """Invalidation broadcast between workers on one host.
+    
+    Each worker binds a Unix datagram socket in CACHE_BUS_DIR; publishing
+    sends one datagram to every socket there. Sockets left by dead workers
+    are removed on the first failed send.
+    """
+    
+    def __init__(self, directory):
+        self.directory = directory
+        self._path = None
+        self._sender = None
+    
+    def listen(self, handler):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'{os.getpid()}.sock')
+        if os.path.exists(path):
+            os.remove(path)
+        receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.bind(path)
+        self._path = path
+        
+        def loop():
+            while True:
+                handler(receiver.recv(65536))
+        threading.Thread(target=loop, name='cache-invalidations', daemon=True).start()
+    
+    def publish(self, message):
+        if self._sender is None:
+            self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        for path in glob.glob(os.path.join(self.directory, '*.sock')):
+            if path == self._path:
+                continue
+            try:
+                self._sender.sendto(message, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            except OSError as e:
+                print(f"Error broadcasting cache invalidation: {e}")
+
+class RedisBus:
+    """Invalidation broadcast over Redis pub/sub (reaches workers on every host)."""
+    
+    def __init__(self, client, channel):
+        self.client = client
+        self.channel = channel
+    
+    def listen(self, handler):
+        threading.Thread(target=self.client.subscribe_forever, args=(self.channel, handler),
+                         name='cache-invalidations', daemon=True).start()
+    
+    def publish(self, message):
+        self.client.publish(self.channel, message)
+
+class CacheStats:
+    """Per-namespace counters (approximate under concurrency)."""
+    
+    FIELDS = ('l1_hits', 'l2_hits', 'misses', 'loads', 'load_failures', 'coalesced', 'invalidations', 'stale_served')
+    
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+    
+    def snapshot(self):
+        result = {field: getattr(self, field) for field in self.FIELDS}
+        lookups = self.l1_hits + self.l2_hits + self.misses
+        result['hit_rate'] = round((self.l1_hits + self.l2_hits) / lookups, 3) if lookups else None
+        return result
+
+class _Flight:
+    __slots__ = ('event', 'value', 'error')
+    
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+_MISSING = object()
+
+class TieredCache:
+    """One cache namespace: in-process L1 (LRU + TTL) over an optional shared L2.
+    
+    invalidate() drops the key from L2 and broadcasts it so every worker
+    drops its L1 copy; get_or_load() lets only one thread per process load
+    a missing key while the others wait for its result.
+    """
+    
+    def __init__(self, namespace, maxsize, ttl):
+        self.namespace = namespace
+        self.ttl = ttl
+        l1_ttl = ttl
+        if isinstance(shared_tier(), MemcacheClient):
+            # Invalidations only reach this host's workers; bound how long
+            # other hosts keep a changed row
+            l1_ttl = min(ttl or Config.CACHE_L1_TTL_WITHOUT_BUS, Config.CACHE_L1_TTL_WITHOUT_BUS)
+        self.l1 = LRUCache(maxsize=maxsize, ttl=l1_ttl)
+        self.stats = CacheStats()
+        self._generation = 0
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+    
+    def _l2_key(self, key):
+        return f'{Config.CACHE_KEY_PREFIX}:{self.namespace}:{key}'
+    
+    def get(self, key, default=None):
+        value = self.l1.get(key, _MISSING)
+        if value is not _MISSING:
+            self.stats.l1_hits += 1
+            return value
+        l2 = shared_tier()
+        if l2 is not None:
+            data = l2.get(self._l2_key(key))
+            if data is not None:
+                value = decode_value(data)
+                self.l1.set(key, value)
+                self.stats.l2_hits += 1
+                return value
+        self.stats.misses += 1
+        return default
+    
+    def get_stale(self, key, default=None):
+        """Last value seen in this process regardless of age (degraded mode)."""
+        value = self.l1.get_stale(key, _MISSING)
+        if value is _MISSING:
+            return default
+        self.stats.stale_served += 1
+        return value
+    
+    def set(self, key, value, shared=True):
+        self.l1.set(key, value)
+        l2 = shared_tier()
+        if l2 is not None and shared:
+            l2.set(self._l2_key(key), encode_value(value), self.ttl)
+    
+    def get_or_load(self, key, loader):
+        """Return the cached value or load it with loader() (single flight).
+        
+        None results are not cached. A loader exception propagates to the
+        caller and to every thread waiting on the same key.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                generation = self._generation
+        
+        if not leader:
+            self.stats.coalesced += 1
+            if not flight.event.wait(Config.CACHE_LOAD_TIMEOUT):
+                return loader()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        
+        try:
+            self.stats.loads += 1
+            started = time.monotonic()
+            flight.value = loader()
+            # Skip caching if an invalidation arrived while we were loading. One
+            # from another worker may still be in flight, so only a load that
+            # finished within CACHE_REDELETE_DELAY is shared: the invalidating
+            # worker's second delete then removes it if it was already stale.
+            if flight.value is not None and generation == self._generation:
+                self.set(key, flight.value, shared=time.monotonic() - started < Config.CACHE_REDELETE_DELAY)
+            return flight.value
+        except Exception as e:
+            self.stats.load_failures += 1
+            flight.error = e
+            raise
+        finally:
+            with self._flights_lock:
+                self._flights.pop(key, None)
+            flight.event.set()
+    
+    def drop_local(self, keys):
+        """Forget the L1 copies (on an invalidation from any worker)."""
+        self._generation += 1
+        for key in keys:
+            self.l1.pop(key)
+        self.stats.invalidations += len(keys)
+    
+    def invalidate(self, key):
+        """Drop key everywhere: this L1, the shared L2 and every other worker's L1."""
+        self.invalidate_many([key])
+    
+    def invalidate_many(self, keys):
+        keys = list(keys)
+        self.drop_local(keys)
+        l2 = shared_tier()
+        if l2 is not None:
+            self._delete_shared(keys)
+            timer = threading.Timer(Config.CACHE_REDELETE_DELAY, self._delete_shared, (keys,))
+            timer.daemon = True
+            timer.start()
+        publish_invalidation(self.namespace, keys)
+    
+    def _delete_shared(self, keys):
+        l2 = shared_tier()
+        if l2 is None:
+            return
+        try:
+            for key in keys:
+                l2.delete(self._l2_key(key))
+        except Exception as e:
+            print(f"Error deleting shared cache keys: {e}")
+    
+    def __len__(self):
+        return len(self.l1)
+
+_caches = {}
+_caches_lock = threading.Lock()
+_l2 = _MISSING
+_bus = None
+_listen_pid = None
+# Broadcast topics with their own handler; any other topic is a cache namespace
+_handlers = {}
+
+def get_cache(namespace, maxsize=None, ttl=None):
+    """The TieredCache for a namespace, created on first use."""
+    with _caches_lock:
+        if namespace not in _caches:
+            _caches[namespace] = TieredCache(namespace, maxsize or Config.DEGRADED_CACHE_SIZE, ttl)
+        return _caches[namespace]
+
+def shared_tier():
+    """The L2 client configured by CACHE_L2_URL, or None."""
+    global _l2
+    if _l2 is _MISSING:
+        _l2 = connect_l2(Config.CACHE_L2_URL)
+    return _l2
+
+def invalidation_bus():
+    global _bus
+    if _bus is None:
+        l2 = shared_tier()
+        if isinstance(l2, RedisClient):
+            _bus = RedisBus(l2, f'{Config.CACHE_KEY_PREFIX}:invalidate')
+        else:
+            _bus = LocalBus(Config.CACHE_BUS_DIR)
+    return _bus
+
+def _sender_id():
+    # Host and pid, so a Redis broadcast is never mistaken for our own on another host
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+# Items per broadcast message, keeping each datagram well under the size limit
+INVALIDATION_BATCH = 1000
+
+def broadcast(topic, items):
+    """Send a list of JSON-serializable items to every other worker's handler for topic."""
+    try:
+        bus = invalidation_bus()
+        for start in range(0, len(items), INVALIDATION_BATCH):
+            bus.publish(json.dumps([_sender_id(), topic, items[start:start + INVALIDATION_BATCH]]).encode())
+    except Exception as e:
+        print(f"Error broadcasting to other workers: {e}")
+
+def on_broadcast(topic, handler):
+    """Call handler(items) for each broadcast on topic from another worker."""
+    _handlers[topic] = handler
+
+def publish_invalidation(namespace, keys):
+    broadcast(namespace, keys)
+
+def _on_message(message):
+    try:
+        sender, topic, items = json.loads(message)
+    except ValueError:
+        return
+    if sender == _sender_id():
+        return
+    handler = _handlers.get(topic)
+    if handler is not None:
+        try:
+            handler(items)
+        except Exception as e:
+            print(f"Error handling broadcast on {topic}: {e}")
+        return
+    cache = _caches.get(topic)
+    if cache is not None:
+        cache.drop_local(items)
+
+def init_cache_invalidations():
+    """Start listening for invalidations and broadcasts from other workers, once per process."""
+    global _listen_pid, _bus, _l2
+    if _listen_pid == os.getpid():
+        return
+    _listen_pid = os.getpid()
+    # Sockets are not shared with the parent after fork
+    _bus = None
+    _l2 = _MISSING
+    invalidation_bus().listen(_on_message)
+
+def cache_stats():
+    """Hit-rate statistics per namespace."""
+    with _caches_lock:
+        caches = dict(_caches)
+    return {namespace: dict(cache.stats.snapshot(), size=len(cache)) for namespace, cache in caches.items()}
@@ -0,0 +1,193 @@
+from config import Config
+import pymysql
+import threading
+import time
+from utils.cache import get_cache
+
+class DatabaseUnavailable(Exception):
+    """Raised when the database (or async pool) cannot serve a query."""
+
+class CircuitBreaker:
+    """Fail fast once the database has failed several times in a row."""
+    
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.total_failures = 0
+        self.total_rejected = 0
+        self._trial_in_flight = False
+        self._trial_started_at = None
+        self._lock = threading.Lock()
+    
+    def allow_request(self):
+        """Return True if a database call may be attempted right now."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            # A trial that never reported back (e.g. a connection closed
+            # unused) must not keep the breaker half-open forever
+            trial_expired = self._trial_in_flight and \
+                time.monotonic() - self._trial_started_at >= self.reset_timeout
+            if self.state == self.HALF_OPEN and (not self._trial_in_flight or trial_expired):
+                # Let exactly one caller probe the database
+                self._trial_in_flight = True
+                self._trial_started_at = time.monotonic()
+                return True
+            self.total_rejected += 1
+            return False
+    
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+    
+    def release_trial(self):
+        """Give up a half-open trial that ended without a verdict (e.g. cancelled)."""
+        with self._lock:
+            self._trial_in_flight = False
+    
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.total_failures += 1
+            self._trial_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+    
+    def snapshot(self):
+        """Return breaker state for monitoring."""
+        with self._lock:
+            retry_in = None
+            if self.state == self.OPEN:
+                retry_in = max(0, round(self.reset_timeout - (time.monotonic() - self.opened_at), 1))
+            return {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'failure_threshold': self.failure_threshold,
+                'total_failures': self.total_failures,
+                'total_rejected': self.total_rejected,
+                'retry_in': retry_in
+            }
+
+breaker = CircuitBreaker(
+    failure_threshold=Config.DB_BREAKER_THRESHOLD,
+    reset_timeout=Config.DB_BREAKER_RESET_TIMEOUT
+)
+
+# Two-tier caches; stale entries double as the last known good rows served
+# to logged-in users while the database is down
+# Users columns that may be cached. The password hash is left out so it is
+# never copied into the shared tier; login reads it with its own query.
+CACHED_USER_COLUMNS = ("u.user_id, u.username, u.email, u.full_name, u.profile_pic, u.role_id, "
+                       "u.is_active, u.risk_flagged_at, u.created_at, u.updated_at")
+
+user_cache = get_cache('users', ttl=Config.CACHE_USER_TTL)
+dashboard_cache = get_cache('dashboard', ttl=Config.CACHE_DASHBOARD_TTL)
+session_cache = get_cache('sessions', ttl=Config.CACHE_SESSIONS_TTL)
+
+def invalidate_users(user_ids):
+    """Drop cached user rows in every worker after the Users rows change."""
+    user_ids = [int(user_id) for user_id in user_ids]
+    user_cache.invalidate_many(user_ids)
+    dashboard_cache.invalidate_many(user_ids)
+
+# OperationalError codes meaning the database could not be reached or did not
+# answer in time: can't connect (2003), server gone away (2006), lost
+# connection, which is also how read/write timeouts surface (2013), and
+# out-of-sync packets on a broken connection (2055). Others, such as a
+# deadlock (1213) or a lock wait timeout (1205), come from a live server.
+CONNECTIVITY_ERRNOS = frozenset((2003, 2006, 2013, 2055))
+
+def is_connectivity_error(error):
+    """True if error means the database is unreachable rather than that a query failed."""
+    if isinstance(error, pymysql.err.InterfaceError):
+        return True
+    if isinstance(error, pymysql.err.OperationalError):
+        return bool(error.args) and error.args[0] in CONNECTIVITY_ERRNOS
+    return False
+
+def breaker_cursor(breaker):
+    """DictCursor class that reports the outcome of every query to breaker.
+    
+    Success is only recorded once a query has completed, so a server that
+    accepts connections but times out on queries still opens the breaker.
+    """
+    class BreakerCursor(pymysql.cursors.DictCursor):
+        def execute(self, query, args=None):
+            try:
+                result = super().execute(query, args)
+            except pymysql.err.Error as e:
+                if is_connectivity_error(e):
+                    breaker.record_failure()
+                    e.breaker_counted = True
+                else:
+                    # The server answered (e.g. a constraint error or deadlock), so it is reachable
+                    breaker.record_success()
+                raise
+            breaker.record_success()
+            return result
+    return BreakerCursor
+
+_MainCursor = breaker_cursor(breaker)
+
+def get_db_connection(database=True):
+    """Create and return a database connection, or None if unavailable."""
+    if not breaker.allow_request():
+        return None
+    
+    try:
+        connection = pymysql.connect(
+            host=Config.MYSQL_HOST,
+            user=Config.MYSQL_USER,
+            password=Config.MYSQL_PASSWORD,
+            database=Config.MYSQL_DB if database else None,
+            cursorclass=_MainCursor,
+            connect_timeout=Config.MYSQL_CONNECT_TIMEOUT,
+            read_timeout=Config.MYSQL_READ_TIMEOUT,
+            write_timeout=Config.MYSQL_WRITE_TIMEOUT
+        )
+        # Success is recorded by the cursor once a query completes
+        return connection
+    except Exception as e:
+        breaker.record_failure()
+        print(f"Database connection error: {e}")
+        return None
+
+def report_error(error):
+    """Count query-level connectivity errors (timeouts, lost connections) against the breaker.
+    
+    Errors raised by a query were already counted by its cursor; this
+    covers the rest, such as a failed commit.
+    """
+    if is_connectivity_error(error) and not getattr(error, 'breaker_counted', False):
+        breaker.record_failure()
+
+def is_degraded():
+    """True while the breaker is rejecting database calls."""
+    return breaker.state != CircuitBreaker.CLOSED
+
+def db_status():
+    """Breaker state plus degraded-mode cache sizes."""
+    status = breaker.snapshot()
+    status['degraded'] = is_degraded()
+    status['cached_users'] = len(user_cache)
+    status['cached_session_lists'] = len(session_cache)
+    return status
+
+def unavailable_message():
+    """User-facing message for a failed database connection."""
+    if is_degraded():
+        return 'The site is temporarily read-only while the database recovers. Please try again shortly.'
+    return 'Database connection error. Please try again.'
@@ -0,0 +1,372 @@
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from config import Config
+from models.audit_log import AuditEvent
+from utils.db import get_db_connection, report_error, invalidate_users, session_cache
+from utils.logging import INSERT_EVENT_SQL, encode_payload, outbox_event
+from utils.outbox import enqueue
+from utils.stats import record_activity
+from utils.search import user_index
+from utils.anomaly import login_monitor
+from utils.shards import connection_for_user, on_user_shards
+from utils.tokens import revoke_user_tokens
+
+DELETE_MODES = ('anonymize', 'cascade')
+
+# Each dependent table: (table, primary key). Rows are found by id and then
+# deleted or anonymized by id, which works the same on every shard backend.
+DEPENDENT_TABLES = (('Sessions', 'session_id'), ('AuditLogs', 'log_id'))
+
+def _worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'[:64]
+
+def queue_deletions(cursor, user_ids, requested_by, mode, requested_at):
+    """Deactivate users, revoke their tokens and queue them, inside the caller's transaction.
+    
+    Returns the ids that exist and were queued.
+    """
+    placeholders = ', '.join(['%s'] * len(user_ids))
+    cursor.execute(f"SELECT user_id FROM Users WHERE user_id IN ({placeholders}) FOR UPDATE", list(user_ids))
+    ids = [row['user_id'] for row in cursor.fetchall()]
+    if not ids:
+        return []
+    placeholders = ', '.join(['%s'] * len(ids))
+    cursor.execute(f"UPDATE Users SET is_active = FALSE WHERE user_id IN ({placeholders})", ids)
+    revoke_user_tokens(cursor, ids)
+    cursor.executemany("""
+        INSERT INTO AccountDeletions (user_id, requested_by, mode, requested_at)
+        VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE mode = VALUES(mode)
+    """, [(user_id, requested_by, mode, requested_at) for user_id in ids])
+    return ids
+
+def request_deletion(user_id, requested_by=None, mode='anonymize'):
+    """Deactivate a user and queue their account for background deletion.
+    
+    The user can no longer sign in once this commits; their rows and
+    uploads are removed later by process_deletions. The audit event is
+    written in the same transaction (on the requester's shard), before the
+    worker can delete anything. It names the user in target_id, which
+    survives anonymization. Returns True if queued, False if the user does
+    not exist or the database is unavailable.
+    """
+    if mode not in DELETE_MODES:
+        raise ValueError(f"Unknown delete mode: {mode}")
+    connection = get_db_connection()
+    if connection is None:
+        return False
+    
+    requested_at = datetime.now()
+    if requested_by == user_id:
+        # The user's own rows are purged, so the event has no actor
+        actor_id, event_type = None, AuditEvent.ACCOUNT_DELETED
+    else:
+        actor_id, event_type = requested_by, AuditEvent.USER_DELETED
+    
+    def insert_event(shard_cursor, _):
+        shard_cursor.execute(INSERT_EVENT_SQL, (actor_id, event_type, user_id, None, requested_at))
+        enqueue(shard_cursor, 'audit', requested_at,
+                **outbox_event(shard_cursor.lastrowid, actor_id, event_type, user_id, None))
+    
+    try:
+        with connection.cursor() as cursor:
+            if not queue_deletions(cursor, [user_id], requested_by, mode, requested_at):
+                connection.rollback()
+                connection.close()
+                return False
+            on_user_shards(cursor, [actor_id], insert_event)
+            record_activity(cursor, actor_id, requested_at)
+            connection.commit()
+        connection.close()
+    except Exception as e:
+        report_error(e)
+        print(f"Error queueing account deletion: {e}")
+        connection.close()
+        return False
+    
+    invalidate_users([user_id])
+    session_cache.invalidate(user_id)
+    user_index.remove(user_id)
+    login_monitor.forget(user_id)
+    return True
+
+def pending_deletions():
+    """Number of queued deletions, or None if the database is unavailable."""
+    connection = get_db_connection()
+    if connection is None:
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) AS count FROM AccountDeletions")
+            count = cursor.fetchone()['count']
+        connection.close()
+        return count
+    except Exception as e:
+        print(f"Error counting account deletions: {e}")
+        connection.close()
+        return None
+
+def failed_deletions():
+    """Number of jobs that reached DELETION_MAX_ATTEMPTS, or None if the database is unavailable."""
+    connection = get_db_connection()
+    if connection is None:
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) AS count FROM AccountDeletions WHERE attempts >= %s",
+                           (Config.DELETION_MAX_ATTEMPTS,))
+            count = cursor.fetchone()['count']
+        connection.close()
+        return count
+    except Exception as e:
+        print(f"Error counting failed account deletions: {e}")
+        connection.close()
+        return None
+
+def retry_failed_deletions():
+    """Give jobs that reached DELETION_MAX_ATTEMPTS another set of attempts. Returns the number reset."""
+    connection = get_db_connection()
+    if connection is None:
+        return None
+    try:
+        with connection.cursor() as cursor:
+            count = cursor.execute("""
+                UPDATE AccountDeletions SET attempts = 0, claimed_by = NULL, claimed_at = NULL
+                WHERE attempts >= %s
+            """, (Config.DELETION_MAX_ATTEMPTS,))
+        connection.commit()
+        connection.close()
+        return count
+    except Exception as e:
+        report_error(e)
+        print(f"Error resetting account deletions: {e}")
+        connection.close()
+        return None
+
+def _claim(connection, limit):
+    """Claim up to limit queued deletions for this worker.
+    
+    A claim is a lease: jobs whose claim is older than
+    DELETION_CLAIM_TIMEOUT (a crashed or failing worker) are picked up
+    again, which also spaces out retries. Jobs that have failed
+    DELETION_MAX_ATTEMPTS times are no longer claimed.
+    """
+    now = datetime.now()
+    stale_before = now - timedelta(seconds=Config.DELETION_CLAIM_TIMEOUT)
+    claimed = []
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT user_id, mode FROM AccountDeletions
+            WHERE (claimed_at IS NULL OR claimed_at < %s) AND attempts < %s
+            ORDER BY requested_at
+            LIMIT %s
+        """, (stale_before, Config.DELETION_MAX_ATTEMPTS, limit))
+        for job in cursor.fetchall():
+            # Only one worker's UPDATE can match while the old claim still applies
+            taken = cursor.execute("""
+                UPDATE AccountDeletions SET claimed_by = %s, claimed_at = %s, attempts = attempts + 1
+                WHERE user_id = %s AND (claimed_at IS NULL OR claimed_at < %s) AND attempts < %s
+            """, (_worker_name(), now, job['user_id'], stale_before, Config.DELETION_MAX_ATTEMPTS))
+            if taken:
+                claimed.append(job)
+        connection.commit()
+    return claimed
+
+def _purge_chunk(cursor, user_id, mode, chunk_size):
+    """Delete or anonymize one chunk of a user's dependent rows. Returns rows changed."""
+    changed = 0
+    for table, key in DEPENDENT_TABLES:
+        cursor.execute(f"SELECT {key} FROM {table} WHERE user_id = %s LIMIT %s", (user_id, chunk_size))
+        ids = [row[key] for row in cursor.fetchall()]
+        if not ids:
+            continue
+        placeholders = ', '.join(['%s'] * len(ids))
+        if table == 'AuditLogs' and mode == 'anonymize':
+            cursor.execute(f"UPDATE AuditLogs SET user_id = NULL WHERE log_id IN ({placeholders})", ids)
+        else:
+            cursor.execute(f"DELETE FROM {table} WHERE {key} IN ({placeholders})", ids)
+        changed += len(ids)
+    return changed
+
+def _purge_history(user_id, mode, chunk_size):
+    """Work through a user's sessions and audit rows one committed chunk at a time."""
+    connection = connection_for_user(user_id)
+    if connection is None:
+        raise RuntimeError('database unavailable')
+    try:
+        while True:
+            with connection.cursor() as cursor:
+                changed = _purge_chunk(cursor, user_id, mode, chunk_size)
+            connection.commit()
+            if not changed:
+                return
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+def remove_upload(filename):
+    """Delete a stored upload; missing files are ignored."""
+    if not filename:
+        return
+    try:
+        os.remove(os.path.join(Config.UPLOAD_FOLDER, os.path.basename(filename)))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Error removing upload {filename}: {e}")
+
+def _delete_account(connection, job, chunk_size):
+    user_id = job['user_id']
+    _purge_history(user_id, job['mode'], chunk_size)
+    
+    def purge_rest(shard_cursor, _):
+        while _purge_chunk(shard_cursor, user_id, job['mode'], chunk_size):
+            pass
+    
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT profile_pic FROM Users WHERE user_id = %s", (user_id,))
+        user = cursor.fetchone()
+        # Rows written since the chunked pass go in the same transaction as the user
+        on_user_shards(cursor, [user_id], purge_rest)
+        cursor.execute("DELETE FROM Users WHERE user_id = %s", (user_id,))
+        cursor.execute("DELETE FROM AccountDeletions WHERE user_id = %s", (user_id,))
+    connection.commit()
+    
+    if user:
+        remove_upload(user['profile_pic'])
+    invalidate_users([user_id])
+    session_cache.invalidate(user_id)
+
+def _record_error(connection, user_id, error):
+    """Roll back a failed job and store its last error.
+    
+    The database may be what failed, so this never raises.
+    """
+    try:
+        connection.rollback()
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE AccountDeletions SET last_error = %s WHERE user_id = %s",
+                           (str(error)[:255], user_id))
+        connection.commit()
+    except Exception as e:
+        report_error(e)
+        print(f"Error recording account deletion failure: {e}")
+
+def process_deletions(limit=10, chunk_size=None):
+    """Run queued account deletions. Returns the number completed, or -1 if the database is unavailable."""
+    chunk_size = chunk_size or Config.DELETION_CHUNK_SIZE
+    connection = get_db_connection()
+    if connection is None:
+        return -1
+    
+    try:
+        jobs = _claim(connection, limit)
+    except Exception as e:
+        report_error(e)
+        print(f"Error claiming account deletions: {e}")
+        connection.close()
+        return -1
+    
+    completed = 0
+    try:
+        for job in jobs:
+            try:
+                _delete_account(connection, job, chunk_size)
+                completed += 1
+            except Exception as e:
+                report_error(e)
+                print(f"Error deleting account {job['user_id']}: {e}")
+                # The claim stays in place, so the job is retried once it expires
+                _record_error(connection, job['user_id'], e)
+    finally:
+        connection.close()
+    return completed
+
+def _referenced_uploads(cursor, names):
+    placeholders = ', '.join(['%s'] * len(names))
+    cursor.execute(f"SELECT profile_pic FROM Users WHERE profile_pic IN ({placeholders})", names)
+    return {row['profile_pic'] for row in cursor.fetchall()}
+
+def collect_orphaned_uploads(min_age=None, dry_run=False, batch_size=1000):
+    """Remove uploads that no user's profile_pic refers to.
+    
+    The directory is walked once with scandir (no per-file stat calls
+    beyond what scandir caches), and candidates are checked against Users
+    in batches. Files younger than min_age seconds are skipped so that an
+    upload saved just before its UPDATE commits is not collected.
+    Returns (files_removed, bytes_freed), or None if the database is
+    unavailable.
+    """
+    min_age = Config.UPLOAD_GC_MIN_AGE if min_age is None else min_age
+    cutoff = time.time() - min_age
+    connection = get_db_connection()
+    if connection is None:
+        return None
+    
+    removed, freed = 0, 0
+    try:
+        batch = {}
+        with os.scandir(Config.UPLOAD_FOLDER) as entries, connection.cursor() as cursor:
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.is_file(follow_symlinks=False):
+                    continue
+                info = entry.stat(follow_symlinks=False)
+                if info.st_mtime > cutoff:
+                    continue
+                batch[entry.name] = info.st_size
+                if len(batch) >= batch_size:
+                    removed, freed = _sweep(cursor, batch, dry_run, removed, freed)
+                    batch = {}
+            if batch:
+                removed, freed = _sweep(cursor, batch, dry_run, removed, freed)
+        connection.close()
+        return removed, freed
+    except FileNotFoundError:
+        connection.close()
+        return removed, freed
+    except Exception as e:
+        report_error(e)
+        print(f"Error collecting orphaned uploads: {e}")
+        connection.close()
+        return None
+
+def _sweep(cursor, batch, dry_run, removed, freed):
+    referenced = _referenced_uploads(cursor, list(batch))
+    for name, size in batch.items():
+        if name in referenced:
+            continue
+        if not dry_run:
+            remove_upload(name)
+        removed += 1
+        freed += size
+    return removed, freed
+
+def _deletion_loop():
+    last_gc = time.monotonic()
+    while True:
+        time.sleep(Config.DELETION_POLL_INTERVAL)
+        # Nothing may end this thread, or queued deletions stop until the worker restarts
+        try:
+            while process_deletions() > 0:
+                pass
+            if time.monotonic() - last_gc >= Config.UPLOAD_GC_INTERVAL:
+                last_gc = time.monotonic()
+                collect_orphaned_uploads()
+        except Exception as e:
+            report_error(e)
+            print(f"Error in account deletion worker: {e}")
+
+_deletion_pid = None
+
+def init_deletion_worker():
+    """Start the background deletion and upload GC thread once per process."""
+    global _deletion_pid
+    if not Config.DELETION_WORKER or _deletion_pid == os.getpid():
+        return
+    _deletion_pid = os.getpid()
+    threading.Thread(target=_deletion_loop, name='account-deletions', daemon=True).start()
@@ -0,0 +1,63 @@
+import threading
+from config import Config
+from utils.outbox import SegmentReader, outbox_dir
+from utils.shards import shard_count
+
+# Live log streams each hold a server thread, so each worker serves only a few
+stream_slots = threading.BoundedSemaphore(Config.LOG_STREAM_MAX_PER_WORKER)
+
+class LiveFeed:
+    """Audit and session events for the admin live tail, read from the outbox segments.
+    
+    The relay (`flask admin relay-outbox --follow`) writes every worker's
+    events to one segment log per shard, so a feed sees all of them. Its
+    position is the byte offset in each shard's log; the event ids sent to
+    clients carry every offset, so a client resumes correctly on any
+    worker.
+    """
+    
+    def __init__(self, last_event_id=None):
+        self.readers = [SegmentReader(outbox_dir(shard)) for shard in range(shard_count())]
+        self.offsets = self._parse(last_event_id)
+        if self.offsets is None:
+            # New subscribers only see events from now on
+            self.offsets = [reader.end_offset() for reader in self.readers]
+    
+    def _parse(self, last_event_id):
+        """Offsets from a client's Last-Event-ID, or None if missing or from another shard layout."""
+        if not last_event_id:
+            return None
+        try:
+            offsets = [int(part) for part in last_event_id.split('.')]
+        except ValueError:
+            return None
+        return offsets if len(offsets) == len(self.readers) else None
+    
+    def read(self, max_records=100):
+        """New events as (event_id, event) pairs, each event a {'type', 'data'} dict."""
+        events = []
+        for shard, reader in enumerate(self.readers):
+            records, next_offset = reader.read(self.offsets[shard], max_records)
+            for i, record in enumerate(records):
+                self.offsets[shard] = records[i + 1]['offset'] if i + 1 < len(records) else next_offset
+                events.append(('.'.join(map(str, self.offsets)), _event(record)))
+        return events
+
+def _event(record):
+    """The live-tail form of an outbox record: its time goes in the field the page shows."""
+    data = dict(record['data'])
+    if record['kind'] == 'audit':
+        data['action_time'] = record['time']
+    elif record['kind'] == 'session':
+        data.update(login_time=record['time'], logout_time=None)
+    elif record['kind'] == 'session_end':
+        data['logout_time'] = record['time']
+    return {'type': record['kind'], 'data': data}
+
+def matches_filter(event, types=None, user_id=None):
+    """Check an event against a subscriber's filters."""
+    if types and event['type'] not in types:
+        return False
+    if user_id is not None and event['data'].get('user_id') != user_id:
+        return False
+    return True
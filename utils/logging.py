@@ -1,52 +1,365 @@
 from config import Config
-import pymysql
 from datetime import datetime
+import json
+import glob
+import os
+import threading
+import time
+from models.audit_log import AuditEvent
+from utils.db import report_error
+from utils.outbox import enqueue, enqueue_many
+from utils.shards import (shard_for, shard_count, get_shard_connection, connection_for_user, on_main,
+                          scatter, merge_newest, attach_usernames, INTEGRITY_ERRORS)
+from utils.stats import record_activity, record_activity_many, record_failed_login
+from utils.rollups import record_metric
 
-def create_audit_log(user_id, action):
-    """Create an audit log entry in the database."""
-    try:
-        connection = pymysql.connect(
-            host=Config.MYSQL_HOST,
-            user=Config.MYSQL_USER,
-            password=Config.MYSQL_PASSWORD,
-            database=Config.MYSQL_DB,
-            cursorclass=pymysql.cursors.DictCursor
-        )
+INSERT_EVENT_SQL = """INSERT INTO AuditLogs (user_id, event_type, target_id, payload, action_time) 
+                      VALUES (%s, %s, %s, %s, %s)"""
+
+_spool_lock = threading.Lock()
+_replay_lock = threading.Lock()
+_last_replay = None
+
+def encode_payload(payload):
+    """Compact JSON for the payload column."""
+    return json.dumps(payload, separators=(',', ':')) if payload else None
+
+def outbox_event(log_id, actor_id, event_type, target_id, payload):
+    """Outbox body for an audit event (the fields a downstream consumer needs)."""
+    return {
+        'log_id': log_id,
+        'user_id': actor_id,
+        'event_type': AuditEvent.NAMES.get(event_type, 'other'),
+        'event_code': event_type,
+        'target_id': target_id,
+        'payload': payload,
+        'action': AuditEvent.describe(event_type, target_id, payload)
+    }
+
+def _spool_audit_log(row):
+    """Append an audit entry to the local spool while the database is unavailable."""
+    try:
+        with _spool_lock:
+            spool_dir = os.path.dirname(Config.AUDIT_SPOOL_FILE)
+            if spool_dir:
+                os.makedirs(spool_dir, exist_ok=True)
+            with open(Config.AUDIT_SPOOL_FILE, 'a') as f:
+                f.write(json.dumps(row) + '\n')
+        return True
+    except Exception as e:
+        print(f"Error spooling audit log: {e}")
+        return False
+
+def _spooled_row(row):
+    # Spools written before structured events only carry the action text
+    if 'event_type' not in row:
+        event_type, target_id, payload = AuditEvent.parse_legacy(row['action'])
+        row = dict(row, event_type=event_type, target_id=target_id, payload=payload)
+    return row
+
+def _append_rows(path, rows):
+    with _spool_lock:
+        with open(path, 'a') as f:
+            for row in rows:
+                f.write(json.dumps(row) + '\n')
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _claim_replay_files():
+    """Move the spool (and batches left by dead workers) to this process's own replay files."""
+    prefix = Config.AUDIT_SPOOL_FILE + '.replay.'
+    claimed = []
+    for path in glob.glob(prefix + '*'):
+        owner = path[len(prefix):].split('.', 1)[0]
+        if owner.isdigit() and int(owner) != os.getpid() and _pid_alive(int(owner)):
+            continue
+        target = f'{prefix}{os.getpid()}.{len(claimed)}.{time.time_ns()}'
+        try:
+            os.replace(path, target)
+            claimed.append(target)
+        except FileNotFoundError:
+            pass  # another worker adopted it first
+    try:
+        # Atomic rename so only one worker replays a given batch
+        target = f'{prefix}{os.getpid()}.{len(claimed)}.{time.time_ns()}'
+        os.replace(Config.AUDIT_SPOOL_FILE, target)
+        claimed.append(target)
+    except FileNotFoundError:
+        pass
+    return claimed
+
+def replay_audit_spool(force=False):
+    """Write spooled audit entries to the database. Returns the number replayed.
+    
+    Runs at most once per AUDIT_SPOOL_REPLAY_INTERVAL per worker unless
+    forced. Entries that fail for a transient reason go back to the spool;
+    entries the database rejects outright (e.g. a foreign key to a user
+    that no longer exists) are moved to AUDIT_SPOOL_FILE.rejected instead
+    of being retried forever.
+    """
+    global _last_replay
+    if not _replay_lock.acquire(blocking=False):
+        return 0
+    try:
+        if not force and _last_replay is not None and \
+                time.monotonic() - _last_replay < Config.AUDIT_SPOOL_REPLAY_INTERVAL:
+            return 0
+        _last_replay = time.monotonic()
+        
+        replayed = 0
+        for replay_file in _claim_replay_files():
+            with open(replay_file) as f:
+                rows = [_spooled_row(json.loads(line)) for line in f if line.strip()]
+            
+            failed = []
+            for index, shard_rows in _group_rows_by_shard(rows).items():
+                written, retry = _replay_rows(index, shard_rows)
+                replayed += written
+                failed.extend(retry)
+            
+            if failed:
+                # Put these back so nothing is lost
+                _append_rows(Config.AUDIT_SPOOL_FILE, failed)
+            try:
+                os.remove(replay_file)
+            except FileNotFoundError:
+                pass
+        return replayed
+    finally:
+        _replay_lock.release()
+
+def _group_rows_by_shard(rows):
+    groups = {}
+    for row in rows:
+        groups.setdefault(shard_for(row['user_id']), []).append(row)
+    return groups
+
+def _insert_spooled(connection, rows):
+    with connection.cursor() as cursor:
+        values = [(row['user_id'], row['event_type'], row['target_id'], encode_payload(row['payload']),
+                   datetime.fromisoformat(row['action_time'])) for row in rows]
+        cursor.executemany(INSERT_EVENT_SQL, values)
+        enqueue_many(cursor, [
+            ('audit', value[4], outbox_event(None, row['user_id'], row['event_type'], row['target_id'], row['payload']))
+            for row, value in zip(rows, values)
+        ])
+        
+        def update_stats(main):
+            record_activity_many(main, [(value[0], value[4]) for value in values])
+            # As in log_event; failed logins spooled during an outage still count
+            for value in values:
+                if value[1] == AuditEvent.LOGIN_FAILED and value[0] is not None:
+                    record_failed_login(main, value[0], value[4])
+        on_main(cursor, update_stats)
+    connection.commit()
+
+def _replay_rows(index, rows):
+    """Write one shard's spooled entries. Returns (rows written, rows to spool again).
+    
+    The batch goes in one transaction. If the database rejects it, the
+    rows are retried one by one so a single bad row cannot hold back the
+    rest; rejected rows are quarantined.
+    """
+    connection = get_shard_connection(index)
+    if connection is None:
+        return 0, rows
+    
+    pending = list(rows)
+    written = 0
+    try:
+        try:
+            _insert_spooled(connection, pending)
+            return len(pending), []
+        except INTEGRITY_ERRORS:
+            connection.rollback()
         
+        while pending:
+            try:
+                _insert_spooled(connection, pending[:1])
+                written += 1
+            except INTEGRITY_ERRORS as e:
+                connection.rollback()
+                print(f"Rejected spooled audit entry: {e}")
+                _append_rows(Config.AUDIT_SPOOL_FILE + '.rejected', [dict(pending[0], error=str(e))])
+            pending.pop(0)
+        return written, []
+    except Exception as e:
+        report_error(e)
+        print(f"Error replaying audit spool: {e}")
+        return written, pending
+    finally:
+        connection.close()
+
+def log_event(actor_id, event_type, target_id=None, payload=None):
+    """Record a structured audit event.
+    
+    actor_id is the user who acted (stored in AuditLogs.user_id), target_id
+    the user acted upon, and payload a small dict of extra fields.
+    """
+    action_time = datetime.now()
+    if event_type == AuditEvent.LOGIN_FAILED:
+        record_metric('failures', actor_id)
+    
+    def update_stats(main):
+        # Keep the per-user summary current (same transaction unless sharded)
+        record_activity(main, actor_id, action_time)
+        if event_type == AuditEvent.LOGIN_FAILED and actor_id is not None:
+            record_failed_login(main, actor_id, action_time)
+    
+    connection = connection_for_user(actor_id)
+    if connection is None:
+        return _spool_audit_log({
+            'user_id': actor_id,
+            'event_type': event_type,
+            'target_id': target_id,
+            'payload': payload,
+            'action_time': action_time.isoformat()
+        })
+    
+    try:
         with connection.cursor() as cursor:
-            sql = "INSERT INTO AuditLogs (user_id, action, action_time) VALUES (%s, %s, %s)"
-            cursor.execute(sql, (user_id, action, datetime.now()))
+            cursor.execute(INSERT_EVENT_SQL, (actor_id, event_type, target_id, encode_payload(payload), action_time))
+            log_id = cursor.lastrowid
+            enqueue(cursor, 'audit', action_time, **outbox_event(log_id, actor_id, event_type, target_id, payload))
+            on_main(cursor, update_stats)
             connection.commit()
         
         connection.close()
-        return True
     except Exception as e:
+        report_error(e)
         print(f"Error creating audit log: {e}")
-        return False
+        connection.close()
+        return _spool_audit_log({
+            'user_id': actor_id,
+            'event_type': event_type,
+            'target_id': target_id,
+            'payload': payload,
+            'action_time': action_time.isoformat()
+        })
+    
+    # The database is reachable again; flush anything spooled during the outage
+    # (throttled, and also adopts batches left behind by workers that died)
+    replay_audit_spool()
+    return True
+
+def create_audit_log(user_id, action):
+    """Create an audit log entry from free text (kept for older callers; prefer log_event)."""
+    event_type, target_id, payload = AuditEvent.parse_legacy(action)
+    return log_event(user_id, event_type, target_id, payload)
 
-def get_audit_logs(limit=100):
-    """Retrieve recent audit logs."""
+def describe_rows(rows):
+    """Fill in the display text for structured rows (action is NULL for them)."""
+    for row in rows:
+        if not row.get('action'):
+            row['action'] = AuditEvent.describe(row.get('event_type'), row.get('target_id'), row.get('payload'))
+    return rows
+
+def get_audit_logs(limit=100, event_type=None, target_id=None):
+    """Retrieve recent audit logs, optionally filtered by event type or target user.
+    
+    Every shard is queried in parallel and the results are merged by time.
+    """
+    conditions = []
+    args = []
+    if event_type is not None:
+        conditions.append("event_type = %s")
+        args.append(event_type)
+    if target_id is not None:
+        conditions.append("target_id = %s")
+        args.append(target_id)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    
+    results = scatter(f"""SELECT * FROM AuditLogs 
+                          {where} 
+                          ORDER BY action_time DESC 
+                          LIMIT %s""", args + [limit])
+    return describe_rows(attach_usernames(merge_newest(results, 'action_time', limit)))
+
+def get_user_audit_logs(user_id, limit=20):
+    """A user's own audit history, read from their shard only."""
+    connection = connection_for_user(user_id)
+    if connection is None:
+        return []
+    
     try:
-        connection = pymysql.connect(
-            host=Config.MYSQL_HOST,
-            user=Config.MYSQL_USER,
-            password=Config.MYSQL_PASSWORD,
-            database=Config.MYSQL_DB,
-            cursorclass=pymysql.cursors.DictCursor
-        )
-        
         with connection.cursor() as cursor:
-            sql = """SELECT al.*, u.username 
-                     FROM AuditLogs al 
-                     LEFT JOIN Users u ON al.user_id = u.user_id 
-                     ORDER BY al.action_time DESC 
-                     LIMIT %s"""
-            cursor.execute(sql, (limit,))
+            cursor.execute("""
+                SELECT * FROM AuditLogs 
+                WHERE user_id = %s 
+                ORDER BY action_time DESC 
+                LIMIT %s
+            """, (user_id, limit))
             results = cursor.fetchall()
         
         connection.close()
-        return results
+        return describe_rows(results)
     except Exception as e:
-        print(f"Error getting audit logs: {e}")
+        report_error(e)
+        print(f"Error getting user audit logs: {e}")
+        connection.close()
         return []
 
+def backfill_audit_events(batch_size=5000):
+    """Convert legacy free-text rows to structured events in keyset batches.
+    
+    Each batch is read by log_id range and updated in its own transaction,
+    so the table is never locked for long. Returns the number converted.
+    """
+    converted = 0
+    for index in range(shard_count()):
+        count = _backfill_shard_events(index, batch_size)
+        if count < 0:
+            return -1
+        converted += count
+    return converted
+
+def _backfill_shard_events(index, batch_size):
+    connection = get_shard_connection(index)
+    if connection is None:
+        return -1
+    
+    converted = 0
+    last_id = 0
+    try:
+        while True:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    SELECT log_id, action FROM AuditLogs 
+                    WHERE log_id > %s AND event_type = %s AND action IS NOT NULL 
+                    ORDER BY log_id 
+                    LIMIT %s
+                """, (last_id, AuditEvent.OTHER, batch_size))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1]['log_id']
+                
+                updates = []
+                for row in rows:
+                    event_type, target_id, payload = AuditEvent.parse_legacy(row['action'])
+                    if event_type != AuditEvent.OTHER:
+                        updates.append((event_type, target_id, encode_payload(payload), row['log_id']))
+                if updates:
+                    # The text is now derived from the event, so drop the repeated copy
+                    cursor.executemany("""
+                        UPDATE AuditLogs 
+                        SET event_type = %s, target_id = %s, payload = %s, action = NULL 
+                        WHERE log_id = %s
+                    """, updates)
+            connection.commit()
+            converted += len(updates)
+        connection.close()
+        return converted
+    except Exception as e:
+        connection.rollback()
+        report_error(e)
+        print(f"Error backfilling audit events: {e}")
+        connection.close()
+        return -1
@@ -0,0 +1,371 @@
+import bisect
+import fcntl
+import json
+import mmap
+import os
+import struct
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+from config import Config
+from utils.db import report_error
+from utils.shards import get_shard_connection, is_sharded, shard_count
+
+INSERT_OUTBOX_SQL = "INSERT INTO AuditOutbox (kind, body, created_at) VALUES (%s, %s, %s)"
+
+# Each record is framed as <length><crc32> followed by the JSON body
+FRAME_HEADER = struct.Struct('>II')
+# Index entries are <highest event id before this offset><byte offset>
+INDEX_ENTRY = struct.Struct('>QQ')
+
+SEGMENT_SUFFIX = '.log'
+INDEX_SUFFIX = '.index'
+
+class RelayLockedError(Exception):
+    """Raised when another relay process already writes a segment directory."""
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+def encode_body(data):
+    return json.dumps(data, separators=(',', ':'), default=_json_default)
+
+def enqueue(cursor, kind, created_at, **data):
+    """Add an event to the outbox inside the caller's transaction."""
+    cursor.execute(INSERT_OUTBOX_SQL, (kind, encode_body(data), created_at))
+
+def enqueue_many(cursor, events):
+    """Add several (kind, created_at, data) events inside the caller's transaction."""
+    if events:
+        cursor.executemany(INSERT_OUTBOX_SQL, [(kind, encode_body(data), created_at)
+                                               for kind, created_at, data in events])
+
+def _segment_path(directory, base, suffix=SEGMENT_SUFFIX):
+    return os.path.join(directory, f'{base:020d}{suffix}')
+
+def list_segments(directory):
+    """Base offsets of the segments in directory, oldest first."""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in names
+                  if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+
+def _scan(buf, start=0):
+    """Yield (position, body) for each complete, intact frame in buf."""
+    position = start
+    size = len(buf)
+    while position + FRAME_HEADER.size <= size:
+        length, checksum = FRAME_HEADER.unpack_from(buf, position)
+        end = position + FRAME_HEADER.size + length
+        if end > size:
+            return  # partially written record at the tail
+        body = buf[position + FRAME_HEADER.size:end]
+        if zlib.crc32(body) != checksum:
+            print(f"Error reading audit segment: checksum mismatch at byte {position}")
+            return
+        yield position, body
+        position = end
+
+class SegmentWriter:
+    """Appends framed records to rotating segment files.
+    
+    Offsets are byte positions in the concatenated log: a segment is named
+    after the offset of its first byte, so a reader can find any offset
+    from the file names alone. Only one writer may append to a directory:
+    it holds an exclusive flock on the directory until closed.
+    """
+    
+    def __init__(self, directory, segment_bytes, index_interval, recent_size=10000):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.recent_size = recent_size
+        self._recent = OrderedDict()
+        self.max_id = 0
+        os.makedirs(directory, exist_ok=True)
+        self._lock_fd = os.open(directory, os.O_RDONLY)
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self._lock_fd)
+            raise RelayLockedError(f'{directory} is locked by another relay process')
+        self._recover()
+    
+    def _recover(self):
+        """Open the newest segment, dropping any torn record left by a crash."""
+        bases = list_segments(self.directory)
+        if not bases:
+            self._open(0)
+            return
+        
+        # The newest segment may be empty if we crashed right after rolling
+        for base in reversed(bases):
+            with open(_segment_path(self.directory, base), 'rb') as f:
+                data = f.read()
+            end = 0
+            for position, body in _scan(data):
+                record = json.loads(body)
+                self._remember(record['id'])
+                end = position + FRAME_HEADER.size + len(body)
+            if end or base == bases[0]:
+                break
+        
+        tail = bases[-1]
+        with open(_segment_path(self.directory, tail), 'rb') as f:
+            tail_end = sum(FRAME_HEADER.size + len(body) for _, body in _scan(f.read()))
+        try:
+            with open(_segment_path(self.directory, tail, INDEX_SUFFIX), 'rb') as f:
+                data = f.read()
+            if len(data) >= INDEX_ENTRY.size:
+                start = (len(data) // INDEX_ENTRY.size - 1) * INDEX_ENTRY.size
+                self.max_id = max(self.max_id, INDEX_ENTRY.unpack_from(data, start)[0])
+        except FileNotFoundError:
+            pass
+        self._open(tail, truncate_at=tail_end)
+    
+    def _open(self, base, truncate_at=None):
+        self.base = base
+        self._log = open(_segment_path(self.directory, base), 'ab')
+        if truncate_at is not None:
+            self._log.truncate(truncate_at)
+        self.position = os.fstat(self._log.fileno()).st_size
+        self._index = open(_segment_path(self.directory, base, INDEX_SUFFIX), 'ab')
+        self._last_indexed = None
+        if self.position == 0:
+            self._write_index(0)
+        else:
+            self._last_indexed = self.position
+    
+    def _write_index(self, position):
+        self._index.write(INDEX_ENTRY.pack(self.max_id, self.base + position))
+        self._last_indexed = position
+    
+    def _remember(self, outbox_id):
+        self.max_id = max(self.max_id, outbox_id)
+        self._recent[outbox_id] = True
+        if len(self._recent) > self.recent_size:
+            self._recent.popitem(last=False)
+    
+    def already_written(self, outbox_id):
+        """True if this event made it into a segment before the outbox row was deleted."""
+        return outbox_id in self._recent
+    
+    @property
+    def end_offset(self):
+        return self.base + self.position
+    
+    def _roll(self):
+        self._sync()
+        self._log.close()
+        self._index.close()
+        self._open(self.end_offset)
+        self._apply_retention()
+    
+    def _apply_retention(self):
+        keep = Config.OUTBOX_RETAIN_SEGMENTS
+        if keep <= 0:
+            return
+        for base in list_segments(self.directory)[:-keep]:
+            for suffix in (SEGMENT_SUFFIX, INDEX_SUFFIX):
+                try:
+                    os.remove(_segment_path(self.directory, base, suffix))
+                except FileNotFoundError:
+                    pass
+    
+    def append(self, records):
+        """Append records (dicts with an 'id') and fsync. Returns the new end offset."""
+        for record in records:
+            body = encode_body(record).encode('utf-8')
+            frame = FRAME_HEADER.pack(len(body), zlib.crc32(body)) + body
+            if self.position and self.position + len(frame) > self.segment_bytes:
+                self._roll()
+            if self.position - self._last_indexed >= self.index_interval:
+                self._write_index(self.position)
+            self._log.write(frame)
+            self.position += len(frame)
+            self._remember(record['id'])
+        self._sync()
+        return self.end_offset
+    
+    def _sync(self):
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        self._index.flush()
+        os.fsync(self._index.fileno())
+    
+    def close(self):
+        self._sync()
+        self._log.close()
+        self._index.close()
+        os.close(self._lock_fd)
+
+class SegmentReader:
+    """Reads records from segment files with memory-mapped access."""
+    
+    def __init__(self, directory):
+        self.directory = directory
+    
+    def read(self, offset, max_records=1000):
+        """Read up to max_records starting at a byte offset.
+        
+        Returns (records, next_offset); each record carries its own
+        'offset'. An offset that has been removed by retention starts at
+        the oldest remaining segment.
+        """
+        bases = list_segments(self.directory)
+        if not bases:
+            return [], offset
+        index = bisect.bisect_right(bases, offset) - 1
+        if index < 0:
+            index, offset = 0, bases[0]
+        
+        records = []
+        while index < len(bases) and len(records) < max_records:
+            base = bases[index]
+            path = _segment_path(self.directory, base)
+            size = os.path.getsize(path)
+            if size > offset - base:
+                with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    for position, body in _scan(mm, offset - base):
+                        record = json.loads(body)
+                        record['offset'] = base + position
+                        records.append(record)
+                        offset = base + position + FRAME_HEADER.size + len(body)
+                        if len(records) >= max_records:
+                            break
+            if index + 1 < len(bases) and offset - base >= size:
+                index += 1
+                offset = bases[index]
+            else:
+                break
+        return records, offset
+    
+    def end_offset(self):
+        """Offset just past the last complete record, where a reader sees only new events.
+        
+        Scans from the newest segment's last index entry, so at most
+        index_interval bytes are read.
+        """
+        bases = list_segments(self.directory)
+        if not bases:
+            return 0
+        offset = bases[-1]
+        try:
+            with open(_segment_path(self.directory, bases[-1], INDEX_SUFFIX), 'rb') as f:
+                data = f.read()
+            if len(data) >= INDEX_ENTRY.size:
+                start = (len(data) // INDEX_ENTRY.size - 1) * INDEX_ENTRY.size
+                offset = INDEX_ENTRY.unpack_from(data, start)[1]
+        except FileNotFoundError:
+            pass
+        while True:
+            records, offset = self.read(offset)
+            if not records:
+                return offset
+    
+    def offset_for_id(self, outbox_id):
+        """Byte offset from which every event with id >= outbox_id will be read.
+        
+        Index entries record the highest id written before their offset,
+        so this stays correct even though events from concurrent
+        transactions can reach the log slightly out of id order.
+        """
+        best = None
+        for base in list_segments(self.directory):
+            try:
+                with open(_segment_path(self.directory, base, INDEX_SUFFIX), 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            for max_before, offset in INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size]):
+                if max_before >= outbox_id:
+                    return best if best is not None else base
+                best = offset
+        return best if best is not None else 0
+    
+    def tail(self, offset, poll_interval=1.0, follow=True):
+        """Yield records from offset onwards, waiting for new ones if follow is set."""
+        while True:
+            records, offset = self.read(offset)
+            for record in records:
+                yield record
+            if not records:
+                if not follow:
+                    return
+                time.sleep(poll_interval)
+
+def outbox_dir(shard=0):
+    """Segment directory for a shard's outbox (each shard has its own log)."""
+    if not is_sharded():
+        return Config.OUTBOX_DIR
+    return os.path.join(Config.OUTBOX_DIR, f'shard{shard}')
+
+def relay_batch(writer, shard=0, batch_size=None):
+    """Move one batch of a shard's outbox rows into its segment log.
+    
+    Rows are appended and fsynced before they are deleted, and deleted by
+    id so the delete never touches more than one batch. Returns the number
+    of rows relayed, or -1 if the database is unavailable.
+    """
+    batch_size = batch_size or Config.OUTBOX_BATCH_SIZE
+    connection = get_shard_connection(shard)
+    if connection is None:
+        return -1
+    
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT outbox_id, kind, body, created_at FROM AuditOutbox
+                ORDER BY outbox_id
+                LIMIT %s
+            """, (batch_size,))
+            rows = cursor.fetchall()
+            if rows:
+                # Rows written before a crash but not yet deleted are skipped
+                writer.append([
+                    {'id': row['outbox_id'], 'kind': row['kind'], 'time': row['created_at'],
+                     'data': json.loads(row['body'])}
+                    for row in rows if not writer.already_written(row['outbox_id'])
+                ])
+                
+                ids = [row['outbox_id'] for row in rows]
+                placeholders = ', '.join(['%s'] * len(ids))
+                cursor.execute(f"DELETE FROM AuditOutbox WHERE outbox_id IN ({placeholders})", ids)
+                connection.commit()
+        
+        connection.close()
+        return len(rows)
+    except Exception as e:
+        report_error(e)
+        print(f"Error relaying audit outbox: {e}")
+        connection.close()
+        return -1
+
+def run_relay(follow=False):
+    """Drain every shard's outbox into segment files; keep polling if follow is set.
+    
+    Raises RelayLockedError if another relay is already running.
+    """
+    writers = []
+    relayed = 0
+    try:
+        for shard in range(shard_count()):
+            writers.append(SegmentWriter(outbox_dir(shard), Config.OUTBOX_SEGMENT_BYTES,
+                                         Config.OUTBOX_INDEX_INTERVAL))
+        while True:
+            counts = [relay_batch(writer, shard) for shard, writer in enumerate(writers)]
+            if any(count > 0 for count in counts):
+                relayed += sum(count for count in counts if count > 0)
+                continue
+            if not follow:
+                break
+            time.sleep(Config.OUTBOX_POLL_INTERVAL)
+    finally:
+        for writer in writers:
+            writer.close()
+    return relayed
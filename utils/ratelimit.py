@@ -0,0 +1,39 @@
+import threading
+import time
+from collections import OrderedDict
+
+class AttemptLimiter:
+    """Counts failed attempts per key in fixed windows (per worker, in memory).
+    
+    Keys are typically client IPs. The oldest keys are dropped beyond
+    maxsize, so a flood of distinct keys cannot grow memory without bound.
+    """
+    
+    def __init__(self, limit, window, maxsize=100000):
+        self.limit = limit
+        self.window = window
+        self.maxsize = maxsize
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _current(self, key, now):
+        entry = self._windows.get(key)
+        if entry is None or now - entry[0] >= self.window:
+            return None
+        return entry
+    
+    def blocked(self, key):
+        """True if key has used up its attempts for the current window."""
+        with self._lock:
+            entry = self._current(key, time.monotonic())
+            return entry is not None and entry[1] >= self.limit
+    
+    def hit(self, key):
+        """Record a failed attempt for key."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._current(key, now)
+            self._windows[key] = (now, 1) if entry is None else (entry[0], entry[1] + 1)
+            self._windows.move_to_end(key)
+            while len(self._windows) > self.maxsize:
+                self._windows.popitem(last=False)
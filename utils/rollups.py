@@ -0,0 +1,246 @@
+import atexit
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from config import Config
+from utils.db import get_db_connection, report_error
+from utils.hll import HyperLogLog
+
+METRICS = ('logins', 'failures', 'registrations')
+RESOLUTIONS = ('minute', 'hour', 'day')
+
+def truncate(moment, resolution):
+    """Start of the bucket containing moment."""
+    if resolution == 'minute':
+        return moment.replace(second=0, microsecond=0)
+    if resolution == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+class _Bucket:
+    __slots__ = ('logins', 'failures', 'registrations', 'users')
+    
+    def __init__(self):
+        self.logins = 0
+        self.failures = 0
+        self.registrations = 0
+        self.users = HyperLogLog()
+
+class RollupBuffer:
+    """Per-minute counters for recent activity, flushed to ActivityRollups.
+    
+    The buffer is a small ring of minute buckets; if the database is down
+    the oldest unflushed minutes are dropped once the ring is full.
+    """
+    
+    def __init__(self, max_minutes=60):
+        self.max_minutes = max_minutes
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def record(self, metric, user_id=None, when=None):
+        """Count one login, failure or registration."""
+        minute = truncate(when or datetime.now(), 'minute')
+        with self._lock:
+            bucket = self._buckets.get(minute)
+            if bucket is None:
+                bucket = self._buckets[minute] = _Bucket()
+                while len(self._buckets) > self.max_minutes:
+                    del self._buckets[min(self._buckets)]
+            setattr(bucket, metric, getattr(bucket, metric) + 1)
+            if metric == 'logins' and user_id is not None:
+                bucket.users.add(user_id)
+    
+    def _take(self, include_current):
+        current = truncate(datetime.now(), 'minute')
+        with self._lock:
+            ready = [minute for minute in self._buckets if include_current or minute < current]
+            return [(minute, self._buckets.pop(minute)) for minute in ready]
+    
+    def _put_back(self, items):
+        with self._lock:
+            for minute, bucket in items:
+                existing = self._buckets.get(minute)
+                if existing is None:
+                    self._buckets[minute] = bucket
+                else:
+                    for metric in METRICS:
+                        setattr(existing, metric, getattr(existing, metric) + getattr(bucket, metric))
+                    existing.users.merge(bucket.users)
+            self._buckets = OrderedDict(sorted(self._buckets.items()))
+            while len(self._buckets) > self.max_minutes:
+                self._buckets.popitem(last=False)
+    
+    def flush(self, include_current=False):
+        """Write finished minute buckets to the database. Returns the number written.
+        
+        Each minute is added to its minute, hour and day rows, so every
+        resolution is complete as soon as the flush commits.
+        """
+        items = self._take(include_current)
+        if not items:
+            return 0
+        connection = get_db_connection()
+        if connection is None:
+            self._put_back(items)
+            return 0
+        
+        rows = {}
+        for minute, bucket in items:
+            for resolution in RESOLUTIONS:
+                totals = rows.setdefault((resolution, truncate(minute, resolution)), _Bucket())
+                for metric in METRICS:
+                    setattr(totals, metric, getattr(totals, metric) + getattr(bucket, metric))
+                totals.users.merge(bucket.users)
+        
+        try:
+            with connection.cursor() as cursor:
+                # Rows are always locked in key order, so concurrent flushes queue
+                # behind each other instead of deadlocking
+                for (resolution, bucket_start), totals in sorted(rows.items()):
+                    _merge_row(cursor, resolution, bucket_start, totals.logins, totals.failures,
+                               totals.registrations, totals.users)
+            connection.commit()
+            connection.close()
+            return len(items)
+        except Exception as e:
+            connection.rollback()
+            report_error(e)
+            print(f"Error flushing rollups: {e}")
+            connection.close()
+            self._put_back(items)
+            return 0
+
+def _merge_row(cursor, resolution, bucket_start, logins, failures, registrations, users):
+    """Add counts into a rollup row, merging the unique-user sketch.
+    
+    The upsert either creates the row with this sketch or adds the counts
+    to an existing row and locks it; only in that second case is the stored
+    sketch read and merged. Nothing is locked before the row exists, so
+    workers creating the same bucket do not deadlock on gap locks.
+    """
+    inserted = cursor.execute("""
+        INSERT INTO ActivityRollups 
+            (resolution, bucket_start, logins, failures, registrations, unique_users, unique_users_hll) 
+        VALUES (%s, %s, %s, %s, %s, %s, %s) 
+        ON DUPLICATE KEY UPDATE 
+            logins = logins + VALUES(logins), 
+            failures = failures + VALUES(failures), 
+            registrations = registrations + VALUES(registrations)
+    """, (resolution, bucket_start, logins, failures, registrations, users.count(), users.to_bytes())) == 1
+    if inserted or not any(users.registers):
+        # No logins to add to the sketch
+        return
+    cursor.execute("""
+        SELECT unique_users_hll FROM ActivityRollups 
+        WHERE resolution = %s AND bucket_start = %s
+    """, (resolution, bucket_start))
+    users = HyperLogLog.from_bytes(cursor.fetchone()['unique_users_hll']).merge(users)
+    cursor.execute("""
+        UPDATE ActivityRollups SET unique_users = %s, unique_users_hll = %s 
+        WHERE resolution = %s AND bucket_start = %s
+    """, (users.count(), users.to_bytes(), resolution, bucket_start))
+
+def prune(resolution, older_than):
+    """Delete rows of one resolution older than the cutoff. Returns rows deleted."""
+    connection = get_db_connection()
+    if connection is None:
+        return 0
+    
+    try:
+        with connection.cursor() as cursor:
+            deleted = cursor.execute("""
+                DELETE FROM ActivityRollups 
+                WHERE resolution = %s AND bucket_start < %s
+            """, (resolution, older_than))
+        connection.commit()
+        connection.close()
+        return deleted
+    except Exception as e:
+        connection.rollback()
+        report_error(e)
+        print(f"Error pruning rollups: {e}")
+        connection.close()
+        return 0
+
+def compact_rollups():
+    """Apply the retention policy: drop old minute rows, then old hour rows.
+    
+    Hour and day rows are written alongside the minutes, so nothing needs
+    folding; coarser rows already cover what is deleted.
+    """
+    now = datetime.now()
+    pruned = prune('minute', truncate(now - timedelta(hours=Config.ROLLUP_MINUTE_RETENTION_HOURS), 'hour'))
+    pruned += prune('hour', truncate(now - timedelta(days=Config.ROLLUP_HOUR_RETENTION_DAYS), 'day'))
+    return pruned
+
+def get_trend(resolution='hour', points=48):
+    """Return the last N buckets at the given resolution, oldest first."""
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"Unknown resolution: {resolution}")
+    step = {'minute': timedelta(minutes=1), 'hour': timedelta(hours=1), 'day': timedelta(days=1)}[resolution]
+    end = truncate(datetime.now(), resolution)
+    start = end - step * (points - 1)
+    
+    buckets = OrderedDict()
+    moment = start
+    while moment <= end:
+        buckets[moment] = {'logins': 0, 'failures': 0, 'registrations': 0, 'unique_users': 0}
+        moment += step
+    
+    connection = get_db_connection()
+    if connection is None:
+        return None
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT * FROM ActivityRollups 
+                WHERE resolution = %s AND bucket_start >= %s
+            """, (resolution, start))
+            rows = cursor.fetchall()
+        connection.close()
+    except Exception as e:
+        report_error(e)
+        print(f"Error reading rollups: {e}")
+        connection.close()
+        return None
+    
+    for row in rows:
+        if row['bucket_start'] in buckets:
+            buckets[row['bucket_start']] = row
+    
+    return [{
+        'bucket_start': moment.isoformat(),
+        'logins': row['logins'],
+        'failures': row['failures'],
+        'registrations': row['registrations'],
+        'unique_users': row['unique_users']
+    } for moment, row in buckets.items()]
+
+rollup_buffer = RollupBuffer()
+
+def record_metric(metric, user_id=None):
+    """Count an event in the current minute bucket (in memory only)."""
+    rollup_buffer.record(metric, user_id)
+
+def _flush_loop():
+    last_compaction = 0
+    while True:
+        time.sleep(Config.ROLLUP_FLUSH_INTERVAL)
+        rollup_buffer.flush()
+        if time.monotonic() - last_compaction >= Config.ROLLUP_COMPACT_INTERVAL:
+            compact_rollups()
+            last_compaction = time.monotonic()
+
+_flush_pid = None
+
+def init_rollups():
+    """Start the background flusher once per process."""
+    global _flush_pid
+    if _flush_pid == os.getpid():
+        return
+    _flush_pid = os.getpid()
+    threading.Thread(target=_flush_loop, name='rollup-flush', daemon=True).start()
+    atexit.register(rollup_buffer.flush, True)
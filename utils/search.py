@@ -0,0 +1,342 @@
+import heapq
+import os
+import threading
+import time
+from datetime import timedelta
+import pymysql
+from config import Config
+from utils.cache import broadcast, on_broadcast
+from utils.db import get_db_connection, report_error
+
+SEARCH_FIELDS = ('username', 'email', 'full_name')
+
+# Users queued for deletion are left out of the index
+NOT_QUEUED = "NOT EXISTS (SELECT 1 FROM AccountDeletions d WHERE d.user_id = u.user_id)"
+
+# Catch-up re-reads rows updated this long before the newest updated_at seen,
+# because a transaction's updated_at is set before it commits
+CATCH_UP_OVERLAP = timedelta(seconds=60)
+
+def _trigrams(text):
+    """Trigrams of each word, padded so 1-2 character prefixes are indexed too."""
+    grams = set()
+    for word in text.lower().split():
+        padded = '  ' + word
+        for i in range(len(padded) - 2):
+            grams.add(padded[i:i + 3])
+    return grams
+
+def _query_trigrams(query):
+    """Trigrams every match must contain, built per word like the index."""
+    grams = set()
+    for word in query.split():
+        if len(word) < 3:
+            # Short words match word prefixes via the padded grams
+            grams.add(('  ' + word)[-3:])
+        else:
+            grams |= {word[i:i + 3] for i in range(len(word) - 2)}
+    return grams
+
+def _word_rank(words, value):
+    """2 if every query word starts a word of value, 3 if some only occur inside it, else None."""
+    value_words = value.split()
+    rank = 2
+    for word in words:
+        if any(value_word.startswith(word) for value_word in value_words):
+            continue
+        if len(word) >= 3 and word in value:
+            rank = 3
+            continue
+        return None
+    return rank
+
+class UserSearchIndex:
+    """In-memory trigram index over username, email and full_name.
+    
+    Each worker has its own copy. With a topic, add/update/remove are
+    broadcast to the other workers, which apply them through apply();
+    catch_up() repairs anything a worker missed.
+    """
+    
+    def __init__(self, topic=None):
+        self.topic = topic
+        self._docs = {}
+        self._postings = {}
+        self._lock = threading.RLock()
+        self._building = False
+        # Writes that land while a rebuild scans Users: ids whose scanned row
+        # is stale (added or removed since), and field updates for ids not
+        # scanned yet
+        self._skip_during_build = set()
+        self._updates_during_build = {}
+        self.ready = False
+        self.built_at = None
+        # Newest Users.updated_at read by a rebuild or catch-up
+        self.high_water = None
+    
+    def _doc_grams(self, doc):
+        grams = set()
+        for field in SEARCH_FIELDS:
+            if doc.get(field):
+                grams |= _trigrams(doc[field])
+        return grams
+    
+    def _broadcast(self, items):
+        if self.topic:
+            broadcast(self.topic, items)
+    
+    def add(self, user_id, username, email, full_name=None):
+        """Insert or replace a user in the index of every worker."""
+        self._add(user_id, username, email, full_name)
+        self._broadcast([['add', user_id, username, email, full_name]])
+    
+    def _add(self, user_id, username, email, full_name):
+        with self._lock:
+            self._add_locked(user_id, username, email, full_name)
+            if self._building:
+                self._skip_during_build.add(user_id)
+    
+    def _add_locked(self, user_id, username, email, full_name):
+        doc = {'user_id': user_id, 'username': username, 'email': email, 'full_name': full_name}
+        self._remove_locked(user_id)
+        self._docs[user_id] = doc
+        for gram in self._doc_grams(doc):
+            self._postings.setdefault(gram, set()).add(user_id)
+    
+    def update(self, user_id, **fields):
+        """Change indexed fields for an existing user in every worker."""
+        fields = {k: v for k, v in fields.items() if k in SEARCH_FIELDS}
+        self._update(user_id, fields)
+        self._broadcast([['update', user_id, fields]])
+    
+    def _update(self, user_id, fields):
+        with self._lock:
+            doc = self._docs.get(user_id)
+            if doc is None:
+                if self._building:
+                    # Applied when the rebuild reaches this user's row
+                    self._updates_during_build.setdefault(user_id, {}).update(fields)
+                return
+            doc = dict(doc, **fields)
+            self._add(user_id, doc['username'], doc['email'], doc['full_name'])
+    
+    def remove(self, user_id):
+        """Drop a user from the index of every worker."""
+        self.remove_many([user_id])
+    
+    def remove_many(self, user_ids):
+        user_ids = list(user_ids)
+        self._remove(user_ids)
+        self._broadcast([['remove', user_id] for user_id in user_ids])
+    
+    def _remove(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._remove_locked(user_id)
+                if self._building:
+                    self._skip_during_build.add(user_id)
+    
+    def apply(self, items):
+        """Apply writes broadcast by another worker."""
+        for item in items:
+            op, user_id = item[0], item[1]
+            if op == 'add':
+                self._add(user_id, *item[2:5])
+            elif op == 'update':
+                self._update(user_id, {k: v for k, v in item[2].items() if k in SEARCH_FIELDS})
+            elif op == 'remove':
+                self._remove([user_id])
+    
+    def _remove_locked(self, user_id):
+        doc = self._docs.pop(user_id, None)
+        if doc is None:
+            return
+        for gram in self._doc_grams(doc):
+            ids = self._postings.get(gram)
+            if ids is not None:
+                ids.discard(user_id)
+                if not ids:
+                    del self._postings[gram]
+    
+    def clear(self):
+        """Drop every document, ahead of a rebuild from scratch."""
+        with self._lock:
+            self._docs = {}
+            self._postings = {}
+            self.ready = False
+            self.built_at = None
+            self.high_water = None
+    
+    def search(self, query, limit=10):
+        """Return the top matches: exact, then prefix, then substring matches."""
+        words = query.lower().split()
+        query = ' '.join(words)
+        if not query:
+            return []
+        
+        with self._lock:
+            # Intersect the rarest posting lists first
+            postings = sorted((self._postings.get(g, set()) for g in _query_trigrams(query)), key=len)
+            candidates = set(postings[0])
+            for ids in postings[1:]:
+                candidates &= ids
+                if not candidates:
+                    return []
+            docs = [self._docs[user_id] for user_id in candidates]
+        
+        ranked = []
+        for doc in docs:
+            best = None
+            for field in SEARCH_FIELDS:
+                value = (doc.get(field) or '').lower()
+                if value == query:
+                    rank = 0
+                elif value.startswith(query):
+                    rank = 1
+                else:
+                    rank = _word_rank(words, value)
+                    if rank is None:
+                        continue
+                best = rank if best is None else min(best, rank)
+            if best is not None:
+                ranked.append((best, len(doc['username']), doc['username'], doc))
+        
+        return [item[3] for item in heapq.nsmallest(limit, ranked, key=lambda item: item[:3])]
+    
+    def rebuild(self, batch_size=5000):
+        """Populate the index from a streaming (unbuffered) scan of Users."""
+        connection = get_db_connection()
+        if connection is None:
+            return False
+        
+        with self._lock:
+            self._building = True
+            self._skip_during_build = set()
+            self._updates_during_build = {}
+        high_water = None
+        try:
+            with connection.cursor(pymysql.cursors.SSDictCursor) as cursor:
+                cursor.execute(f"SELECT user_id, username, email, full_name, updated_at FROM Users u WHERE {NOT_QUEUED}")
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        if row['updated_at'] is not None and (high_water is None or row['updated_at'] > high_water):
+                            high_water = row['updated_at']
+                        with self._lock:
+                            if row['user_id'] in self._skip_during_build:
+                                continue
+                            row = dict(row, **self._updates_during_build.pop(row['user_id'], {}))
+                            self._add_locked(row['user_id'], row['username'], row['email'], row['full_name'])
+            connection.close()
+            self.ready = True
+            self.built_at = time.time()
+            self.high_water = high_water
+            return True
+        except Exception as e:
+            report_error(e)
+            print(f"Error building user search index: {e}")
+            connection.close()
+            return False
+        finally:
+            with self._lock:
+                self._building = False
+                self._skip_during_build = set()
+                self._updates_during_build = {}
+    
+    def catch_up(self, batch_size=5000):
+        """Apply writes this worker missed (made before it listened, or lost in transit).
+        
+        Rows updated since the high-water mark are re-read, and if the
+        index holds more users than the table, ids that no longer exist
+        (or are queued for deletion) are dropped in a single ordered scan
+        of Users.user_id.
+        """
+        connection = get_db_connection()
+        if connection is None:
+            return False
+        
+        try:
+            with connection.cursor() as cursor:
+                if self.high_water is None:
+                    # Users was empty when the index was built
+                    cursor.execute(f"SELECT user_id, username, email, full_name, updated_at FROM Users u WHERE {NOT_QUEUED}")
+                else:
+                    cursor.execute(f"""
+                        SELECT user_id, username, email, full_name, updated_at FROM Users u 
+                        WHERE updated_at >= %s AND {NOT_QUEUED}
+                    """, (self.high_water - CATCH_UP_OVERLAP,))
+                for row in cursor.fetchall():
+                    if self.high_water is None or row['updated_at'] > self.high_water:
+                        self.high_water = row['updated_at']
+                    self._add(row['user_id'], row['username'], row['email'], row['full_name'])
+                cursor.execute(f"SELECT COUNT(*) AS count FROM Users u WHERE {NOT_QUEUED}")
+                count = cursor.fetchone()['count']
+            if len(self) > count:
+                self._drop_missing(connection, batch_size)
+            connection.close()
+            return True
+        except Exception as e:
+            report_error(e)
+            print(f"Error catching up user search index: {e}")
+            connection.close()
+            return False
+    
+    def _drop_missing(self, connection, batch_size):
+        with self._lock:
+            indexed = sorted(self._docs)
+        stale = []
+        position = 0
+        with connection.cursor(pymysql.cursors.SSDictCursor) as cursor:
+            cursor.execute(f"SELECT user_id FROM Users u WHERE {NOT_QUEUED} ORDER BY user_id")
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    while position < len(indexed) and indexed[position] < row['user_id']:
+                        stale.append(indexed[position])
+                        position += 1
+                    if position < len(indexed) and indexed[position] == row['user_id']:
+                        position += 1
+        stale.extend(indexed[position:])
+        self._remove(stale)
+    
+    def __len__(self):
+        return len(self._docs)
+
+USER_INDEX_TOPIC = 'user_index'
+
+user_index = UserSearchIndex(USER_INDEX_TOPIC)
+on_broadcast(USER_INDEX_TOPIC, user_index.apply)
+_build_pid = None
+
+def _maintain(rebuild):
+    while True:
+        if rebuild:
+            rebuild = not user_index.rebuild()
+        else:
+            user_index.catch_up()
+        time.sleep(Config.USER_INDEX_CATCH_UP_INTERVAL)
+
+def init_user_index():
+    """Build the user search index once per process, then keep it caught up, in the background.
+    
+    Writes from other workers arrive over the cache bus; a periodic
+    catch_up() covers anything missed. A worker keeps an index inherited
+    from a preloading master if it is younger than PRELOAD_MAX_AGE (the
+    first catch-up applies writes made since); an older one is rebuilt
+    from scratch.
+    """
+    global _build_pid
+    if _build_pid == os.getpid():
+        return
+    _build_pid = os.getpid()
+    rebuild = True
+    if user_index.built_at is not None:
+        if time.time() - user_index.built_at < Config.PRELOAD_MAX_AGE:
+            rebuild = False
+        else:
+            user_index.clear()
+    threading.Thread(target=_maintain, args=(rebuild,), name='user-index', daemon=True).start()
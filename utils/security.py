@@ -1,4 +1,5 @@
 from werkzeug.security import generate_password_hash, check_password_hash
+from utils.breach import is_breached
 
 def hash_password(password):
     """Hash a password using werkzeug's secure hashing."""
@@ -18,5 +19,7 @@ def validate_password_strength(password):
         return False, "Password must contain at least one lowercase letter"
     if not any(c.isdigit() for c in password):
         return False, "Password must contain at least one number"
+    if is_breached(password):
+        return False, "This password has appeared in a data breach. Please choose a different one"
     return True, "Password is valid"
 
@@ -1,100 +1,110 @@
-from config import Config
-import pymysql
 from datetime import datetime
+from utils.db import report_error, session_cache, dashboard_cache, DatabaseUnavailable
+from utils.outbox import enqueue
+from utils.shards import connection_for_user, on_main, scatter, merge_newest, attach_usernames
+from utils.stats import record_login, record_logout
+from utils.rollups import record_metric
+
+# Session history rows kept per user in session_cache
+CACHED_SESSIONS = 10
 
 def create_session(user_id, ip_address, user_agent):
-    """Create a new session record in the database."""
+    """Create a new session record on the user's shard."""
+    connection = connection_for_user(user_id)
+    if connection is None:
+        return None
+    
     try:
-        connection = pymysql.connect(
-            host=Config.MYSQL_HOST,
-            user=Config.MYSQL_USER,
-            password=Config.MYSQL_PASSWORD,
-            database=Config.MYSQL_DB,
-            cursorclass=pymysql.cursors.DictCursor
-        )
-        
         with connection.cursor() as cursor:
+            login_time = datetime.now()
             sql = "INSERT INTO Sessions (user_id, ip_address, user_agent, login_time) VALUES (%s, %s, %s, %s)"
-            cursor.execute(sql, (user_id, ip_address, user_agent, datetime.now()))
-            connection.commit()
+            cursor.execute(sql, (user_id, ip_address, user_agent, login_time))
             session_id = cursor.lastrowid
+            enqueue(cursor, 'session', login_time, session_id=session_id, user_id=user_id,
+                    ip_address=ip_address, user_agent=user_agent)
+            on_main(cursor, lambda main: record_login(main, user_id, ip_address, login_time))
+            connection.commit()
         
         connection.close()
+        session_cache.invalidate(user_id)
+        dashboard_cache.invalidate(user_id)
+        record_metric('logins', user_id)
         return session_id
     except Exception as e:
+        report_error(e)
         print(f"Error creating session: {e}")
+        connection.close()
         return None
 
-def end_session(session_id):
-    """Update session with logout time."""
+def end_session(session_id, user_id=None):
+    """Update session with logout time.
+    
+    Session ids are only unique within a shard, so pass the owner's user_id.
+    """
+    connection = connection_for_user(user_id)
+    if connection is None:
+        return False
+    
     try:
-        connection = pymysql.connect(
-            host=Config.MYSQL_HOST,
-            user=Config.MYSQL_USER,
-            password=Config.MYSQL_PASSWORD,
-            database=Config.MYSQL_DB,
-            cursorclass=pymysql.cursors.DictCursor
-        )
-        
         with connection.cursor() as cursor:
-            sql = "UPDATE Sessions SET logout_time = %s WHERE session_id = %s"
-            cursor.execute(sql, (datetime.now(), session_id))
+            logout_time = datetime.now()
+            if user_id is not None:
+                sql = "UPDATE Sessions SET logout_time = %s WHERE session_id = %s AND user_id = %s"
+                cursor.execute(sql, (logout_time, session_id, user_id))
+            else:
+                sql = "UPDATE Sessions SET logout_time = %s WHERE session_id = %s"
+                cursor.execute(sql, (logout_time, session_id))
+            enqueue(cursor, 'session_end', logout_time, session_id=session_id, user_id=user_id)
+            if user_id is not None:
+                on_main(cursor, lambda main: record_logout(main, user_id, logout_time))
             connection.commit()
         
         connection.close()
+        if user_id is not None:
+            session_cache.invalidate(user_id)
         return True
     except Exception as e:
+        report_error(e)
         print(f"Error ending session: {e}")
+        connection.close()
         return False
 
-def get_user_sessions(user_id, limit=10):
-    """Get user's session history."""
+def _query_user_sessions(user_id, limit):
+    connection = connection_for_user(user_id)
+    if connection is None:
+        raise DatabaseUnavailable('database unavailable')
     try:
-        connection = pymysql.connect(
-            host=Config.MYSQL_HOST,
-            user=Config.MYSQL_USER,
-            password=Config.MYSQL_PASSWORD,
-            database=Config.MYSQL_DB,
-            cursorclass=pymysql.cursors.DictCursor
-        )
-        
         with connection.cursor() as cursor:
             sql = """SELECT * FROM Sessions 
                      WHERE user_id = %s 
                      ORDER BY login_time DESC 
                      LIMIT %s"""
             cursor.execute(sql, (user_id, limit))
-            results = cursor.fetchall()
-        
+            return list(cursor.fetchall())
+    finally:
         connection.close()
-        return results
-    except Exception as e:
-        print(f"Error getting user sessions: {e}")
-        return []
 
-def get_all_sessions(limit=100):
-    """Get all sessions (for admin)."""
+def get_user_sessions(user_id, limit=10):
+    """Get user's session history (read from the user's shard only).
+    
+    The latest CACHED_SESSIONS rows are cached per user and invalidated
+    whenever one of the user's sessions starts or ends.
+    """
     try:
-        connection = pymysql.connect(
-            host=Config.MYSQL_HOST,
-            user=Config.MYSQL_USER,
-            password=Config.MYSQL_PASSWORD,
-            database=Config.MYSQL_DB,
-            cursorclass=pymysql.cursors.DictCursor
-        )
-        
-        with connection.cursor() as cursor:
-            sql = """SELECT s.*, u.username 
-                     FROM Sessions s
-                     LEFT JOIN Users u ON s.user_id = u.user_id 
-                     ORDER BY s.login_time DESC 
-                     LIMIT %s"""
-            cursor.execute(sql, (limit,))
-            results = cursor.fetchall()
-        
-        connection.close()
-        return results
+        if limit <= CACHED_SESSIONS:
+            return session_cache.get_or_load(user_id, lambda: _query_user_sessions(user_id, CACHED_SESSIONS))[:limit]
+        return _query_user_sessions(user_id, limit)
+    except DatabaseUnavailable:
+        pass
     except Exception as e:
-        print(f"Error getting all sessions: {e}")
-        return []
+        report_error(e)
+        print(f"Error getting user sessions: {e}")
+    # Degraded mode: serve the last history we saw for this user
+    return session_cache.get_stale(user_id, [])[:limit]
 
+def get_all_sessions(limit=100):
+    """Get all sessions (for admin), newest first across every shard."""
+    results = scatter("""SELECT * FROM Sessions 
+                         ORDER BY login_time DESC 
+                         LIMIT %s""", (limit,))
+    return attach_usernames(merge_newest(results, 'login_time', limit))
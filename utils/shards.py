@@ -0,0 +1,611 @@
+"""Hash sharding for the Sessions and AuditLogs tables.
+
+Rows live on the shard their user_id hashes to; rows without a user
+(anonymized history, system events) live on shard 0. With DB_SHARDS unset
+there is a single shard, the main database, and everything below collapses
+to the old single-database behaviour, including sharing the caller's
+transaction. Users, Roles and the summary tables always stay on the main
+database.
+"""
+import hashlib
+import heapq
+import itertools
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlparse, unquote
+import pymysql
+from config import Config
+from utils.db import CircuitBreaker, get_db_connection, report_error, breaker_cursor
+
+# Tables created on every shard when DB_SHARDS is set (no foreign keys: Users is elsewhere)
+SHARD_SCHEMA = {
+    'mysql': [
+        """CREATE TABLE IF NOT EXISTS Sessions (
+            session_id INT PRIMARY KEY AUTO_INCREMENT,
+            user_id INT NOT NULL,
+            login_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            logout_time TIMESTAMP NULL,
+            ip_address VARCHAR(45),
+            user_agent VARCHAR(255),
+            INDEX idx_sessions_user_time (user_id, login_time),
+            INDEX idx_sessions_time (login_time)
+        )""",
+        """CREATE TABLE IF NOT EXISTS AuditLogs (
+            log_id INT AUTO_INCREMENT PRIMARY KEY,
+            user_id INT,
+            action VARCHAR(100),
+            event_type TINYINT UNSIGNED NOT NULL DEFAULT 0,
+            target_id INT NULL,
+            payload JSON NULL,
+            action_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            INDEX idx_auditlogs_user_time (user_id, action_time),
+            INDEX idx_auditlogs_time (action_time),
+            INDEX idx_auditlogs_type_time (event_type, action_time),
+            INDEX idx_auditlogs_target_time (target_id, action_time)
+        )""",
+        """CREATE TABLE IF NOT EXISTS AuditOutbox (
+            outbox_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            kind VARCHAR(20) NOT NULL,
+            body TEXT NOT NULL,
+            created_at DATETIME NOT NULL
+        )"""
+    ],
+    'sqlite': [
+        """CREATE TABLE IF NOT EXISTS Sessions (
+            session_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            login_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            logout_time TIMESTAMP NULL,
+            ip_address VARCHAR(45),
+            user_agent VARCHAR(255)
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_sessions_user_time ON Sessions (user_id, login_time)",
+        "CREATE INDEX IF NOT EXISTS idx_sessions_time ON Sessions (login_time)",
+        """CREATE TABLE IF NOT EXISTS AuditLogs (
+            log_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            action VARCHAR(100),
+            event_type INTEGER NOT NULL DEFAULT 0,
+            target_id INTEGER NULL,
+            payload TEXT NULL,
+            action_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_auditlogs_user_time ON AuditLogs (user_id, action_time)",
+        "CREATE INDEX IF NOT EXISTS idx_auditlogs_time ON AuditLogs (action_time)",
+        "CREATE INDEX IF NOT EXISTS idx_auditlogs_type_time ON AuditLogs (event_type, action_time)",
+        "CREATE INDEX IF NOT EXISTS idx_auditlogs_target_time ON AuditLogs (target_id, action_time)",
+        """CREATE TABLE IF NOT EXISTS AuditOutbox (
+            outbox_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind VARCHAR(20) NOT NULL,
+            body TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL
+        )"""
+    ]
+}
+
+# Tables moved by the rebalancer: (table, primary key, copied columns). Rows
+# keep their primary key, which is how a retried move recognizes rows that an
+# interrupted run already copied.
+MOVABLE_TABLES = (
+    ('Sessions', 'session_id', ('user_id', 'login_time', 'logout_time', 'ip_address', 'user_agent')),
+    ('AuditLogs', 'log_id', ('user_id', 'action', 'event_type', 'target_id', 'payload', 'action_time'))
+)
+
+# Source "shard" for rows left in the main database from before DB_SHARDS was set
+MAIN = -1
+
+# Constraint violations from either backend (the row itself is bad; retrying will not help)
+INTEGRITY_ERRORS = (pymysql.err.IntegrityError, sqlite3.IntegrityError)
+
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+sqlite3.register_converter('TIMESTAMP', lambda value: datetime.fromisoformat(value.decode()))
+
+class _SqliteCursor:
+    """Just enough of the PyMySQL DictCursor API for the shard queries."""
+    
+    def __init__(self, cursor):
+        self._cursor = cursor
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self._cursor.close()
+    
+    def execute(self, sql, args=()):
+        self._cursor.execute(sql.replace('%s', '?'), tuple(args or ()))
+        return self._cursor.rowcount
+    
+    def executemany(self, sql, args):
+        self._cursor.executemany(sql.replace('%s', '?'), [tuple(row) for row in args])
+        return self._cursor.rowcount
+    
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        return dict(row) if row is not None else None
+    
+    def fetchmany(self, size):
+        return [dict(row) for row in self._cursor.fetchmany(size)]
+    
+    def fetchall(self):
+        return [dict(row) for row in self._cursor.fetchall()]
+    
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+    
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+class SqliteConnection:
+    """SQLite shard with the connection methods the app uses (for local testing)."""
+    
+    dialect = 'sqlite'
+    
+    def __init__(self, path):
+        self._connection = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, timeout=Config.MYSQL_WRITE_TIMEOUT)
+        self._connection.row_factory = sqlite3.Row
+    
+    def cursor(self, cursorclass=None):
+        return _SqliteCursor(self._connection.cursor())
+    
+    def commit(self):
+        self._connection.commit()
+    
+    def rollback(self):
+        self._connection.rollback()
+    
+    def close(self):
+        self._connection.close()
+
+def is_sharded():
+    """True when Sessions and AuditLogs live on separate shard databases."""
+    return bool(Config.DB_SHARDS)
+
+def shard_count():
+    return len(Config.DB_SHARDS) or 1
+
+def _jump_hash(key, buckets):
+    # Jump consistent hash: growing from N to N+1 shards moves only 1/(N+1) of users
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+def shard_for(user_id, count=None):
+    """Shard index holding a user's sessions and audit events."""
+    if user_id is None:
+        return 0
+    digest = hashlib.blake2b(str(int(user_id)).encode(), digest_size=8).digest()
+    return _jump_hash(int.from_bytes(digest, 'big'), count or shard_count())
+
+def group_by_shard(user_ids):
+    """Split user ids into {shard index: [user ids]}."""
+    groups = {}
+    for user_id in user_ids:
+        groups.setdefault(shard_for(user_id), []).append(user_id)
+    return groups
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def _shard_breaker(index):
+    with _breakers_lock:
+        if index not in _breakers:
+            _breakers[index] = CircuitBreaker(
+                failure_threshold=Config.DB_BREAKER_THRESHOLD,
+                reset_timeout=Config.DB_BREAKER_RESET_TIMEOUT
+            )
+        return _breakers[index]
+
+_shard_cursors = {}
+
+def _shard_cursor(index):
+    """Cursor class that reports query outcomes to the shard's own breaker."""
+    with _breakers_lock:
+        if index not in _shard_cursors:
+            _shard_cursors[index] = breaker_cursor(_breakers[index])
+        return _shard_cursors[index]
+
+def _id_sequence(index):
+    """Session settings that give shard index its own AUTO_INCREMENT residue.
+    
+    Shard i hands out ids congruent to i + 1 modulo SHARD_ID_STRIDE, so
+    session, audit and outbox ids never repeat across shards (and survive a
+    move to another shard unchanged) as long as there are at most
+    SHARD_ID_STRIDE shards.
+    """
+    return (f"SET SESSION auto_increment_increment = {Config.SHARD_ID_STRIDE}, "
+            f"auto_increment_offset = {index + 1}")
+
+def _connect(url, cursorclass=pymysql.cursors.DictCursor, init_command=None):
+    parsed = urlparse(url)
+    if parsed.scheme == 'sqlite':
+        return SqliteConnection(url[len('sqlite:///'):])
+    return pymysql.connect(
+        host=parsed.hostname,
+        port=parsed.port or 3306,
+        user=unquote(parsed.username or ''),
+        password=unquote(parsed.password or ''),
+        database=parsed.path.lstrip('/') or None,
+        cursorclass=cursorclass,
+        init_command=init_command,
+        connect_timeout=Config.MYSQL_CONNECT_TIMEOUT,
+        read_timeout=Config.MYSQL_READ_TIMEOUT,
+        write_timeout=Config.MYSQL_WRITE_TIMEOUT
+    )
+
+def get_shard_connection(index):
+    """Connection to one shard, or None if it is unavailable.
+    
+    Each shard has its own circuit breaker, so one failed shard does not
+    put the whole site into degraded mode.
+    """
+    if not is_sharded():
+        return get_db_connection()
+    
+    breaker = _shard_breaker(index)
+    if not breaker.allow_request():
+        return None
+    try:
+        connection = _connect(Config.DB_SHARDS[index], _shard_cursor(index), _id_sequence(index))
+        if isinstance(connection, SqliteConnection):
+            # Local files have no query timeouts to detect
+            breaker.record_success()
+        return connection
+    except Exception as e:
+        breaker.record_failure()
+        print(f"Shard {index} connection error: {e}")
+        return None
+
+def connection_for_user(user_id):
+    """Connection to the shard holding user_id's sessions and audit events."""
+    return get_shard_connection(shard_for(user_id))
+
+def shard_status():
+    """Breaker state per shard (empty when not sharded)."""
+    if not is_sharded():
+        return []
+    return [dict(_shard_breaker(index).snapshot(), shard=index) for index in range(shard_count())]
+
+def on_main(cursor, apply):
+    """Run apply(cursor) against the main database for a shard write.
+    
+    Unsharded, cursor already points at the main database and apply joins
+    its transaction. Sharded, apply commits on its own; a failure there
+    loses a summary update but never the shard row.
+    """
+    if not is_sharded():
+        return apply(cursor)
+    
+    connection = get_db_connection()
+    if connection is None:
+        return None
+    try:
+        with connection.cursor() as main_cursor:
+            result = apply(main_cursor)
+        connection.commit()
+        connection.close()
+        return result
+    except Exception as e:
+        connection.rollback()
+        report_error(e)
+        print(f"Error updating main database: {e}")
+        connection.close()
+        return None
+
+def on_user_shards(cursor, user_ids, apply):
+    """Run apply(shard_cursor, ids) on the shards holding these users.
+    
+    Unsharded, apply runs on the caller's main-database cursor. Sharded,
+    each shard commits separately and any failure raises, so the caller
+    can roll back its own transaction.
+    """
+    if not is_sharded():
+        return apply(cursor, list(user_ids))
+    
+    for index, ids in group_by_shard(user_ids).items():
+        connection = get_shard_connection(index)
+        if connection is None:
+            raise RuntimeError(f'shard {index} unavailable')
+        try:
+            with connection.cursor() as shard_cursor:
+                apply(shard_cursor, ids)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _pool():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=Config.SHARD_QUERY_WORKERS, thread_name_prefix='shard-query')
+        return _executor
+
+def scatter(sql, args=(), strict=False):
+    """Run a read on every shard in parallel and return one row list per shard.
+    
+    Unavailable shards contribute no rows unless strict is set, in which
+    case the first failure is raised.
+    """
+    def run(index):
+        connection = get_shard_connection(index)
+        if connection is None:
+            if strict:
+                raise RuntimeError(f'shard {index} unavailable')
+            return []
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(sql, args)
+                rows = list(cursor.fetchall())
+            connection.close()
+            return rows
+        except Exception as e:
+            report_error(e)
+            print(f"Error querying shard {index}: {e}")
+            connection.close()
+            if strict:
+                raise
+            return []
+    
+    if not is_sharded():
+        return [run(0)]
+    return list(_pool().map(run, range(shard_count())))
+
+def merge_newest(results, key, limit):
+    """k-way heap merge of per-shard row lists, each already sorted newest first."""
+    merged = heapq.merge(*results, key=lambda row: row[key], reverse=True)
+    return list(itertools.islice(merged, limit))
+
+def count_rows(table):
+    """Row count of a sharded table across all shards."""
+    return sum(rows[0]['count'] for rows in scatter(f"SELECT COUNT(*) AS count FROM {table}") if rows)
+
+def attach_usernames(rows):
+    """Add each row's username from the main database (shards have no Users table)."""
+    user_ids = sorted({row['user_id'] for row in rows if row.get('user_id') is not None})
+    names = {}
+    if user_ids:
+        connection = get_db_connection()
+        if connection is not None:
+            try:
+                with connection.cursor() as cursor:
+                    placeholders = ', '.join(['%s'] * len(user_ids))
+                    cursor.execute(f"SELECT user_id, username FROM Users WHERE user_id IN ({placeholders})", user_ids)
+                    names = {row['user_id']: row['username'] for row in cursor.fetchall()}
+                connection.close()
+            except Exception as e:
+                report_error(e)
+                print(f"Error loading usernames: {e}")
+                connection.close()
+    for row in rows:
+        row['username'] = names.get(row.get('user_id'))
+    return rows
+
+def init_shards():
+    """Create the sharded tables on every configured shard."""
+    if shard_count() > Config.SHARD_ID_STRIDE:
+        print(f"DB_SHARDS has more than SHARD_ID_STRIDE ({Config.SHARD_ID_STRIDE}) shards; ids will repeat across shards")
+    for index, url in enumerate(Config.DB_SHARDS):
+        connection = get_shard_connection(index)
+        if connection is None:
+            print(f"Shard {index} is unavailable; tables not created")
+            continue
+        dialect = getattr(connection, 'dialect', 'mysql')
+        try:
+            with connection.cursor() as cursor:
+                for statement in SHARD_SCHEMA[dialect]:
+                    cursor.execute(statement)
+            connection.commit()
+            print(f"Shard {index} initialized ({urlparse(url).scheme})")
+        finally:
+            connection.close()
+
+def query_shard(index, sql, args=()):
+    """Run a read on a single shard, raising if it fails."""
+    connection = get_shard_connection(index)
+    if connection is None:
+        raise RuntimeError(f'shard {index} unavailable')
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, args)
+            return list(cursor.fetchall())
+    finally:
+        connection.close()
+
+def _source_connection(source):
+    connection = get_db_connection() if source == MAIN else get_shard_connection(source)
+    if connection is None:
+        raise RuntimeError('main database unavailable' if source == MAIN else f'shard {source} unavailable')
+    return connection
+
+def _next_users(source, after, limit):
+    """The next limit user ids above after that have rows on source.
+    
+    Each side of the UNION is a bounded, index-ordered scan, so a batch
+    costs the same however many users the shard holds.
+    """
+    connection = _source_connection(source)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT user_id FROM (
+                    SELECT DISTINCT user_id FROM Sessions WHERE user_id > %s ORDER BY user_id LIMIT %s
+                ) s
+                UNION
+                SELECT user_id FROM (
+                    SELECT DISTINCT user_id FROM AuditLogs WHERE user_id > %s ORDER BY user_id LIMIT %s
+                ) a
+                ORDER BY user_id
+                LIMIT %s
+            """, (after, limit, after, limit, limit))
+            return [row['user_id'] for row in cursor.fetchall()]
+    finally:
+        connection.close()
+
+def _copy_rows(src_cursor, dst_cursor, table, key, columns, where, args):
+    """Copy the matching source rows to the target, keeping their ids. Returns (rows copied, ids read).
+    
+    A row whose id is already on the target with the same values was copied
+    by an interrupted run and is skipped. A different row holding that id
+    (ids from before SHARD_ID_STRIDE, or from the main database) makes the
+    copy take a new id, unless an identical copy of the user's row is
+    already there.
+    """
+    selected = (key,) + columns
+    src_cursor.execute(f"SELECT {', '.join(selected)} FROM {table} WHERE {where}", args)
+    rows = src_cursor.fetchall()
+    if not rows:
+        return 0, []
+    ids = [row[key] for row in rows]
+    dst_cursor.execute(f"SELECT {', '.join(selected)} FROM {table} WHERE {key} IN ({', '.join(['%s'] * len(ids))})", ids)
+    existing = {row[key]: row for row in dst_cursor.fetchall()}
+    
+    with_id, without_id = [], []
+    for row in rows:
+        other = existing.get(row[key])
+        if other is None:
+            with_id.append(tuple(row[column] for column in selected))
+        elif any(other[column] != row[column] for column in columns):
+            without_id.append(tuple(row[column] for column in columns))
+    
+    if without_id:
+        user_ids = sorted({values[0] for values in without_id if values[0] is not None})
+        copied = set()
+        if user_ids:
+            dst_cursor.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE user_id IN ({', '.join(['%s'] * len(user_ids))})",
+                               user_ids)
+            copied = {tuple(row[column] for column in columns) for row in dst_cursor.fetchall()}
+        without_id = [values for values in without_id if values not in copied]
+    
+    if with_id:
+        dst_cursor.executemany(
+            f"INSERT INTO {table} ({', '.join(selected)}) VALUES ({', '.join(['%s'] * len(selected))})", with_id)
+    if without_id:
+        dst_cursor.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})", without_id)
+    return len(with_id) + len(without_id), ids
+
+def _move_rows(source, target, select):
+    """Copy rows to target, then delete them from source. Returns (rows copied, rows read).
+    
+    select(table, key) gives the WHERE clause and arguments picking each
+    table's rows. The target commits before the source deletes, so an
+    interrupted move leaves copies that the retry recognizes by id.
+    """
+    src = _source_connection(source)
+    try:
+        dst = get_shard_connection(target)
+        if dst is None:
+            raise RuntimeError(f'shard {target} unavailable')
+    except Exception:
+        src.close()
+        raise
+    
+    copied = read = 0
+    try:
+        moved = []
+        with src.cursor() as src_cursor, dst.cursor() as dst_cursor:
+            for table, key, columns in MOVABLE_TABLES:
+                where, args = select(table, key)
+                if where is None:
+                    continue
+                count, ids = _copy_rows(src_cursor, dst_cursor, table, key, columns, where, args)
+                copied += count
+                read += len(ids)
+                moved.append((table, key, ids))
+            dst.commit()
+            
+            for table, key, ids in moved:
+                for start in range(0, len(ids), 1000):
+                    chunk = ids[start:start + 1000]
+                    src_cursor.execute(f"DELETE FROM {table} WHERE {key} IN ({', '.join(['%s'] * len(chunk))})", chunk)
+            src.commit()
+        return copied, read
+    except Exception:
+        dst.rollback()
+        src.rollback()
+        raise
+    finally:
+        src.close()
+        dst.close()
+
+def _move_users(source, target, user_ids):
+    placeholders = ', '.join(['%s'] * len(user_ids))
+    return _move_rows(source, target, lambda table, key: (f"user_id IN ({placeholders})", user_ids))[0]
+
+def _move_unowned(batch_size):
+    """Move main-database audit rows without a user to shard 0, in id order. Returns rows copied."""
+    def select(table, key):
+        if table != 'AuditLogs':
+            return None, None
+        # Each batch is deleted once copied, so the next one starts at the front again
+        return f"user_id IS NULL ORDER BY {key} LIMIT %s", (batch_size,)
+    
+    copied = 0
+    while True:
+        count, read = _move_rows(MAIN, 0, select)
+        copied += count
+        if read < batch_size:
+            return copied
+
+def _main_has_rows():
+    """Whether the main database still holds Sessions or AuditLogs rows."""
+    connection = _source_connection(MAIN)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT EXISTS(SELECT 1 FROM Sessions) AS s, EXISTS(SELECT 1 FROM AuditLogs) AS a")
+            row = cursor.fetchone()
+            return bool(row['s'] or row['a'])
+    except pymysql.err.ProgrammingError:
+        # No such tables: nothing to migrate
+        return False
+    finally:
+        connection.close()
+
+def rebalance(batch_size=500, dry_run=False):
+    """Move rows to the shard their user hashes to.
+    
+    Run after appending shards to DB_SHARDS, and once after DB_SHARDS is
+    first set: rows still in the main database's Sessions and AuditLogs
+    are moved onto the shards too (rows without a user go to shard 0).
+    Users are read in keyset batches of batch_size per source. Returns
+    (users, rows): misplaced users found and rows copied (0 for a dry
+    run). Raises if a shard fails.
+    """
+    if not is_sharded():
+        return 0, 0
+    
+    sources = list(range(shard_count()))
+    if _main_has_rows():
+        sources.insert(0, MAIN)
+    
+    users = rows = 0
+    for source in sources:
+        after = 0
+        while True:
+            batch = _next_users(source, after, batch_size)
+            if not batch:
+                break
+            # Moved users are deleted from source, but the cursor only moves forward
+            after = batch[-1]
+            misplaced = [user_id for user_id in batch if source == MAIN or shard_for(user_id) != source]
+            users += len(misplaced)
+            if dry_run or not misplaced:
+                continue
+            for target, ids in group_by_shard(misplaced).items():
+                rows += _move_users(source, target, ids)
+        if source == MAIN and not dry_run:
+            rows += _move_unowned(batch_size)
+    return users, rows
@@ -0,0 +1,156 @@
+from datetime import datetime
+from models.audit_log import AuditEvent
+from utils.db import get_db_connection, report_error
+from utils.shards import is_sharded, scatter
+
+# Per-user activity summary, maintained in place so reads never aggregate history.
+# The helpers take an open cursor so the update commits with the caller's write.
+
+def record_login(cursor, user_id, ip_address, login_time=None):
+    cursor.execute("""
+        INSERT INTO UserStats (user_id, login_count, last_login_at, last_ip) 
+        VALUES (%s, 1, %s, %s) 
+        ON DUPLICATE KEY UPDATE 
+            login_count = login_count + 1, 
+            last_login_at = VALUES(last_login_at), 
+            last_ip = VALUES(last_ip)
+    """, (user_id, login_time or datetime.now(), ip_address))
+
+def record_failed_login(cursor, user_id, attempt_time=None):
+    cursor.execute("""
+        INSERT INTO UserStats (user_id, failed_login_count, last_failed_login_at) 
+        VALUES (%s, 1, %s) 
+        ON DUPLICATE KEY UPDATE 
+            failed_login_count = failed_login_count + 1, 
+            last_failed_login_at = VALUES(last_failed_login_at)
+    """, (user_id, attempt_time or datetime.now()))
+
+def record_logout(cursor, user_id, logout_time=None):
+    cursor.execute("""
+        INSERT INTO UserStats (user_id, last_logout_at) 
+        VALUES (%s, %s) 
+        ON DUPLICATE KEY UPDATE last_logout_at = VALUES(last_logout_at)
+    """, (user_id, logout_time or datetime.now()))
+
+ACTIVITY_SQL = """
+    INSERT INTO UserStats (user_id, activity_count, last_activity_at) 
+    VALUES (%s, 1, %s) 
+    ON DUPLICATE KEY UPDATE 
+        activity_count = activity_count + 1, 
+        last_activity_at = GREATEST(COALESCE(last_activity_at, VALUES(last_activity_at)), VALUES(last_activity_at))
+"""
+
+def record_activity(cursor, user_id, action_time=None):
+    """Count an audit log entry for the user."""
+    if user_id is not None:
+        cursor.execute(ACTIVITY_SQL, (user_id, action_time or datetime.now()))
+
+def record_activity_many(cursor, rows):
+    """Count several (user_id, action_time) audit entries."""
+    rows = [row for row in rows if row[0] is not None]
+    if rows:
+        cursor.executemany(ACTIVITY_SQL, rows)
+
+def get_user_stats(user_id):
+    """Return the summary row for one user, or None."""
+    connection = get_db_connection()
+    if connection is None:
+        return None
+    
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT * FROM UserStats WHERE user_id = %s", (user_id,))
+            result = cursor.fetchone()
+        connection.close()
+        return result
+    except Exception as e:
+        report_error(e)
+        print(f"Error getting user stats: {e}")
+        connection.close()
+        return None
+
+SESSION_TOTALS_SQL = """
+    SELECT s.user_id, agg.login_count, agg.last_login_at, agg.last_logout_at, s.ip_address
+    FROM (
+        SELECT user_id, COUNT(*) AS login_count, MAX(login_time) AS last_login_at,
+               MAX(logout_time) AS last_logout_at, MAX(session_id) AS last_session_id
+        FROM Sessions
+        WHERE user_id BETWEEN %s AND %s
+        GROUP BY user_id
+    ) agg
+    JOIN Sessions s ON s.session_id = agg.last_session_id
+"""
+
+EVENT_TOTALS_SQL = """
+    SELECT user_id, COUNT(*), MAX(action_time),
+           SUM(event_type = %s),
+           MAX(CASE WHEN event_type = %s THEN action_time END)
+    FROM AuditLogs
+    WHERE user_id BETWEEN %s AND %s
+    GROUP BY user_id
+"""
+
+INSERT_SESSION_TOTALS = "INSERT INTO UserStats (user_id, login_count, last_login_at, last_logout_at, last_ip)"
+INSERT_EVENT_TOTALS = "INSERT INTO UserStats (user_id, activity_count, last_activity_at, failed_login_count, last_failed_login_at)"
+ON_DUPLICATE_EVENT_TOTALS = """
+    ON DUPLICATE KEY UPDATE 
+        activity_count = VALUES(activity_count), 
+        last_activity_at = VALUES(last_activity_at), 
+        failed_login_count = VALUES(failed_login_count), 
+        last_failed_login_at = VALUES(last_failed_login_at)
+"""
+
+def backfill_user_stats(batch_size=1000):
+    """Rebuild UserStats from Sessions and AuditLogs. Returns True on success.
+    
+    Users are rebuilt in id ranges of batch_size, one transaction each.
+    Deleting a range's rows first locks it, so a login or audit write for
+    those users waits and then adds its increment to the rebuilt totals
+    instead of being overwritten; other users are not blocked. Unsharded
+    each range is two INSERT ... SELECT statements. Sharded, each shard
+    is aggregated separately (a user's rows live on one shard) and the
+    totals are written to the main database; increments committed on the
+    main database while a range's shards are read can be counted twice.
+    """
+    connection = get_db_connection()
+    if connection is None:
+        return False
+    
+    try:
+        last = 0
+        while True:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT user_id FROM Users WHERE user_id > %s ORDER BY user_id LIMIT %s",
+                               (last, batch_size))
+                ids = [row['user_id'] for row in cursor.fetchall()]
+                if not ids:
+                    break
+                first, last = ids[0], ids[-1]
+                _rebuild_range(cursor, first, last)
+            connection.commit()
+        connection.close()
+        return True
+    except Exception as e:
+        connection.rollback()
+        report_error(e)
+        print(f"Error backfilling user stats: {e}")
+        connection.close()
+        return False
+
+def _rebuild_range(cursor, first, last):
+    """Replace the UserStats rows of users first..last (inclusive) with totals from history."""
+    cursor.execute("DELETE FROM UserStats WHERE user_id BETWEEN %s AND %s", (first, last))
+    session_args = (first, last)
+    event_args = (AuditEvent.LOGIN_FAILED, AuditEvent.LOGIN_FAILED, first, last)
+    if not is_sharded():
+        cursor.execute(INSERT_SESSION_TOTALS + SESSION_TOTALS_SQL, session_args)
+        cursor.execute(INSERT_EVENT_TOTALS + EVENT_TOTALS_SQL + ON_DUPLICATE_EVENT_TOTALS, event_args)
+        return
+    for rows in scatter(SESSION_TOTALS_SQL, session_args, strict=True):
+        if rows:
+            cursor.executemany(INSERT_SESSION_TOTALS + " VALUES (%s, %s, %s, %s, %s)",
+                               [tuple(row.values()) for row in rows])
+    for rows in scatter(EVENT_TOTALS_SQL, event_args, strict=True):
+        if rows:
+            cursor.executemany(INSERT_EVENT_TOTALS + " VALUES (%s, %s, %s, %s, %s)" + ON_DUPLICATE_EVENT_TOTALS,
+                               [tuple(row.values()) for row in rows])
@@ -0,0 +1,233 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from config import Config
+from utils.db import get_db_connection, report_error
+from utils.ratelimit import AttemptLimiter
+
+class TokenError(Exception):
+    """Raised when an API token is malformed, forged, expired or revoked.
+    
+    user_id is the token's user when the signature was valid, else None.
+    """
+    
+    def __init__(self, message, user_id=None):
+        super().__init__(message)
+        self.user_id = user_id
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+def _sign(payload):
+    return hmac.new(Config.API_TOKEN_SECRET.encode(), payload, hashlib.sha256).digest()
+
+# Revocations are re-read this many ids behind the newest one seen, because
+# AUTO_INCREMENT ids can commit out of order
+REFRESH_OVERLAP = 1000
+
+class RevocationBitmap:
+    """One bit per token id, set when the token is revoked."""
+    
+    def __init__(self):
+        self._bits = bytearray()
+        self._lock = threading.Lock()
+        self.last_revoke_id = 0
+        self._last_full_refresh = None
+    
+    def add(self, token_id):
+        with self._lock:
+            index = token_id >> 3
+            if index >= len(self._bits):
+                self._bits.extend(bytes(index - len(self._bits) + 1))
+            self._bits[index] |= 1 << (token_id & 7)
+    
+    def __contains__(self, token_id):
+        index = token_id >> 3
+        bits = self._bits
+        return index < len(bits) and bool(bits[index] & (1 << (token_id & 7)))
+    
+    def refresh(self):
+        """Pull recent revocations.
+        
+        Each refresh re-reads a trailing window of REFRESH_OVERLAP ids, so a
+        lower id that commits after a higher one was read is still picked
+        up. Every API_TOKEN_FULL_REFRESH_INTERVAL seconds everything is
+        re-read, which catches any revocation that committed later still.
+        """
+        connection = get_db_connection()
+        if connection is None:
+            return False
+        
+        full = self._last_full_refresh is None or \
+            time.monotonic() - self._last_full_refresh >= Config.API_TOKEN_FULL_REFRESH_INTERVAL
+        since = 0 if full else max(0, self.last_revoke_id - REFRESH_OVERLAP)
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("""
+                    SELECT revoke_id, token_id FROM RevokedTokens 
+                    WHERE revoke_id > %s 
+                    ORDER BY revoke_id
+                """, (since,))
+                rows = cursor.fetchall()
+            connection.close()
+            for row in rows:
+                self.add(row['token_id'])
+            if rows:
+                self.last_revoke_id = max(self.last_revoke_id, rows[-1]['revoke_id'])
+            if full:
+                self._last_full_refresh = time.monotonic()
+            return True
+        except Exception as e:
+            report_error(e)
+            print(f"Error refreshing revoked tokens: {e}")
+            connection.close()
+            return False
+
+revoked_tokens = RevocationBitmap()
+
+# Failed token and credential checks per client IP
+auth_failures = AttemptLimiter(Config.API_AUTH_MAX_FAILURES, Config.API_AUTH_FAILURE_WINDOW)
+
+def encode_token(token_id, user_id, role, expires_at):
+    """Build a signed token string from its claims."""
+    payload = json.dumps({
+        't': token_id,
+        'u': user_id,
+        'r': role,
+        'e': int(expires_at.timestamp())
+    }, separators=(',', ':')).encode()
+    return f"{_b64encode(payload)}.{_b64encode(_sign(payload))}"
+
+def verify_token(token):
+    """Check a token's signature, expiry and revocation without touching the database.
+    
+    Returns the claims as a dict with token_id, user_id, role and expires_at.
+    """
+    try:
+        payload_part, signature_part = token.split('.')
+        payload = _b64decode(payload_part)
+        signature = _b64decode(signature_part)
+    except (ValueError, AttributeError):
+        raise TokenError('Malformed token')
+    
+    if not hmac.compare_digest(signature, _sign(payload)):
+        raise TokenError('Invalid signature')
+    
+    claims = json.loads(payload)
+    if claims['e'] < time.time():
+        raise TokenError('Token expired', claims['u'])
+    if claims['t'] in revoked_tokens:
+        raise TokenError('Token revoked', claims['u'])
+    
+    return {
+        'token_id': claims['t'],
+        'user_id': claims['u'],
+        'role': claims['r'],
+        'expires_at': datetime.fromtimestamp(claims['e'])
+    }
+
+def issue_token(user_id, role, ttl=None, label=None):
+    """Record a new token and return (token_id, token, expires_at), or None."""
+    ttl = ttl or Config.API_TOKEN_TTL
+    expires_at = (datetime.now() + timedelta(seconds=ttl)).replace(microsecond=0)
+    connection = get_db_connection()
+    if connection is None:
+        return None
+    
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO ApiTokens (user_id, label, expires_at) VALUES (%s, %s, %s)",
+                (user_id, label, expires_at)
+            )
+            connection.commit()
+            token_id = cursor.lastrowid
+        connection.close()
+        return token_id, encode_token(token_id, user_id, role, expires_at), expires_at
+    except Exception as e:
+        report_error(e)
+        print(f"Error issuing API token: {e}")
+        connection.close()
+        return None
+
+def revoke_token(token_id):
+    """Revoke a token everywhere; takes effect in this worker immediately."""
+    connection = get_db_connection()
+    if connection is None:
+        return False
+    
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT IGNORE INTO RevokedTokens (token_id) VALUES (%s)", (token_id,))
+            connection.commit()
+        connection.close()
+        revoked_tokens.add(token_id)
+        return True
+    except Exception as e:
+        report_error(e)
+        print(f"Error revoking API token: {e}")
+        connection.close()
+        return False
+
+def revoke_user_tokens(cursor, user_ids):
+    """Revoke every unexpired token of these users inside the caller's transaction.
+    
+    Used whenever a user's role changes or they are deactivated or deleted.
+    Tokens already revoked are skipped by the unique key on token_id.
+    Returns the token ids, all revoked now.
+    """
+    if not user_ids:
+        return []
+    placeholders = ', '.join(['%s'] * len(user_ids))
+    cursor.execute(f"""
+        SELECT token_id FROM ApiTokens 
+        WHERE user_id IN ({placeholders}) 
+          AND (expires_at IS NULL OR expires_at > %s)
+    """, list(user_ids) + [datetime.now()])
+    token_ids = [row['token_id'] for row in cursor.fetchall()]
+    if token_ids:
+        cursor.executemany("INSERT IGNORE INTO RevokedTokens (token_id) VALUES (%s)", [(token_id,) for token_id in token_ids])
+        for token_id in token_ids:
+            revoked_tokens.add(token_id)
+    return token_ids
+
+def get_token_owner(token_id):
+    """Return the user_id a token was issued to, or None."""
+    connection = get_db_connection()
+    if connection is None:
+        return None
+    
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT user_id FROM ApiTokens WHERE token_id = %s", (token_id,))
+            row = cursor.fetchone()
+        connection.close()
+        return row['user_id'] if row else None
+    except Exception as e:
+        report_error(e)
+        print(f"Error looking up API token: {e}")
+        connection.close()
+        return None
+
+def _refresh_loop():
+    while True:
+        revoked_tokens.refresh()
+        time.sleep(Config.API_TOKEN_REFRESH_INTERVAL)
+
+_refresh_pid = None
+
+def init_token_revocations():
+    """Keep the revocation bitmap current in the background, once per process."""
+    global _refresh_pid
+    if _refresh_pid == os.getpid():
+        return
+    _refresh_pid = os.getpid()
+    threading.Thread(target=_refresh_loop, name='token-revocations', daemon=True).start()